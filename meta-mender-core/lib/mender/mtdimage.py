@@ -0,0 +1,216 @@
+# Copyright 2019 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Assembler for the raw flash image (mtdimg).
+#
+# Every payload is written exactly once, at the offset of its MTD partition.
+# Everything which is not covered by a payload is either filled with the value
+# which erased flash reads as (normally 0xff), or left as a hole in the image
+# file, which reads as zeros. Optionally a program map is written, listing the
+# erase blocks which contain anything else than that fill value, so that
+# flashers can skip the others, as long as they make sure those read as the
+# fill value, which the map records as EraseValue.
+#
+# For targets which expose the flash as several banks, such as the QEMU
+# vexpress-a9 NOR flash, the image can also be split into one file per bank.
+
+import os
+
+from mender import partimage
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# What holes in the image file read as.
+HOLE_VALUE = 0x00
+
+
+class MtdImageError(Exception):
+    pass
+
+
+class MtdRegion(object):
+    """An MTD partition, and the file to write into it, if any."""
+
+    def __init__(self, name, offset, size, source=None):
+        self.name = name
+        self.offset = offset
+        self.size = size
+        self.source = source
+
+    def __repr__(self):
+        return "MtdRegion(%s, offset=%d, size=%d, source=%s)" % (self.name, self.offset,
+                                                                self.size, self.source)
+
+
+def _pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def _fill(fd, start, end, fill_value):
+    if fill_value is None or start >= end:
+        # Leave it as a hole.
+        return
+    chunk = bytes(bytearray([fill_value]) * min(COPY_CHUNK_SIZE, end - start))
+    pos = start
+    while pos < end:
+        length = min(len(chunk), end - pos)
+        _pwrite_all(fd, chunk[:length], pos)
+        pos += length
+
+
+def _mark_programmed_blocks(blocks, data, offset, block_size, erase_value):
+    """Add the index of every block touched by data (at image offset) which
+    contains anything else than erase_value to blocks."""
+
+    erased = bytes(bytearray([erase_value]) * block_size)
+    pos = 0
+    while pos < len(data):
+        block = (offset + pos) // block_size
+        block_end = (block + 1) * block_size - offset
+        piece = data[pos:block_end]
+        if block not in blocks and piece != erased[:len(piece)]:
+            blocks.add(block)
+        pos = block_end
+
+
+def _block_ranges(blocks):
+    ranges = []
+    for block in sorted(blocks):
+        if ranges and ranges[-1][1] == block - 1:
+            ranges[-1][1] = block
+        else:
+            ranges.append([block, block])
+    return ranges
+
+
+def write_program_map(path, image_name, image_size, block_size, erase_value, blocks, regions):
+    with open(path, "w") as fd:
+        fd.write("# Program map for %s\n" % image_name)
+        fd.write("# ImageSize: %d\n" % image_size)
+        fd.write("# BlockSize: %d\n" % block_size)
+        fd.write("# BlocksCount: %d\n" % ((image_size + block_size - 1) // block_size))
+        fd.write("# MappedBlocksCount: %d\n" % len(blocks))
+        fd.write("# EraseValue: 0x%02x\n" % erase_value)
+        fd.write("# Blocks which are not listed contain only EraseValue bytes.\n")
+        fd.write("# first-last offset size mtdpart\n")
+        for first, last in _block_ranges(blocks):
+            offset = first * block_size
+            size = min((last + 1) * block_size, image_size) - offset
+            names = [region.name for region in regions
+                     if region.offset < offset + size and offset < region.offset + region.size]
+            fd.write("%d-%d 0x%08x 0x%08x %s\n" % (first, last, offset, size, ",".join(names)))
+
+
+def assemble(output, regions, fill_value=None, block_size=None, map_path=None):
+    """Write the flash image, in a single pass.
+
+    regions is a list of MtdRegion. If fill_value is None, everything not
+    covered by a payload is left as holes, otherwise it is filled with
+    fill_value. If map_path is given, a program map with the granularity of
+    block_size is written there, with the value the unused space actually
+    has as the erase value."""
+
+    regions = sorted(regions, key=lambda region: region.offset)
+    for prev, cur in zip(regions, regions[1:]):
+        if prev.offset + prev.size > cur.offset:
+            raise MtdImageError("mtdparts '%s' and '%s' overlap" % (prev.name, cur.name))
+    image_size = max([region.offset + region.size for region in regions] + [0])
+
+    erase_value = HOLE_VALUE if fill_value is None else fill_value
+    programmed = set()
+
+    if os.path.lexists(output):
+        os.unlink(output)
+    fd = os.open(output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, image_size)
+        pos = 0
+        for region in regions:
+            _fill(fd, pos, region.offset, fill_value)
+            pos = region.offset
+
+            if region.source is not None:
+                source_size = os.stat(region.source).st_size
+                if source_size > region.size:
+                    raise MtdImageError("%s is too big to fit inside '%s' mtdpart of size %d."
+                                        % (region.source, region.name, region.size))
+                with open(region.source, "rb") as source:
+                    while True:
+                        chunk = source.read(COPY_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        _pwrite_all(fd, chunk, pos)
+                        if map_path:
+                            _mark_programmed_blocks(programmed, chunk, pos, block_size,
+                                                    erase_value)
+                        pos += len(chunk)
+
+            _fill(fd, pos, region.offset + region.size, fill_value)
+            pos = region.offset + region.size
+    except Exception:
+        os.close(fd)
+        os.unlink(output)
+        raise
+    os.close(fd)
+
+    if map_path:
+        write_program_map(map_path, os.path.basename(output), image_size, block_size,
+                          erase_value, programmed, regions)
+
+
+def split_banks(image, bank_paths, bank_size, fill_value=None):
+    """Split the flash image into one file per bank, in a single pass.
+
+    Every bank file is bank_size bytes. Only the data extents of image are
+    copied, holes stay holes, and everything after the end of image is either
+    filled with fill_value or left as a hole if fill_value is None."""
+
+    src_fd = os.open(image, os.O_RDONLY)
+    try:
+        image_size = os.fstat(src_fd).st_size
+        if image_size > bank_size * len(bank_paths):
+            raise MtdImageError("%s (%d bytes) does not fit in %d banks of %d bytes"
+                                % (image, image_size, len(bank_paths), bank_size))
+        extents = list(partimage._data_extents(src_fd, image_size))
+
+        for index, path in enumerate(bank_paths):
+            bank_start = index * bank_size
+            bank_end = bank_start + bank_size
+
+            if os.path.lexists(path):
+                os.unlink(path)
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.ftruncate(fd, bank_size)
+                for start, end in extents:
+                    pos = max(start, bank_start)
+                    end = min(end, bank_end)
+                    while pos < end:
+                        chunk = os.pread(src_fd, min(COPY_CHUNK_SIZE, end - pos), pos)
+                        if not chunk:
+                            raise MtdImageError("Unexpected end of file in %s" % image)
+                        _pwrite_all(fd, chunk, pos - bank_start)
+                        pos += len(chunk)
+                _fill(fd, max(image_size, bank_start) - bank_start, bank_size, fill_value)
+            except Exception:
+                os.close(fd)
+                os.unlink(path)
+                raise
+            os.close(fd)
+    finally:
+        os.close(src_fd)
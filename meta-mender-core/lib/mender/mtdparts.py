@@ -0,0 +1,120 @@
+# Copyright 2019 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Parser for mtdparts strings, such as MENDER_MTDPARTS. See the description of
+# the format in mender-setup-ubi.inc.
+#
+# This is the only place the format is parsed. The result is cached on the
+# input strings, so all the helpers which need the MTD layout can ask for it
+# as often as they like.
+
+import collections
+import functools
+import re
+
+# One MTD partition. offset and size are in bytes, and size is None for the
+# '-' partition, which takes all the remaining space.
+MtdPart = collections.namedtuple("MtdPart", ["name", "offset", "size", "ro"])
+
+_PART_RE = re.compile(r"^([0-9]+|-)([kmg]?)(?:@([0-9]+)([kmg]?))?\(([^)]+)\)(ro)?$")
+
+_UNITS = {
+    "": 1,
+    "k": 1024,
+    "m": 1048576,
+    "g": 1073741824,
+}
+
+
+class MtdPartsError(Exception):
+    pass
+
+
+class MtdIdNotFoundError(MtdPartsError):
+    """There is no partition list for the mtdid, including when either of them
+    is empty."""
+    pass
+
+
+def convert_units_to_bytes(number, unit):
+    unit = (unit or "").lower()
+    if unit not in _UNITS:
+        raise MtdPartsError("Cannot parse number '%s' and unit '%s'" % (number, unit))
+    to_return = int(number) * _UNITS[unit]
+
+    if to_return % 1024 != 0:
+        raise MtdPartsError("Numbers in mtdparts must be aligned to a KiB boundary")
+
+    return to_return
+
+
+@functools.lru_cache(maxsize=None)
+def parse(mtdparts, mtdid):
+    """Return the partitions of mtdid in the mtdparts string, as a tuple of
+    MtdPart."""
+
+    if not mtdparts:
+        raise MtdIdNotFoundError("MENDER_MTDPARTS is empty.")
+    if not mtdid:
+        raise MtdIdNotFoundError("MENDER_IS_ON_MTDID is empty. Please set it to the mtdid inside "
+                                 "MENDER_MTDPARTS that you want Mender to use.")
+
+    # Pick the mtdid that matches MENDER_IS_ON_MTDID.
+    for definition in mtdparts.split(";"):
+        if definition.split(":", 1)[0] == mtdid:
+            break
+    else:
+        raise MtdIdNotFoundError("Cannot find a valid mtdparts string inside MENDER_MTDPARTS "
+                                 "(\"%s\"), corresponding to MENDER_IS_ON_MTDID (\"%s\")."
+                                 % (mtdparts, mtdid))
+
+    parts = []
+    total_offset = 0
+    remaining_encountered = False
+    # Skip first component (the ID).
+    for component in definition.split(":", 1)[1].split(","):
+        if len(component) == 0:
+            continue
+
+        if remaining_encountered:
+            raise MtdPartsError("'-' entry was not last entry in mtdparts: '%s'" % definition)
+
+        match = _PART_RE.match(component)
+        if match is None:
+            raise MtdPartsError("'%s' is not a valid mtdparts string. Please set MENDER_MTDPARTS "
+                                "to a valid value" % definition)
+
+        if match.group(3) is None:
+            offset = total_offset
+        else:
+            offset = convert_units_to_bytes(match.group(3), match.group(4))
+
+        if match.group(1) == "-":
+            size = None
+            remaining_encountered = True
+        else:
+            size = convert_units_to_bytes(match.group(1), match.group(2))
+            total_offset = offset + size
+
+        parts.append(MtdPart(match.group(5), offset, size, match.group(6) is not None))
+
+    return tuple(parts)
+
+
+def part_size(part, total_size):
+    """The size of part, resolving '-' against the total size of the flash."""
+
+    if part.size is None:
+        return total_size - part.offset
+    return part.size
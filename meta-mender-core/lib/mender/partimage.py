@@ -0,0 +1,814 @@
+# Copyright 2019 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Assembler for the partitioned Mender images (sdimg, uefiimg, biosimg and
+# gptimg).
+#
+# The partition payloads (boot filesystem, rootfs and data filesystem) are
+# built only once per image, by their own image types. All this module does is
+# to lay them out on a disk image and write the MBR or GPT partition table
+# around them, so that adding another partitioned image type only adds the
+# cost of copying the payloads, not the cost of generating them.
+#
+# The layout is described using the subset of the wic kickstart (wks) format
+# which mender-part-images.bbclass generates, and the partitions are placed
+# exactly where "wic create" would place them. Payloads are copied sparsely, so
+# holes in the payloads stay holes in the resulting image. Partitions using the
+# "empty" source are not written at all, and are left as holes. Like wic's
+# rawcopy source, a --label on a vfat partition is applied to the copied file
+# system. On msdos partition tables, the partition type is the --system-id of
+# the partition, or else chosen from its --fstype, the same way wic chooses it.
+#
+# It also contains the post-processing of the finished image (padding, fixing
+# partition types and setting PARTUUIDs), which is done in a single pass over
+# the partition table, see fixup().
+
+import errno
+import os
+import shlex
+import struct
+import uuid
+import zlib
+
+SECTOR_SIZE = 512
+
+# Sectors before the first partition which are needed by the partition table.
+MBR_OVERHEAD = 1
+GPT_OVERHEAD = 34
+
+GPT_ENTRY_COUNT = 128
+GPT_ENTRY_SIZE = 128
+
+MBR_TYPE_LINUX = 0x83
+MBR_TYPE_SWAP = 0x82
+MBR_TYPE_FAT16 = 0x06
+MBR_TYPE_FAT32_LBA = 0x0c
+MBR_TYPE_EXTENDED_LBA = 0x0f
+MBR_TYPE_EXTENDED = 0x05
+MBR_TYPE_GPT_PROTECTIVE = 0xee
+
+# Partition type GUIDs, indexed by the short codes used by gdisk/sgdisk.
+GPT_TYPE_CODES = {
+    "0700": "EBD0A0A2-B9E5-4433-87C0-68B6B72699C7",  # Microsoft basic data
+    "8200": "0657FD6D-A4AB-43C4-84E5-0933C84B4F4F",  # Linux swap
+    "8300": "0FC63DAF-8483-4772-8E79-3D69D8477DE4",  # Linux filesystem
+    "EF00": "C12A7328-F81F-11D2-BA4B-00A0C93EC93B",  # EFI system partition
+    "EF02": "21686148-6449-6E6F-744E-656564454649",  # BIOS boot partition
+}
+
+# "Legacy BIOS bootable" GPT attribute, which is what the --active flag maps to
+# on GPT.
+GPT_ATTR_LEGACY_BIOS_BOOTABLE = 1 << 2
+
+# Size of the chunks used when copying payloads.
+COPY_CHUNK_SIZE = 1024 * 1024
+
+FAT_LABEL_SIZE = 11
+FAT_ATTR_VOLUME_ID = 0x08
+FAT_ATTR_LONG_NAME = 0x0f
+FAT_DIRENT_SIZE = 32
+
+# Options of "wic create", which WIC_CREATE_EXTRA_ARGS used to be passed to,
+# and whether they take an argument. They only changed how wic itself ran, or
+# produced files next to the image which were thrown away, so they have no
+# equivalent here. Other options are reported, see check_wic_args().
+WIC_NO_EFFECT_OPTIONS = {
+    "-D": False, "--debug": False,
+    "-f": False, "--build-rootfs": False,
+    "-s": False, "--skip-build-check": False,
+    "-m": False, "--bmap": False,
+    "--no-fstab-update": False,
+    "-e": True, "--image-name": True,
+    "-r": True, "--rootfs-dir": True,
+    "-b": True, "--bootimg-dir": True,
+    "-k": True, "--kernel-dir": True,
+    "-n": True, "--native-sysroot": True,
+    "-v": True, "--vars": True,
+    "-o": True, "--outdir": True,
+}
+
+
+class PartImageError(Exception):
+    pass
+
+
+class Partition(object):
+    """One "part" line from the layout description."""
+
+    def __init__(self):
+        self.mountpoint = None
+        self.source = None
+        self.source_file = None
+        self.fstype = None
+        self.label = None
+        self.align_kb = 0
+        self.size_kb = None
+        self.no_table = False
+        self.active = False
+        self.part_type = None
+        self.system_id = None
+
+        # Filled in by layout_partitions().
+        self.start = None
+        self.size_sec = None
+        self.num = 0
+        self.logical = False
+
+    def __repr__(self):
+        return ("Partition(num=%d, start=%d, size_sec=%d, fstype=%s, source_file=%s)"
+                % (self.num, self.start or 0, self.size_sec or 0, self.fstype, self.source_file))
+
+
+class Layout(object):
+    """A complete disk layout, as described by a wks file."""
+
+    def __init__(self):
+        self.ptable_type = None
+        self.partitions = []
+        # Filled in by layout_partitions(), in sectors.
+        self.disk_sectors = None
+
+    def table_partitions(self):
+        return [part for part in self.partitions if not part.no_table]
+
+
+def parse_size_kb(size, default_unit="M"):
+    """Parse a wks style size ("100", "100M", "512k", "1G") into KiB."""
+
+    size = size.strip()
+    unit = default_unit
+    if size and size[-1].upper() in "KMG":
+        unit = size[-1].upper()
+        size = size[:-1]
+    try:
+        value = int(size)
+    except ValueError:
+        raise PartImageError("Invalid size: '%s'" % size)
+    return value * {"K": 1, "M": 1024, "G": 1024 * 1024}[unit]
+
+
+def parse_wks(path):
+    """Parse the wks subset generated by mender-part-images.bbclass."""
+
+    layout = Layout()
+    with open(path) as fd:
+        for lineno, line in enumerate(fd, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                tokens = shlex.split(line)
+                if tokens[0] == "part":
+                    layout.partitions.append(_parse_part(tokens[1:]))
+                elif tokens[0] == "bootloader":
+                    layout.ptable_type = _parse_bootloader(tokens[1:])
+                else:
+                    raise PartImageError("Unknown command '%s'" % tokens[0])
+            except (PartImageError, ValueError) as e:
+                raise PartImageError("%s:%d: %s" % (path, lineno, e))
+
+    if layout.ptable_type is None:
+        layout.ptable_type = "msdos"
+    return layout
+
+
+def _option_value(tokens, i, name):
+    if "=" in tokens[i]:
+        return tokens[i].split("=", 1)[1], i + 1
+    if i + 1 >= len(tokens):
+        raise PartImageError("Option %s requires an argument" % name)
+    return tokens[i + 1], i + 2
+
+
+def _parse_part(tokens):
+    part = Partition()
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        name = token.split("=", 1)[0]
+        if not token.startswith("--"):
+            if part.mountpoint is not None:
+                raise PartImageError("Unexpected argument '%s'" % token)
+            part.mountpoint = token
+            i += 1
+        elif name in ("--no-table", "--active"):
+            setattr(part, name[2:].replace("-", "_"), True)
+            i += 1
+        else:
+            value, i = _option_value(tokens, i, name)
+            if name == "--source":
+                part.source = value
+            elif name == "--sourceparams":
+                for param in value.split(","):
+                    key, _, param_value = param.partition("=")
+                    if key == "file":
+                        part.source_file = param_value
+            elif name == "--fstype":
+                part.fstype = value
+            elif name == "--label":
+                part.label = value
+            elif name == "--align":
+                part.align_kb = int(value)
+            elif name in ("--fixed-size", "--size"):
+                part.size_kb = parse_size_kb(value)
+            elif name == "--part-type":
+                part.part_type = value
+            elif name == "--system-id":
+                part.system_id = _parse_system_id(value)
+            elif name in ("--ondisk", "--mkfs-extraopts"):
+                # The disk is always the image itself, and the filesystems are
+                # made beforehand.
+                pass
+            else:
+                raise PartImageError("Unsupported option '%s'" % name)
+
+    if part.source not in (None, "rawcopy", "empty"):
+        raise PartImageError("Unsupported source '%s', only 'rawcopy' and 'empty' are supported"
+                             % part.source)
+    if part.source == "rawcopy" and not part.source_file:
+        raise PartImageError("rawcopy source requires 'file' in --sourceparams")
+    if part.source is None and part.fstype != "swap":
+        raise PartImageError("Partitions without a source must be swap partitions")
+    if part.source != "rawcopy" and part.size_kb is None:
+        raise PartImageError("Partitions without a payload require a size")
+    return part
+
+
+def _parse_system_id(value):
+    try:
+        system_id = int(value, 16)
+    except ValueError:
+        raise PartImageError("Invalid MBR partition type '%s'" % value)
+    if not 0 < system_id <= 0xff:
+        raise PartImageError("Invalid MBR partition type '%s'" % value)
+    return system_id
+
+
+def _parse_bootloader(tokens):
+    ptable_type = None
+    i = 0
+    while i < len(tokens):
+        name = tokens[i].split("=", 1)[0]
+        value, i = _option_value(tokens, i, name)
+        if name == "--ptable":
+            ptable_type = value
+    if ptable_type not in ("msdos", "gpt"):
+        raise PartImageError("Unsupported partition table type '%s'" % ptable_type)
+    return ptable_type
+
+
+def layout_partitions(layout):
+    """Calculate the position of every partition, the same way wic does it."""
+
+    real_count = len(layout.table_partitions())
+    if layout.ptable_type == "gpt" and real_count > GPT_ENTRY_COUNT:
+        raise PartImageError("Too many partitions for GPT: %d" % real_count)
+
+    if layout.ptable_type == "gpt":
+        offset = GPT_OVERHEAD
+    else:
+        offset = MBR_OVERHEAD
+
+    realpart = 0
+    for part in layout.partitions:
+        if not part.no_table:
+            realpart += 1
+
+        if part.size_kb is None:
+            # Raw payload which goes wherever it fits. Round up to whole KiB,
+            # like wic does.
+            file_size = os.stat(part.source_file).st_size
+            part.size_kb = (file_size + 1023) // 1024
+
+        if (layout.ptable_type == "msdos" and real_count > 4
+                and realpart > 3 and not part.no_table):
+            # Reserve a sector for the EBR of every logical partition, before
+            # alignment is performed.
+            offset += 1
+
+        if part.align_kb:
+            align_sectors = part.align_kb * 1024 // SECTOR_SIZE
+            if offset % align_sectors:
+                offset += align_sectors - offset % align_sectors
+
+        part.start = offset
+        part.size_sec = part.size_kb * 1024 // SECTOR_SIZE
+        offset += part.size_sec
+
+        if part.no_table:
+            part.num = 0
+        elif layout.ptable_type == "msdos" and real_count > 4 and realpart > 3:
+            # Number 4 is taken by the extended partition.
+            part.logical = True
+            part.num = realpart + 1
+        else:
+            part.num = realpart
+
+    if layout.ptable_type == "gpt":
+        offset += GPT_OVERHEAD
+    layout.disk_sectors = offset
+
+
+def _data_extents(fd, size):
+    """Yield (start, end) of the ranges of fd which contain data."""
+
+    pos = 0
+    try:
+        while pos < size:
+            try:
+                start = os.lseek(fd, pos, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # Only a hole left.
+                    return
+                raise
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+            yield start, min(end, size)
+            pos = end
+    except (AttributeError, OSError) as e:
+        if isinstance(e, OSError) and e.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+            raise
+        # No hole information available from this platform or filesystem, so
+        # treat the remainder as data.
+        if pos < size:
+            yield pos, size
+
+
+def copy_sparse(src_path, out_fd, offset, max_size):
+    """Copy the data extents of src_path into out_fd at offset."""
+
+    src_fd = os.open(src_path, os.O_RDONLY)
+    try:
+        size = os.fstat(src_fd).st_size
+        if size > max_size:
+            raise PartImageError("%s (%d bytes) does not fit in partition of %d bytes"
+                                 % (src_path, size, max_size))
+        for start, end in _data_extents(src_fd, size):
+            pos = start
+            while pos < end:
+                chunk = os.pread(src_fd, min(COPY_CHUNK_SIZE, end - pos), pos)
+                if not chunk:
+                    raise PartImageError("Unexpected end of file in %s" % src_path)
+                _pwrite_all(out_fd, chunk, offset + pos)
+                pos += len(chunk)
+    finally:
+        os.close(src_fd)
+
+
+def _pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def make_swap_header(size, label=None, page_size=None):
+    """Return a Linux swap header (version 1) for a swap area of size bytes."""
+
+    if page_size is None:
+        page_size = os.sysconf("SC_PAGE_SIZE")
+    pages = size // page_size
+    if pages < 10:
+        raise PartImageError("Swap partition too small: %d bytes" % size)
+
+    header = bytearray(page_size)
+    volume_name = (label or "").encode("utf-8")[:16]
+    struct.pack_into("<III16s16s", header, 1024,
+                     1,             # version
+                     pages - 1,     # last_page
+                     0,             # nr_badpages
+                     uuid.uuid4().bytes,
+                     volume_name)
+    header[page_size - 10:] = b"SWAPSPACE2"
+    return bytes(header)
+
+
+def _chs(lba):
+    """CHS address of lba for a disk with 255 heads and 63 sectors/track."""
+
+    cylinder = lba // (255 * 63)
+    if cylinder > 1023:
+        return b"\xfe\xff\xff"
+    head = (lba // 63) % 255
+    sector = lba % 63 + 1
+    return struct.pack("<BBB", head, sector | ((cylinder >> 2) & 0xc0), cylinder & 0xff)
+
+
+def mbr_entry(boot, ptype, start, sectors):
+    """Pack a 16 byte MBR partition entry."""
+
+    if start > 0xffffffff or sectors > 0xffffffff:
+        raise PartImageError("Partition at sector %d too large for MBR" % start)
+    return (struct.pack("<B", 0x80 if boot else 0x00)
+            + _chs(start)
+            + struct.pack("<B", ptype)
+            + _chs(start + sectors - 1)
+            + struct.pack("<II", start, sectors))
+
+
+def pack_mbr(entries, disk_id=0, bootcode=None):
+    """Pack a MBR sector. entries is a list of up to four 16 byte entries."""
+
+    sector = bytearray(SECTOR_SIZE)
+    if bootcode:
+        sector[:len(bootcode)] = bootcode
+    struct.pack_into("<I", sector, 440, disk_id)
+    for i, entry in enumerate(entries):
+        sector[446 + i * 16:446 + (i + 1) * 16] = entry
+    sector[510:512] = b"\x55\xaa"
+    return bytes(sector)
+
+
+def gpt_type_guid(part_type):
+    """Return the type GUID for a gdisk style code or a GUID string."""
+
+    code = part_type.upper()
+    if code in GPT_TYPE_CODES:
+        return uuid.UUID(GPT_TYPE_CODES[code])
+    try:
+        return uuid.UUID(part_type)
+    except ValueError:
+        raise PartImageError("Unknown GPT partition type '%s'" % part_type)
+
+
+def pack_gpt_entry(type_guid, part_guid, first_lba, last_lba, attributes=0, name=""):
+    encoded_name = name.encode("utf-16-le")[:72]
+    return struct.pack("<16s16sQQQ72s", type_guid.bytes_le, part_guid.bytes_le,
+                       first_lba, last_lba, attributes, encoded_name)
+
+
+def pack_gpt_header(disk_sectors, disk_guid, entries_crc, backup):
+    """Pack the primary (or backup, if backup is True) GPT header sector."""
+
+    last_lba = disk_sectors - 1
+    entry_sectors = GPT_ENTRY_COUNT * GPT_ENTRY_SIZE // SECTOR_SIZE
+    if backup:
+        current, other, entries_lba = last_lba, 1, last_lba - entry_sectors
+    else:
+        current, other, entries_lba = 1, last_lba, 2
+
+    def pack(crc):
+        return struct.pack("<8sIIIIQQQQ16sQIII",
+                           b"EFI PART", 0x00010000, 92, crc, 0,
+                           current, other,
+                           GPT_OVERHEAD, disk_sectors - GPT_OVERHEAD,
+                           disk_guid.bytes_le, entries_lba,
+                           GPT_ENTRY_COUNT, GPT_ENTRY_SIZE, entries_crc)
+
+    crc = zlib.crc32(pack(0)) & 0xffffffff
+    return pack(crc) + b"\0" * (SECTOR_SIZE - 92)
+
+
+def write_gpt(out_fd, disk_sectors, disk_guid, entries, bootcode=None, disk_id=0):
+    """Write protective MBR, both GPT headers and both entry arrays.
+
+    entries is a list of packed entries, which is padded to the full table.
+    bootcode and disk_id are preserved in the protective MBR."""
+
+    table = b"".join(entries)
+    table += b"\0" * (GPT_ENTRY_COUNT * GPT_ENTRY_SIZE - len(table))
+    entries_crc = zlib.crc32(table) & 0xffffffff
+
+    protective = mbr_entry(False, MBR_TYPE_GPT_PROTECTIVE, 1,
+                           min(disk_sectors - 1, 0xffffffff))
+    _pwrite_all(out_fd, pack_mbr([protective], disk_id, bootcode), 0)
+    _pwrite_all(out_fd, pack_gpt_header(disk_sectors, disk_guid, entries_crc, False),
+                SECTOR_SIZE)
+    _pwrite_all(out_fd, table, 2 * SECTOR_SIZE)
+    backup_entries_lba = disk_sectors - 1 - len(table) // SECTOR_SIZE
+    _pwrite_all(out_fd, table, backup_entries_lba * SECTOR_SIZE)
+    _pwrite_all(out_fd, pack_gpt_header(disk_sectors, disk_guid, entries_crc, True),
+                (disk_sectors - 1) * SECTOR_SIZE)
+
+
+def _mbr_type(part):
+    if part.system_id is not None:
+        return part.system_id
+    if part.fstype == "swap":
+        return MBR_TYPE_SWAP
+    if part.fstype == "vfat":
+        return MBR_TYPE_FAT32_LBA
+    if part.fstype == "msdos":
+        return MBR_TYPE_FAT16
+    return MBR_TYPE_LINUX
+
+
+def write_msdos_table(out_fd, layout, disk_id):
+    parts = layout.table_partitions()
+    primary = [part for part in parts if not part.logical]
+    logical = [part for part in parts if part.logical]
+
+    entries = [mbr_entry(part.active, _mbr_type(part), part.start, part.size_sec)
+               for part in primary]
+    if logical:
+        # The extended partition starts at the EBR of the first logical
+        # partition, and covers all the logical partitions.
+        ext_start = logical[0].start - 1
+        ext_end = logical[-1].start + logical[-1].size_sec
+        entries.append(mbr_entry(False, MBR_TYPE_EXTENDED_LBA, ext_start, ext_end - ext_start))
+    _pwrite_all(out_fd, pack_mbr(entries, disk_id), 0)
+
+    # Chain of EBRs, one sector in front of each logical partition.
+    for i, part in enumerate(logical):
+        ebr = part.start - 1
+        ebr_entries = [mbr_entry(part.active, _mbr_type(part), 1, part.size_sec)]
+        if i + 1 < len(logical):
+            following = logical[i + 1]
+            following_ebr = following.start - 1
+            ebr_entries.append(mbr_entry(False, MBR_TYPE_EXTENDED,
+                                         following_ebr - ext_start,
+                                         following.start + following.size_sec - following_ebr))
+        _pwrite_all(out_fd, pack_mbr(ebr_entries), ebr * SECTOR_SIZE)
+
+
+def write_gpt_table(out_fd, layout, disk_guid):
+    entries = []
+    for part in layout.table_partitions():
+        if part.part_type:
+            type_guid = gpt_type_guid(part.part_type)
+        elif part.fstype == "swap":
+            type_guid = gpt_type_guid("8200")
+        elif part.fstype == "vfat":
+            type_guid = gpt_type_guid("0700")
+        else:
+            type_guid = gpt_type_guid("8300")
+        attributes = GPT_ATTR_LEGACY_BIOS_BOOTABLE if part.active else 0
+        entries.append(pack_gpt_entry(type_guid, uuid.uuid4(),
+                                      part.start, part.start + part.size_sec - 1,
+                                      attributes, "primary"))
+    write_gpt(out_fd, layout.disk_sectors, disk_guid, entries)
+
+
+def check_wic_args(args):
+    """Check the "wic create" options in args, a list, and return a tuple of
+    the ones which have no effect here, and the ones which are not supported.
+    Neither kind is applied, so the caller should warn about the unsupported
+    ones. The arguments following an unsupported option are assumed to belong
+    to it, up to the next option."""
+
+    ignored = []
+    unsupported = []
+    i = 0
+    while i < len(args):
+        name = args[i].split("=", 1)[0]
+        if name not in WIC_NO_EFFECT_OPTIONS:
+            option = [args[i]]
+            i += 1
+            while i < len(args) and not args[i].startswith("-"):
+                option.append(args[i])
+                i += 1
+            unsupported.append(" ".join(option))
+        elif WIC_NO_EFFECT_OPTIONS[name] and "=" not in args[i]:
+            value, i = _option_value(args, i, name)
+            ignored.append("%s %s" % (name, value))
+        else:
+            ignored.append(args[i])
+            i += 1
+    return ignored, unsupported
+
+
+def set_fat_label(fd, offset, label):
+    """Set the label of the FAT file system at offset in fd, in the boot
+    sector, and in the volume label entry of the root directory if there is
+    one, which is where mkfs.vfat -n puts it, and where blkid looks first."""
+
+    raw_label = label.encode("ascii")
+    if len(raw_label) > FAT_LABEL_SIZE:
+        raise PartImageError("FAT label '%s' is longer than %d characters"
+                             % (label, FAT_LABEL_SIZE))
+    raw_label = raw_label.ljust(FAT_LABEL_SIZE, b" ")
+
+    boot = _pread_all(fd, SECTOR_SIZE, offset)
+    if boot[510:512] != b"\x55\xaa":
+        raise PartImageError("No FAT file system at offset %d" % offset)
+    (sector_size, sectors_per_cluster, reserved, fats, root_entries,
+     fat_sectors) = struct.unpack_from("<HBHBH3xH", boot, 11)
+    fat32 = fat_sectors == 0
+    if fat32:
+        fat_sectors, root_cluster = struct.unpack_from("<I4xI", boot, 36)
+    _pwrite_all(fd, raw_label, offset + (71 if fat32 else 43))
+
+    # Byte ranges of the root directory.
+    fat_offset = offset + reserved * sector_size
+    root_offset = fat_offset + fats * fat_sectors * sector_size
+    if fat32:
+        cluster_size = sector_size * sectors_per_cluster
+        ranges = []
+        cluster = root_cluster
+        while 2 <= cluster < 0x0ffffff8 and len(ranges) < 65536:
+            ranges.append((root_offset + (cluster - 2) * cluster_size, cluster_size))
+            cluster = struct.unpack("<I", _pread_all(fd, 4, fat_offset + cluster * 4))[0]
+            cluster &= 0x0fffffff
+    else:
+        ranges = [(root_offset, root_entries * FAT_DIRENT_SIZE)]
+
+    for start, size in ranges:
+        data = _pread_all(fd, size, start)
+        for pos in range(0, size, FAT_DIRENT_SIZE):
+            first = data[pos]
+            attributes = data[pos + 11]
+            if first == 0x00:
+                return
+            if (first != 0xe5 and attributes & 0x3f != FAT_ATTR_LONG_NAME
+                    and attributes & FAT_ATTR_VOLUME_ID):
+                _pwrite_all(fd, raw_label, start + pos)
+                return
+
+
+def assemble(layout, output):
+    """Write the disk image described by layout to the file output."""
+
+    layout_partitions(layout)
+
+    if os.path.lexists(output):
+        os.unlink(output)
+    out_fd = os.open(output, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(out_fd, layout.disk_sectors * SECTOR_SIZE)
+
+        for part in layout.partitions:
+            offset = part.start * SECTOR_SIZE
+            size = part.size_sec * SECTOR_SIZE
+            if part.source_file:
+                copy_sparse(part.source_file, out_fd, offset, size)
+                if part.label and part.fstype == "vfat":
+                    set_fat_label(out_fd, offset, part.label)
+            elif part.fstype == "swap":
+                _pwrite_all(out_fd, make_swap_header(size, part.label), offset)
+
+        # The partition table is written last, so that payloads which are
+        # placed without a table entry cannot clobber it.
+        if layout.ptable_type == "gpt":
+            write_gpt_table(out_fd, layout, uuid.uuid4())
+        else:
+            disk_id = struct.unpack("<I", os.urandom(4))[0]
+            write_msdos_table(out_fd, layout, disk_id)
+    except Exception:
+        os.close(out_fd)
+        os.unlink(output)
+        raise
+    os.close(out_fd)
+
+
+def describe(layout):
+    """Return a human readable table of the layout, for the task log."""
+
+    lines = ["%-4s %-10s %-12s %-12s %s" % ("Num", "Type", "Start", "Sectors", "Source")]
+    for part in layout.partitions:
+        if part.no_table:
+            kind = "raw"
+        elif part.logical:
+            kind = "logical"
+        else:
+            kind = part.fstype or "data"
+        lines.append("%-4s %-10s %-12d %-12d %s" % (part.num or "-", kind, part.start,
+                                                    part.size_sec,
+                                                    part.source_file or part.fstype or part.source))
+    return "\n".join(lines)
+
+
+def _pread_all(fd, size, offset):
+    data = os.pread(fd, size, offset)
+    if len(data) != size:
+        raise PartImageError("Unexpected end of image at offset %d" % offset)
+    return data
+
+
+def _is_gpt(fd, mbr):
+    return (mbr[446 + 4] == MBR_TYPE_GPT_PROTECTIVE
+            and _pread_all(fd, 8, SECTOR_SIZE) == b"EFI PART")
+
+
+def _fixup_msdos(fd, mbr, types, disk_id):
+    ebr_writes = []
+    for num, ptype in types:
+        if num < 1:
+            raise PartImageError("Invalid partition number %d" % num)
+        try:
+            ptype = int(ptype, 16)
+        except ValueError:
+            raise PartImageError("Invalid MBR partition type '%s'" % ptype)
+        if num <= 4:
+            entry = 446 + (num - 1) * 16
+            if mbr[entry + 4] == 0:
+                raise PartImageError("Partition %d does not exist" % num)
+            mbr[entry + 4] = ptype
+            continue
+
+        # Logical partition: follow the EBR chain from the extended partition.
+        for i in range(4):
+            if mbr[446 + i * 16 + 4] in (MBR_TYPE_EXTENDED, MBR_TYPE_EXTENDED_LBA, 0x85):
+                ext_start = struct.unpack_from("<I", mbr, 446 + i * 16 + 8)[0]
+                break
+        else:
+            raise PartImageError("Partition %d does not exist" % num)
+        ebr_sector = ext_start
+        for _ in range(num - 5):
+            ebr = _pread_all(fd, SECTOR_SIZE, ebr_sector * SECTOR_SIZE)
+            next_start = struct.unpack_from("<I", ebr, 446 + 16 + 8)[0]
+            if ebr[446 + 16 + 4] == 0 or next_start == 0:
+                raise PartImageError("Partition %d does not exist" % num)
+            ebr_sector = ext_start + next_start
+        ebr = bytearray(_pread_all(fd, SECTOR_SIZE, ebr_sector * SECTOR_SIZE))
+        if ebr[510:512] != b"\x55\xaa" or ebr[446 + 4] == 0:
+            raise PartImageError("Partition %d does not exist" % num)
+        ebr[446 + 4] = ptype
+        ebr_writes.append((ebr_sector, ebr))
+
+    if disk_id is not None:
+        struct.pack_into("<I", mbr, 440, disk_id)
+
+    for sector, ebr in ebr_writes:
+        _pwrite_all(fd, bytes(ebr), sector * SECTOR_SIZE)
+    _pwrite_all(fd, bytes(mbr), 0)
+
+
+def _fixup_gpt(fd, mbr, disk_sectors, types, partuuids):
+    header = _pread_all(fd, 92, SECTOR_SIZE)
+    (_, _, header_size, header_crc, _, _, _, _, _, disk_guid, entries_lba,
+     entry_count, entry_size, entries_crc) = struct.unpack("<8sIIIIQQQQ16sQIII", header)
+    if zlib.crc32(header[:16] + b"\0\0\0\0" + header[20:]) & 0xffffffff != header_crc:
+        raise PartImageError("Primary GPT header is corrupt")
+    if entry_count != GPT_ENTRY_COUNT or entry_size != GPT_ENTRY_SIZE:
+        raise PartImageError("Unsupported GPT entry layout: %d entries of %d bytes"
+                             % (entry_count, entry_size))
+    table = _pread_all(fd, entry_count * entry_size, entries_lba * SECTOR_SIZE)
+    if zlib.crc32(table) & 0xffffffff != entries_crc:
+        raise PartImageError("GPT partition entries are corrupt")
+
+    entries = [bytearray(table[i:i + entry_size]) for i in range(0, len(table), entry_size)]
+
+    def entry_for(num):
+        if num < 1 or num > entry_count or entries[num - 1][:16] == b"\0" * 16:
+            raise PartImageError("Partition %d does not exist" % num)
+        return entries[num - 1]
+
+    for num, part_type in types:
+        entry_for(num)[0:16] = gpt_type_guid(part_type).bytes_le
+    for num, partuuid in partuuids:
+        entry_for(num)[16:32] = uuid.UUID(partuuid).bytes_le
+
+    # Rewriting the whole table puts the backup header and entries at the end
+    # of the (possibly padded) image, and recomputes all the CRCs.
+    write_gpt(fd, disk_sectors, uuid.UUID(bytes_le=disk_guid), [bytes(e) for e in entries],
+              bootcode=bytes(mbr[:440]), disk_id=struct.unpack_from("<I", mbr, 440)[0])
+
+
+def fixup(path, alignment=None, types=(), partuuids=(), disk_id=None):
+    """Post-process a finished partitioned image, in one pass.
+
+    - Pads the image up to a multiple of alignment bytes, and on GPT, moves the
+      backup header and entries to the new end of the image.
+    - Sets the type of the partitions in types, a list of (number, type) pairs,
+      where type is a hex MBR type ("83") for msdos, or a gdisk code or GUID
+      for GPT.
+    - Sets the unique GUID (PARTUUID) of the partitions in partuuids, a list of
+      (number, uuid) pairs. GPT only.
+    - Sets the disk identifier to disk_id. msdos only, where the PARTUUIDs are
+      derived from the disk identifier.
+
+    Pairs are applied in order, so later entries win."""
+
+    fd = os.open(path, os.O_RDWR)
+    try:
+        size = os.fstat(fd).st_size
+        if size % SECTOR_SIZE:
+            raise PartImageError("Image size %d is not a multiple of the sector size" % size)
+        new_size = size
+        if alignment:
+            new_size = (size + alignment - 1) // alignment * alignment
+            if new_size % SECTOR_SIZE:
+                raise PartImageError("Alignment %d is not a multiple of the sector size"
+                                     % alignment)
+
+        mbr = bytearray(_pread_all(fd, SECTOR_SIZE, 0))
+        if mbr[510:512] != b"\x55\xaa":
+            raise PartImageError("%s does not contain a partition table" % path)
+
+        if _is_gpt(fd, mbr):
+            if disk_id is not None:
+                raise PartImageError("Disk identifier can only be set on msdos partition tables")
+            if new_size != size:
+                os.ftruncate(fd, new_size)
+            _fixup_gpt(fd, mbr, new_size // SECTOR_SIZE, types, partuuids)
+        else:
+            if partuuids:
+                raise PartImageError("PARTUUIDs can only be set on GPT partition tables, "
+                                     "use the disk identifier for msdos")
+            if new_size != size:
+                os.ftruncate(fd, new_size)
+            _fixup_msdos(fd, mbr, types, disk_id)
+    finally:
+        os.close(fd)
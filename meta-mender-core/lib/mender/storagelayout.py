@@ -0,0 +1,267 @@
+# Copyright 2019 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Storage layout planner.
+#
+# Computes everything which follows from the storage configuration in one go:
+# the size of the rootfs partitions, the number of the data partition, the
+# offsets of the U-Boot environment copies and, for partitioned images, where
+# every partition ends up on the disk, and checks that it is consistent. The
+# result is memoized on the configuration, so that expanding
+# MENDER_CALC_ROOTFS_SIZE, MENDER_DATA_PART_NUMBER and friends over and over
+# again, which bitbake does for every recipe, only computes the layout once per
+# configuration.
+
+import collections
+import functools
+import math
+
+from mender import partimage
+
+# All the inputs of the planner. Sizes named *_mb are in MiB, the rest are in
+# bytes, except overhead_kb. ptable_type is "msdos", "gpt" or None for
+# storage without a partition table (UBI). env_offset and env_total_size
+# describe the U-Boot environment, they can be None if there is none, and
+# env_on_disk tells whether it is stored in front of the partitions.
+StorageConfig = collections.namedtuple("StorageConfig", [
+    "total_mb",
+    "boot_mb",
+    "data_mb",
+    "swap_mb",
+    "alignment",
+    "overhead_kb",
+    "reserved_bootloader_data",
+    "ptable_type",
+    "env_offset",
+    "env_total_size",
+    "env_on_disk",
+])
+
+# One region of the storage, in bytes. number is None for regions which are not
+# in the partition table.
+StorageRegion = collections.namedtuple("StorageRegion", ["name", "number", "offset", "size"])
+
+
+class StorageLayoutError(Exception):
+    pass
+
+
+class StorageLayout(object):
+    """The result of plan(). Should be treated as read only, since it is
+    shared between all the users of the same configuration."""
+
+    def __init__(self, config):
+        self.config = config
+        self.rootfs_size_kb = None
+        self.data_part_number = None
+        self.env_offsets = ()
+        # Only for partitioned storage.
+        self.regions = ()
+        self.disk_size = None
+        # Inconsistencies found in the configuration, as human readable
+        # strings.
+        self.problems = ()
+
+    def check(self):
+        if self.problems:
+            raise StorageLayoutError("Inconsistent storage configuration:\n  "
+                                     + "\n  ".join(self.problems))
+
+
+def logical_partition_count(boot_mb, swap_mb, ptable_type):
+    """The number of partitions which end up as logical partitions inside an
+    msdos extended partition."""
+
+    if ptable_type != "msdos":
+        return 0
+    count = 3
+    if boot_mb:
+        count += 1
+    if swap_mb:
+        count += 1
+    if count <= 4:
+        return 0
+    # Everything from the fourth partition on.
+    return count - 3
+
+
+def default_overhead_kb(alignment, logical_partitions=0):
+    """Estimate how much space may be lost due partition table. This is based on
+    the assumption that GPT uses one set of sectors at the start of the disk,
+    and one at the end. This wastes a little bit of space in the non-GPT case,
+    which only puts data at the start. In addition, the EBR in front of every
+    logical partition pushes it to the next alignment boundary."""
+
+    if alignment:
+        return (2 + logical_partitions) * int(math.ceil(alignment / 1024))
+    return 0
+
+
+def rootfs_size_kb(config):
+    alignment = config.alignment
+
+    # Space used by each of the partitions, aligned to partition alignment
+    calc_space = math.ceil(config.boot_mb * 1048576 / alignment) * alignment
+    calc_space += math.ceil(config.data_mb * 1048576 / alignment) * alignment
+    calc_space += math.ceil(config.swap_mb * 1048576 / alignment) * alignment
+
+    # Remaining space after partitions and overhead are subtracted.
+    calc_space = config.total_mb * 1048576 - calc_space - config.overhead_kb * 1024
+
+    # Subtract reserved raw space.
+    calc_space = calc_space - config.reserved_bootloader_data
+
+    # Split in two.
+    calc_space = calc_space / 2
+
+    # Need to align to partition alignment, and round down.
+    calc_space = int(calc_space / alignment) * alignment
+
+    # Turn into kiB.
+    return int(calc_space / 1024)
+
+
+def data_part_number(boot_mb, swap_mb, ptable_type):
+    n = 3
+    if boot_mb:
+        n += 1
+    if swap_mb:
+        n += 1
+
+    # Is an msdos extended partition going to be required?
+    if n > 4 and ptable_type == "msdos":
+        n += 1
+    return n
+
+
+def env_offsets(env_offset, env_total_size):
+    """The offsets of the two copies of the U-Boot environment."""
+
+    return (int(env_offset), int(env_offset + env_total_size / 2))
+
+
+def _plan_regions(config, layout):
+    # Lay the partitions out the same way the partitioned image types do, see
+    # mender-part-images.bbclass.
+    if config.alignment % 1024:
+        return ["MENDER_PARTITION_ALIGNMENT (%d) must be KiB aligned when using a partition table"
+                % config.alignment]
+
+    align_kb = config.alignment // 1024
+    disk = partimage.Layout()
+    disk.ptable_type = config.ptable_type
+
+    names = []
+
+    def add(name, size_kb, align, no_table=False, fstype=None):
+        part = partimage.Partition()
+        part.size_kb = size_kb
+        part.align_kb = align
+        part.no_table = no_table
+        part.fstype = fstype
+        disk.partitions.append(part)
+        names.append(name)
+
+    if config.env_on_disk and config.env_total_size:
+        add("uboot-env", (config.env_total_size + 1023) // 1024, config.env_offset // 1024,
+            no_table=True)
+    if config.boot_mb:
+        add("boot", config.boot_mb * 1024, align_kb)
+    add("rootfs-a", layout.rootfs_size_kb, align_kb)
+    add("rootfs-b", layout.rootfs_size_kb, align_kb)
+    if config.swap_mb:
+        add("swap", config.swap_mb * 1024, align_kb, fstype="swap")
+    add("data", config.data_mb * 1024, align_kb)
+
+    partimage.layout_partitions(disk)
+
+    layout.regions = tuple(StorageRegion(name, part.num or None,
+                                         part.start * partimage.SECTOR_SIZE,
+                                         part.size_sec * partimage.SECTOR_SIZE)
+                           for name, part in zip(names, disk.partitions))
+    layout.disk_size = disk.disk_sectors * partimage.SECTOR_SIZE
+
+    problems = []
+    if layout.disk_size > config.total_mb * 1048576:
+        problems.append("The partitions need %d bytes, but MENDER_STORAGE_TOTAL_SIZE_MB is only "
+                        "%d bytes" % (layout.disk_size, config.total_mb * 1048576))
+    data = [region for region in layout.regions if region.name == "data"][0]
+    if data.number != layout.data_part_number:
+        problems.append("The data partition ends up as partition %d, not %d"
+                        % (data.number, layout.data_part_number))
+    return problems
+
+
+@functools.lru_cache(maxsize=None)
+def plan(config):
+    """Plan the storage layout for config, which is a StorageConfig."""
+
+    if config.alignment <= 0:
+        raise StorageLayoutError("MENDER_PARTITION_ALIGNMENT must be positive, not %d"
+                                 % config.alignment)
+
+    layout = StorageLayout(config)
+    layout.rootfs_size_kb = rootfs_size_kb(config)
+    layout.data_part_number = data_part_number(config.boot_mb, config.swap_mb,
+                                               config.ptable_type)
+    if config.env_offset is not None and config.env_total_size is not None:
+        layout.env_offsets = env_offsets(config.env_offset, config.env_total_size)
+
+    problems = []
+    if layout.rootfs_size_kb <= 0:
+        problems.append("There is no space left for the rootfs partitions (%d KiB)"
+                        % layout.rootfs_size_kb)
+    if config.env_on_disk and config.env_offset is not None and config.env_total_size is not None:
+        if config.env_offset % config.alignment:
+            problems.append("The U-Boot environment offset (%d) is not aligned to "
+                            "MENDER_PARTITION_ALIGNMENT (%d)"
+                            % (config.env_offset, config.alignment))
+        # Zero reserved space means that the environment is stored outside of
+        # the user data area, such as in an eMMC boot partition.
+        if 0 < config.reserved_bootloader_data < config.env_total_size:
+            problems.append("The U-Boot environment (%d bytes) does not fit in "
+                            "MENDER_RESERVED_SPACE_BOOTLOADER_DATA (%d bytes)"
+                            % (config.env_total_size, config.reserved_bootloader_data))
+    if config.ptable_type is not None and layout.rootfs_size_kb > 0:
+        problems += _plan_regions(config, layout)
+    layout.problems = tuple(problems)
+
+    return layout
+
+
+def format_table(layout):
+    """Return a human readable description of the layout."""
+
+    config = layout.config
+    lines = [
+        "Storage size:       %d MiB" % config.total_mb,
+        "Partition table:    %s" % (config.ptable_type or "none"),
+        "Alignment:          %d bytes" % config.alignment,
+        "Overhead:           %d KiB" % config.overhead_kb,
+        "Rootfs size:        %d KiB" % layout.rootfs_size_kb,
+        "Data partition:     %d" % layout.data_part_number,
+    ]
+    for index, offset in enumerate(layout.env_offsets, 1):
+        lines.append("U-Boot env %d:       0x%x" % (index, offset))
+    if layout.regions:
+        lines.append("")
+        lines.append("%-4s %-10s %-14s %-14s %s" % ("Num", "Name", "Offset", "Size", "Size (KiB)"))
+        for region in layout.regions:
+            lines.append("%-4s %-10s 0x%-12x 0x%-12x %d" % (region.number or "-", region.name,
+                                                           region.offset, region.size,
+                                                           region.size // 1024))
+        lines.append("Disk end: 0x%x" % layout.disk_size)
+    for problem in layout.problems:
+        lines.append("Problem: %s" % problem)
+    return "\n".join(lines)
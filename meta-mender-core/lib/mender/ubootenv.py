@@ -0,0 +1,387 @@
+# Copyright 2019 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Reads and writes the redundant U-Boot environment in images on the host,
+# without booting them.
+#
+# Each of the two copies is a CRC32 of the variables, a flags byte, and the
+# variables as "name=value" strings, each terminated by a null byte, followed
+# by an extra null byte. The flags byte is a counter, incremented for every
+# write, and the valid copy with the highest counter is the active one. Like
+# fw_setenv, a write goes to the inactive copy, so that the active one stays
+# intact until the new one is complete.
+#
+# The copies can be in a plain file at two offsets, such as uboot.env, or an
+# sdimg at MENDER_UBOOT_ENV_STORAGE_DEVICE_OFFSET_1/2, or in two dynamic
+# volumes of a UBI image, such as the u-boot-env-1/2 volumes of a ubimg.
+
+import collections
+import os
+import struct
+import zlib
+
+ENV_HEADER = struct.Struct("<IB")
+
+UBI_EC_MAGIC = b"UBI#"
+UBI_VID_MAGIC = b"UBI!"
+UBI_LAYOUT_VOLUME_ID = 0x7fffefff
+UBI_VID_DYNAMIC = 1
+UBI_VTBL_RECORD_SIZE = 172
+
+UBI_ENV_VOLUMES = ("u-boot-env-1", "u-boot-env-2")
+
+_UBI_EC_HEADER = struct.Struct(">4sB3xQII")
+_UBI_VID_HEADER = struct.Struct(">4sBBBBII4xIIII4xQ")
+_UBI_VTBL_RECORD = struct.Struct(">IIIBBH128s")
+
+
+class UBootEnvError(Exception):
+    pass
+
+
+def _ubi_crc(data):
+    # UBI uses CRC32 without the final inversion.
+    return ~zlib.crc32(data) & 0xffffffff
+
+
+def parse_variables(data):
+    """Returns the variables in data, the part of an environment copy after
+    the header, as an ordered dictionary."""
+
+    variables = collections.OrderedDict()
+    for entry in data.split(b"\0"):
+        if not entry:
+            # Two null bytes in a row end the environment.
+            break
+        name, sep, value = entry.partition(b"=")
+        if not sep:
+            raise UBootEnvError("Invalid environment entry: '%s'"
+                                % entry.decode("utf-8", "replace"))
+        variables[name.decode("utf-8", "surrogateescape")] \
+            = value.decode("utf-8", "surrogateescape")
+    return variables
+
+
+def pack_variables(variables, size):
+    """Returns variables packed into the size bytes following the header of
+    an environment copy, sorted by name like U-Boot does."""
+
+    data = b"".join([("%s=%s" % (name, variables[name])).encode("utf-8", "surrogateescape")
+                     + b"\0" for name in sorted(variables)])
+    if len(data) + 1 > size:
+        raise UBootEnvError("The variables need %d bytes, but the environment only has %d"
+                            % (len(data) + 1, size))
+    return data + b"\0" * (size - len(data))
+
+
+def parse_defaults(path):
+    """Returns the variables in path, a text file in the format printed by
+    fw_printenv, with one "name=value" per line."""
+
+    variables = collections.OrderedDict()
+    with open(path) as fd:
+        for line in fd:
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            name, sep, value = line.partition("=")
+            if not sep:
+                raise UBootEnvError("%s: Invalid line: '%s'" % (path, line))
+            variables[name] = value
+    return variables
+
+
+def _newer(flags1, flags2):
+    # Whether a copy with flags1 was written after one with flags2, with the
+    # same wrap around rule as U-Boot.
+    if flags1 == 0 and flags2 == 255:
+        return True
+    if flags1 == 255 and flags2 == 0:
+        return False
+    return flags1 > flags2
+
+
+class FileStorage(object):
+    """size bytes at offset in the file at path."""
+
+    def __init__(self, path, offset, size):
+        self.path = path
+        self.offset = offset
+        self.size = size
+        if offset + size > os.stat(path).st_size:
+            raise UBootEnvError("%s: The environment at 0x%x, 0x%x bytes, is beyond the end of "
+                                "the file" % (path, offset, size))
+
+    def __str__(self):
+        return "%s at 0x%x" % (self.path, self.offset)
+
+    def read(self):
+        with open(self.path, "rb") as fd:
+            fd.seek(self.offset)
+            return fd.read(self.size)
+
+    def write(self, data):
+        with open(self.path, "r+b") as fd:
+            fd.seek(self.offset)
+            fd.write(data)
+
+
+class UbiVolumeStorage(object):
+    """The first size bytes of a dynamic UBI volume. leb_pebs maps the logical
+    erase blocks of the volume to the offsets of their data in the image.
+    Data is written in place, which is fine for dynamic volumes, because their
+    data is not covered by a CRC."""
+
+    def __init__(self, path, name, leb_pebs, leb_size, size):
+        self.path = path
+        self.name = name
+        self.leb_pebs = leb_pebs
+        self.leb_size = leb_size
+        self.size = size
+
+    def __str__(self):
+        return "%s volume %s" % (self.path, self.name)
+
+    def _ranges(self):
+        # Yields (offset in the volume, offset in the image or None, size).
+        for start in range(0, self.size, self.leb_size):
+            yield start, self.leb_pebs.get(start // self.leb_size), \
+                min(self.leb_size, self.size - start)
+
+    def read(self):
+        data = []
+        with open(self.path, "rb") as fd:
+            for start, offset, size in self._ranges():
+                if offset is None:
+                    # Unmapped LEBs read as erased flash.
+                    data.append(b"\xff" * size)
+                else:
+                    fd.seek(offset)
+                    data.append(fd.read(size))
+        return b"".join(data)
+
+    def write(self, data):
+        with open(self.path, "r+b") as fd:
+            for start, offset, size in self._ranges():
+                if offset is None:
+                    raise UBootEnvError("%s: LEB %d is not mapped, so it can't be written in "
+                                        "place" % (self, start // self.leb_size))
+                fd.seek(offset)
+                fd.write(data[start:start + size])
+
+
+def _ubi_peb_size(fd, image_size):
+    # The PEB size is the distance to the next erase counter header.
+    size = 4096
+    while size < image_size:
+        fd.seek(size)
+        if fd.read(4) == UBI_EC_MAGIC:
+            return size
+        size *= 2
+    return image_size
+
+
+def ubi_volume_storages(path, names=UBI_ENV_VOLUMES, size=None, peb_size=None):
+    """Returns a UbiVolumeStorage for each of the volumes called names in the
+    UBI image at path. If size is None, the whole volumes are used. peb_size
+    is guessed if it is None."""
+
+    image_size = os.stat(path).st_size
+    with open(path, "rb") as fd:
+        if fd.read(4) != UBI_EC_MAGIC:
+            raise UBootEnvError("%s: Not a UBI image" % path)
+        if peb_size is None:
+            peb_size = _ubi_peb_size(fd, image_size)
+
+        # {volume id: {LEB number: (sequence number, data offset)}}
+        volumes = {}
+        data_offset = None
+        for peb in range(0, image_size - peb_size + 1, peb_size):
+            fd.seek(peb)
+            ec_header = fd.read(64)
+            if len(ec_header) < 64 or ec_header[:4] != UBI_EC_MAGIC \
+               or struct.unpack(">I", ec_header[60:])[0] != _ubi_crc(ec_header[:60]):
+                continue
+            magic, version, ec, vid_offset, data_offset = _UBI_EC_HEADER.unpack_from(ec_header)
+            fd.seek(peb + vid_offset)
+            vid_header = fd.read(64)
+            if len(vid_header) < 64 or vid_header[:4] != UBI_VID_MAGIC \
+               or struct.unpack(">I", vid_header[60:])[0] != _ubi_crc(vid_header[:60]):
+                # Erased PEB.
+                continue
+            (magic, version, vol_type, copy_flag, compat, vol_id, lnum, data_size, used_ebs,
+             data_pad, data_crc, sqnum) = _UBI_VID_HEADER.unpack_from(vid_header)
+            lebs = volumes.setdefault(vol_id, {})
+            if lnum not in lebs or lebs[lnum][0] < sqnum:
+                lebs[lnum] = (sqnum, peb + data_offset)
+        if data_offset is None:
+            raise UBootEnvError("%s: No valid UBI erase blocks" % path)
+        leb_size = peb_size - data_offset
+
+        layout = volumes.get(UBI_LAYOUT_VOLUME_ID, {})
+        if 0 not in layout:
+            raise UBootEnvError("%s: No UBI volume table" % path)
+        fd.seek(layout[0][1])
+        vtbl = fd.read(leb_size)
+
+    by_name = {}
+    for vol_id in range(len(vtbl) // UBI_VTBL_RECORD_SIZE):
+        record = vtbl[vol_id * UBI_VTBL_RECORD_SIZE:(vol_id + 1) * UBI_VTBL_RECORD_SIZE]
+        reserved_pebs, alignment, data_pad, vol_type, upd_marker, name_len, name \
+            = _UBI_VTBL_RECORD.unpack_from(record)
+        if reserved_pebs == 0 or name_len == 0:
+            continue
+        by_name[name[:name_len].decode("utf-8", "replace")] \
+            = (vol_id, reserved_pebs * (leb_size - data_pad), vol_type)
+
+    storages = []
+    for name in names:
+        if name not in by_name:
+            raise UBootEnvError("%s: No UBI volume called %s" % (path, name))
+        vol_id, vol_size, vol_type = by_name[name]
+        if vol_type != UBI_VID_DYNAMIC:
+            raise UBootEnvError("%s: UBI volume %s is static, only dynamic volumes can be "
+                                "written in place" % (path, name))
+        if size is not None and size > vol_size:
+            raise UBootEnvError("%s: UBI volume %s is smaller than the environment" % (path, name))
+        leb_pebs = dict((lnum, entry[1]) for lnum, entry in volumes.get(vol_id, {}).items())
+        storages.append(UbiVolumeStorage(path, name, leb_pebs, leb_size,
+                                         vol_size if size is None else size))
+    return storages
+
+
+class EnvCopy(object):
+    """One copy of the environment, as read from storage. variables is None if
+    the CRC doesn't match."""
+
+    def __init__(self, storage, crc, flags, variables):
+        self.storage = storage
+        self.crc = crc
+        self.flags = flags
+        self.variables = variables
+
+    @property
+    def valid(self):
+        return self.variables is not None
+
+
+class UBootEnv(object):
+    """The redundant environment in the two storages. size is the size of
+    each copy, BOOTENV_SIZE in the U-Boot recipe."""
+
+    def __init__(self, storages, size):
+        if len(storages) != 2:
+            raise UBootEnvError("The redundant environment needs two copies, not %d"
+                                % len(storages))
+        if size <= ENV_HEADER.size:
+            raise UBootEnvError("Invalid environment size: %d" % size)
+        self.storages = storages
+        self.size = size
+
+    def copies(self):
+        """Returns the two EnvCopy objects."""
+
+        copies = []
+        for storage in self.storages:
+            data = storage.read()[:self.size]
+            crc, flags = ENV_HEADER.unpack_from(data)
+            body = data[ENV_HEADER.size:]
+            if zlib.crc32(body) & 0xffffffff == crc:
+                variables = parse_variables(body)
+            else:
+                variables = None
+            copies.append(EnvCopy(storage, crc, flags, variables))
+        return copies
+
+    def active(self):
+        """Returns the EnvCopy which U-Boot and fw_printenv use, or None if
+        neither copy is valid, in which case U-Boot uses its built in
+        defaults."""
+
+        return self._active(self.copies())
+
+    @staticmethod
+    def _active(copies):
+        first, second = copies
+        if first.valid and second.valid:
+            return second if _newer(second.flags, first.flags) else first
+        if first.valid:
+            return first
+        if second.valid:
+            return second
+        return None
+
+    def variables(self):
+        """Returns the variables of the active copy, or None if neither copy
+        is valid."""
+
+        active = self.active()
+        return None if active is None else active.variables
+
+    def write(self, variables):
+        """Writes variables to the inactive copy, making it the active one."""
+
+        copies = self.copies()
+        active = self._active(copies)
+        if active is None:
+            target = copies[0]
+            flags = 1
+        else:
+            target = copies[1] if active is copies[0] else copies[0]
+            flags = (active.flags + 1) & 0xff
+        body = pack_variables(variables, self.size - ENV_HEADER.size)
+        target.storage.write(ENV_HEADER.pack(zlib.crc32(body) & 0xffffffff, flags) + body)
+
+    def update(self, changes, defaults=None):
+        """Sets the variables in changes, and removes the ones whose value is
+        None, like fw_setenv. If neither copy is valid, the changes are
+        applied to defaults, which should be U-Boot's default environment,
+        because U-Boot won't use its defaults anymore once there is a valid
+        copy."""
+
+        variables = self.variables()
+        if variables is None:
+            if defaults is None:
+                raise UBootEnvError("Neither copy of the environment is valid, so the default "
+                                    "environment is needed to change it")
+            variables = collections.OrderedDict(defaults)
+        for name, value in changes.items():
+            if not name or "=" in name:
+                raise UBootEnvError("Invalid variable name: '%s'" % name)
+            if value is None:
+                variables.pop(name, None)
+            else:
+                variables[name] = value
+        self.write(variables)
+
+
+def open_env(path, size=None, offsets=None, volumes=UBI_ENV_VOLUMES, peb_size=None):
+    """Returns the UBootEnv in the image at path. For UBI images, the copies
+    are in volumes. Otherwise they are at offsets, which defaults to the start
+    and the middle of the file, like in uboot.env. size defaults to all the
+    space there is for each copy."""
+
+    with open(path, "rb") as fd:
+        magic = fd.read(4)
+    if magic == UBI_EC_MAGIC and offsets is None:
+        storages = ubi_volume_storages(path, volumes, size, peb_size)
+        if size is None:
+            size = min([storage.size for storage in storages])
+        return UBootEnv(storages, size)
+
+    if offsets is None:
+        offsets = (0, os.stat(path).st_size // 2)
+    if size is None:
+        size = abs(offsets[1] - offsets[0])
+    return UBootEnv([FileStorage(path, offset, size) for offset in offsets], size)
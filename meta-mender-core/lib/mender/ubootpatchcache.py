@@ -0,0 +1,127 @@
+# Copyright 2019 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Content addressed cache for the patch produced by U-Boot auto-configuration.
+#
+# The key is a hash of everything the auto-configuration depends on: the U-Boot
+# sources as they are before auto-configuration (including the patches and
+# files added by the recipe, such as the Kconfig fragment), the defconfig, the
+# auto-configuration scripts and any other settings given by the caller.
+# Patches are stored as <cache dir>/<first two digits of key>/<key>.patch.
+
+import hashlib
+import os
+import shutil
+import stat
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class PatchCacheError(Exception):
+    pass
+
+
+def _hash_file(digest, path):
+    with open(path, "rb") as fd:
+        while True:
+            chunk = fd.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+
+
+def tree_digest(digest, top, exclude=(".git",)):
+    """Add the names, types and contents of everything in top to digest, in a
+    stable order. Top level entries in exclude are skipped."""
+
+    for dirpath, dirnames, filenames in os.walk(top):
+        if dirpath == top:
+            dirnames[:] = [name for name in dirnames if name not in exclude]
+            filenames = [name for name in filenames if name not in exclude]
+        dirnames.sort()
+        rel_dir = os.path.relpath(dirpath, top)
+        for name in sorted(filenames + [name for name in dirnames
+                                        if os.path.islink(os.path.join(dirpath, name))]):
+            path = os.path.join(dirpath, name)
+            rel_path = os.path.normpath(os.path.join(rel_dir, name))
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                digest.update(("L %s -> %s\n" % (rel_path, os.readlink(path))).encode())
+            elif stat.S_ISREG(st.st_mode):
+                digest.update(("F %s %o %d\n" % (rel_path, st.st_mode & 0o111, st.st_size)).encode())
+                _hash_file(digest, path)
+
+
+def cache_key(src_dir, config, files=(), extra=()):
+    """Returns the cache key for auto-configuring src_dir with the defconfig
+    config. files are additional files which influence the result, such as the
+    scripts, and extra a list of strings."""
+
+    digest = hashlib.sha256()
+    digest.update(("config %s\n" % config).encode())
+    for path in files:
+        digest.update(("file %s\n" % os.path.basename(path)).encode())
+        _hash_file(digest, path)
+    for value in extra:
+        digest.update(("extra %s\n" % value).encode())
+    tree_digest(digest, src_dir)
+    return digest.hexdigest()
+
+
+def _entry(cache_dir, key):
+    if len(key) < 3 or not all(c in "0123456789abcdef" for c in key):
+        raise PatchCacheError("Invalid cache key: '%s'" % key)
+    return os.path.join(cache_dir, key[:2], "%s.patch" % key)
+
+
+def lookup(cache_dir, key):
+    """Returns the path of the cached patch for key, or None."""
+
+    path = _entry(cache_dir, key)
+    if os.path.isfile(path):
+        return path
+    return None
+
+
+def check_patch(patch):
+    """Raises PatchCacheError if patch, a diff of the whole tree, cannot be
+    applied as it is. diff only reports binary files as changed, without the
+    changes themselves, so applying such a patch would silently leave them
+    out."""
+
+    with open(patch, "rb") as fd:
+        binary = [line.decode("utf-8", "replace").rstrip()
+                  for line in fd if line.startswith(b"Binary files ")]
+    if binary:
+        raise PatchCacheError("Patch %s contains binary changes, which cannot be applied:\n  %s"
+                              % (patch, "\n  ".join(binary)))
+
+
+def store(cache_dir, key, patch):
+    """Stores patch under key. The entry appears atomically, so concurrent
+    builds never see a partial patch."""
+
+    check_patch(patch)
+    path = _entry(cache_dir, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        shutil.copyfile(patch, tmp_path)
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return path
@@ -0,0 +1,166 @@
+# Copyright 2019 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Validator for the MENDER_* variables, using the definitions in
+# conf/mender-vars.json. It is run by mender_vars_handler in mender-setup.bbclass
+# after every parse.
+#
+# The bitbake server process lives across parses, so everything which can be
+# is kept between them: The schema is loaded and its regular expressions are
+# compiled only once, as long as the file does not change, and variable names
+# are only classified once. A variable is only expanded and checked again if
+# its unexpanded value, or the unexpanded value of anything its expansion
+# depends on, has changed since the last parse. Looking at the unexpanded
+# values is cheap, while expanding can run inline Python, such as the storage
+# layout functions.
+
+import json
+import os
+import re
+
+# Variables ending in something like this are overrides, such as
+# "MENDER_FOO_mender-uboot", and are not checked.
+_OVERRIDE_RE = re.compile(r"_[-a-z0-9][-\w]*$")
+
+# Kinds of variable names.
+_OVERRIDE = 0
+_UNKNOWN = 1
+_KNOWN = 2
+_CHECKED = 3
+
+_schemas = {}
+
+
+class VarsSchema(object):
+    def __init__(self, path):
+        with open(path, "r") as fd:
+            definitions = json.load(fd)
+
+        # Name -> regex source, or list of them, which only produces a note
+        # for the failed ones. They are compiled when first used, since some
+        # of the entries are not meant for re, see _compiled().
+        self.checks = {}
+        self.names = set()
+        for name, value in definitions.items():
+            self.names.add(name)
+            if value != "":
+                self.checks[name] = value
+
+        # Name -> (whether the definition is a list, [(regex source, regex)]).
+        self._compiled = {}
+        self._kinds = {}
+        # Name -> (((dependency, unexpanded value), ...), messages).
+        self._results = {}
+
+    def kind(self, name):
+        kind = self._kinds.get(name)
+        if kind is None:
+            if _OVERRIDE_RE.search(name) is not None:
+                kind = _OVERRIDE
+            elif name not in self.names:
+                kind = _UNKNOWN
+            elif name in self.checks:
+                kind = _CHECKED
+            else:
+                kind = _KNOWN
+            self._kinds[name] = kind
+        return kind
+
+    def _regexes(self, name):
+        # Only variables which are set are checked, so a definition which is
+        # not a valid expression, such as the __MENDER__INFO__ entry, is never
+        # compiled.
+        compiled = self._compiled.get(name)
+        if compiled is None:
+            definition = self.checks[name]
+            if isinstance(definition, list):
+                compiled = (True, [(regex, re.compile(regex)) for regex in definition])
+            else:
+                compiled = (False, [(definition, re.compile(definition))])
+            self._compiled[name] = compiled
+        return compiled
+
+    def check_value(self, name, value):
+        """Return the notes for value, the expanded value of name."""
+
+        if value is None:
+            value = ""
+        is_list, regexes = self._regexes(name)
+        messages = []
+        if is_list:
+            # Each of the expressions is checked for existence.
+            missing = [source for source, regex in regexes if regex.search(value) is None]
+            if missing:
+                messages.append("Variable \"%s\" does not contain suggested value(s): {%s}"
+                                % (name, ', '.join(missing)))
+        else:
+            source, regex = regexes[0]
+            if regex.search(value) is None:
+                messages.append("%s initialized with value \"%s\" | Expected[regex]: \"%s\""
+                                % (name, value, source))
+        return messages
+
+    def check(self, name, get_raw, expand):
+        """Return the notes for name, and whether it had to be expanded and
+        checked, rather than being unchanged since last time. get_raw returns
+        the unexpanded value of a variable, and expand returns the expanded
+        value of a variable together with the names of all the variables the
+        expansion depends on."""
+
+        cached = self._results.get(name)
+        if cached is not None and all(get_raw(dep) == raw for dep, raw in cached[0]):
+            return cached[1], False
+
+        value, deps = expand(name)
+        messages = self.check_value(name, value)
+        snapshot = tuple((dep, get_raw(dep)) for dep in sorted(set(deps) | set([name])))
+        self._results[name] = (snapshot, messages)
+        return messages, True
+
+
+def load(path):
+    """Return the schema in path, reusing the one loaded before if the file has
+    not changed."""
+
+    st = os.stat(path)
+    key = (st.st_mtime, st.st_size, st.st_ino)
+    cached = _schemas.get(path)
+    if cached is None or cached[0] != key:
+        cached = (key, VarsSchema(path))
+        _schemas[path] = cached
+    return cached[1]
+
+
+def validate(schema, names, get_raw, expand):
+    """Validate the variables in names, which may contain any variable names.
+    See VarsSchema.check() for get_raw and expand.
+
+    Returns (warnings, notes, number of values which had to be checked)."""
+
+    warnings = []
+    notes = []
+    checked = 0
+    for name in names:
+        if not name.startswith("MENDER_"):
+            continue
+        kind = schema.kind(name)
+        if kind == _UNKNOWN:
+            # Warn if user has defined some new (unused) MENDER_.* variables
+            warnings.append("\"%s\" is not a recognized MENDER_ variable. Typo?" % name)
+        elif kind == _CHECKED:
+            messages, was_checked = schema.check(name, get_raw, expand)
+            notes += messages
+            if was_checked:
+                checked += 1
+    return warnings, notes, checked
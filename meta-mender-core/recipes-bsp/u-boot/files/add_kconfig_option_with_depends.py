@@ -1,59 +1,139 @@
 #/usr/bin/python3
 
-# Convenience script to add a Kconfig option, and at the same time add the
-# "depends on" entries for that option. This is hard to do in shell.
+# Convenience script to add Kconfig options, and at the same time add the
+# "depends on" entries for those options. This is hard to do in shell.
+#
+# All the Kconfig files in the source tree are read once, into an index of each
+# config symbol and the symbols it depends on. If --index-file is given, and
+# the source tree is a git checkout without local changes to the Kconfig files,
+# the index is saved there, together with the revision of the tree, and reused
+# by later invocations on the same revision.
 
 import argparse
+import json
 import os
 import re
+import subprocess
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--src-dir", required=True,
                     help="Directory containing sources.")
 parser.add_argument("--defconfig-file", required=True,
                     help="The file containing defconfig entries.")
-parser.add_argument("option", metavar="OPTION", nargs=1,
+parser.add_argument("--index-file",
+                    help="Where to keep the index of Kconfig symbols between invocations.")
+parser.add_argument("option", metavar="OPTION", nargs="+",
                     help="Option to add to Kconfig, expressed as KEY=VALUE.")
 args = parser.parse_args()
 
-def add_kconfig_option(option):
-    key, value = option.split("=", 1)
+INDEX_FORMAT = 1
 
+CONFIG_RE = re.compile(r"^config\s*(\S+)(\s|$)")
+CONFIG_START_RE = re.compile(r"^config ")
+DEPENDS_RE = re.compile(r"^\s*depends *on *(\S+)")
+
+def source_revision(src_dir):
+    # The revision of the source tree, or None if it cannot be trusted to
+    # describe the Kconfig files, because it isn't a git checkout or because
+    # the Kconfig files have been modified.
+    try:
+        with open(os.devnull, "w") as null:
+            revision = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                               cwd=src_dir, stderr=null)
+            status = subprocess.check_output(["git", "status", "--porcelain",
+                                              "--", "Kconfig", "*/Kconfig"],
+                                             cwd=src_dir, stderr=null)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    if status.strip():
+        return None
+    return revision.decode().strip()
+
+def build_index(src_dir):
+    # Returns a dictionary of Kconfig symbol -> list of symbols it depends on.
+    # Negative dependencies are left out, we're not handling them right now.
+    index = {}
+    for dirpath, dirnames, filenames in os.walk(src_dir):
+        if "Kconfig" not in filenames:
+            continue
+        with open(os.path.join(dirpath, "Kconfig")) as fd:
+            depends = None
+            for line in fd:
+                match = CONFIG_RE.match(line)
+                if match:
+                    depends = index.setdefault(match.group(1), [])
+                    continue
+                elif CONFIG_START_RE.match(line):
+                    depends = None
+                    continue
+
+                if depends is None:
+                    continue
+
+                match = DEPENDS_RE.match(line)
+                if not match:
+                    continue
+                dependee = match.group(1)
+                if dependee.startswith("!"):
+                    continue
+                depends.append(dependee)
+    return index
+
+def load_index(src_dir, index_file):
+    revision = None
+    if index_file:
+        revision = source_revision(src_dir)
+    if revision is not None and os.path.exists(index_file):
+        try:
+            with open(index_file) as fd:
+                stored = json.load(fd)
+            if stored.get("format") == INDEX_FORMAT and stored.get("revision") == revision:
+                return stored["symbols"]
+        except (ValueError, KeyError):
+            # Broken index, just build it again.
+            pass
+
+    index = build_index(src_dir)
+
+    if revision is not None:
+        tmp_file = "%s.%d" % (index_file, os.getpid())
+        with open(tmp_file, "w") as fd:
+            json.dump({"format": INDEX_FORMAT, "revision": revision, "symbols": index}, fd)
+        os.rename(tmp_file, index_file)
+
+    return index
+
+def add_kconfig_options(options):
     with open(args.defconfig_file) as fd:
-        if any([line.startswith("%s=" % key) for line in fd.readlines()]):
-            # Already added, skip.
+        present = set([line.split("=", 1)[0] for line in fd if "=" in line])
+
+    index = load_index(args.src_dir, args.index_file)
+
+    to_add = []
+    visiting = set()
+
+    def add_kconfig_option(option):
+        key, value = option.split("=", 1)
+
+        if key in present or key in visiting:
+            # Already added, or being added, skip.
             return
+        visiting.add(key)
+
+        if not key.startswith("CONFIG_"):
+            raise Exception("Not sure how to handle Kconfig option that doesn't start with 'CONFIG_'")
+        for dependee in index.get(key[len("CONFIG_"):], []):
+            add_kconfig_option("CONFIG_%s=y" % dependee)
+
+        present.add(key)
+        to_add.append(option)
+
+    for option in options:
+        add_kconfig_option(option)
+
+    if to_add:
+        with open(args.defconfig_file, "a") as fd:
+            for option in to_add:
+                fd.write("%s\n" % option)
 
-    for dirpath, dirnames, filenames in os.walk(args.src_dir):
-        for filename in filenames:
-            if filename != "Kconfig":
-                continue
-            with open(os.path.join(dirpath, filename)) as fd:
-                if not key.startswith("CONFIG_"):
-                    raise Exception("Not sure how to handle Kconfig option that doesn't start with 'CONFIG_'")
-                kconfig_key = key[len("CONFIG_"):]
-                inside_option = False
-                for line in fd.readlines():
-                    if re.match("^config\s*%s(\s|$)" % kconfig_key, line):
-                        inside_option = True
-                        continue
-                    elif re.match("^config ", line):
-                        inside_option = False
-                        continue
-
-                    if not inside_option:
-                        continue
-
-                    match = re.match("^\s*depends *on *(\S+)", line)
-                    if not match:
-                        continue
-                    dependee = match.group(1)
-                    if dependee.startswith("!"):
-                        # We're not handling negative dependencies right now.
-                        continue
-                    add_kconfig_option("CONFIG_%s=y" % dependee)
-
-    with open(args.defconfig_file, "a") as fd:
-        fd.write("%s\n" % option)
-
-add_kconfig_option(args.option[0])
+add_kconfig_options(args.option)
@@ -12,6 +12,18 @@ MAYBE_UBI=
 DEBUG=0
 SCRIPT_DIR="$(readlink -f "$(dirname "$0")")"
 
+link_tree() {
+    # Makes a copy of the source tree in $2 which shares all files with $1
+    # using hard links, except the ones in configs and include, which are
+    # modified in place while probing. Falls back to a full copy if hard links
+    # are not possible.
+    cp -al "$1" "$2" 2>/dev/null || { rm -rf "$2"; cp -r "$1" "$2"; }
+    for dir in configs include; do
+        rm -rf "$2/$dir"
+        cp -r "$1/$dir" "$2/$dir"
+    done
+}
+
 usage() {
     cat <<EOF
 $(basename "$0")
@@ -29,6 +41,10 @@ Script to produce a patch for U-Boot so it will work with Mender.
 	is the resulting patch)
 --tmp-dir=<temp dir>"
 	Temporary directory to use while working
+--kconfig-index=<index file>
+	Where to keep the index of Kconfig symbols, so that it can be reused as
+	long as the U-Boot source revision stays the same. Defaults to
+	"kconfig-index.json" next to the temporary directory.
 --ubi
 	Enable auto-configuration for Flash/UBI setup
 --debug
@@ -53,6 +69,9 @@ while [ -n "$1" ]; do
         --tmp-dir=*)
             TMP_DIR="$(readlink -f "${1#--tmp-dir=}")"
             ;;
+        --kconfig-index=*)
+            KCONFIG_INDEX="$(readlink -f "${1#--kconfig-index=}")"
+            ;;
         --ubi)
             MAYBE_UBI="$MAYBE_UBI --ubi"
             ;;
@@ -82,9 +101,13 @@ fi
 
 set -u
 
+# The index is kept outside of the temporary directory, so that it survives
+# reruns.
+KCONFIG_INDEX="${KCONFIG_INDEX:-$(dirname "$TMP_DIR")/kconfig-index.json}"
+
 rm -rf "$TMP_DIR"
 mkdir -p "$(dirname "$TMP_DIR")"
-cp -r "$SRC_DIR" "$TMP_DIR"
+link_tree "$SRC_DIR" "$TMP_DIR"
 cd "$TMP_DIR"
 
 # Prepare build.
@@ -144,6 +167,7 @@ env HOSTCC="$BUILD_CC -DMENDER_AUTO_PROBING" CC="$CC -DMENDER_AUTO_PROBING" \
         --compiled-env="$TMP_DIR/compiled-environment.txt" \
         --config="$CONFIG" \
         --kconfig-fragment="$KCONFIG_FRAGMENT" \
+        --kconfig-index="$KCONFIG_INDEX" \
         $MAYBE_UBI
 
 set +x
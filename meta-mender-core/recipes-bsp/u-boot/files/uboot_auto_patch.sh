@@ -1,6 +1,7 @@
 #!/bin/bash
 
 UBI=0
+KCONFIG_INDEX=
 
 SCRIPT_DIR="$(readlink -f "$(dirname "$0")")"
 
@@ -73,7 +74,7 @@ add_definition() {
 
     if is_kconfig_option "$1"; then
         # In the Kconfig case it's easy, just add it to the defconfig file.
-        python3 $SCRIPT_DIR/add_kconfig_option_with_depends.py --src-dir=. --defconfig-file=configs/$CONFIG "$kconfig_repl"
+        python3 $SCRIPT_DIR/add_kconfig_option_with_depends.py --src-dir=. --defconfig-file=configs/$CONFIG ${KCONFIG_INDEX:+--index-file="$KCONFIG_INDEX"} "$kconfig_repl"
     else
         # In the pre-Kconfig case, it's more open. We need to add it somewhere
         # in the source, but it's not obvious where. Add it to
@@ -143,7 +144,7 @@ is_kconfig_option() {
     fi
 
     cp $BUILD_DIR/configs/$CONFIG $BUILD_DIR/configs/$CONFIG.backup
-    python3 $SCRIPT_DIR/add_kconfig_option_with_depends.py --src-dir=$BUILD_DIR --defconfig-file=$BUILD_DIR/configs/$CONFIG "$kconfig_repl"
+    python3 $SCRIPT_DIR/add_kconfig_option_with_depends.py --src-dir=$BUILD_DIR --defconfig-file=$BUILD_DIR/configs/$CONFIG ${KCONFIG_INDEX:+--index-file="$KCONFIG_INDEX"} "$kconfig_repl"
 
     # Update .config
     make HOSTCC="$HOSTCC" CC="$CC" -C $BUILD_DIR $CONFIG
@@ -427,6 +428,9 @@ while [ -n "$1" ]; do
         --dep-file=*)
             DEP_FILE=${1#--dep-file=}
             ;;
+        --kconfig-index=*)
+            KCONFIG_INDEX=${1#--kconfig-index=}
+            ;;
         --kconfig-fragment=*)
             # Read in all the definitions from that file into variables.
             # Use only line separator as delimiter.
@@ -0,0 +1,33 @@
+# Copyright 2019 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Conversions between the native str type and the bytes stored in images, for
+# the image readers, which work under both Python 2 and Python 3. Under Python
+# 2, str is bytes, so both are no-ops for str values.
+#
+# The default error handler, surrogateescape, lets names which are not valid
+# UTF-8 survive the round trip through to_str() and to_bytes(). Pass
+# errors="strict" where such values should be rejected instead.
+
+
+def to_bytes(value, errors="surrogateescape"):
+    if isinstance(value, bytes):
+        return value
+    return value.encode("utf-8", errors)
+
+
+def to_str(value, errors="surrogateescape"):
+    if str is bytes:
+        return value
+    return value.decode("utf-8", errors)
@@ -127,18 +127,25 @@ def start_qemu_flash(latest_vexpress_nor):
 
     print("qemu raw flash with image {}".format(latest_vexpress_nor))
 
-    # make a temp file, make sure that it has .vexpress-nor suffix, so that
-    # mender-qemu will know how to handle it
-    fh, img_path = tempfile.mkstemp(suffix=".vexpress-nor", prefix="test-image")
-    # don't need an open fd to temp file
-    os.close(fh)
-
     # vexpress-nor is more complex than sdimg, inside it's compose of 2 raw
     # files that represent 2 separate flash banks (and each file is a 'drive'
-    # passed to qemu). Because of this, we cannot directly apply qemu-img and
-    # create a qcow2 image with backing file. Instead make a disposable copy of
-    # flash image file.
-    shutil.copyfile(latest_vexpress_nor, img_path)
+    # passed to qemu). The banks are also deployed next to the image, and
+    # mender-qemu puts qcow2 overlays on top of those, so all we need is a
+    # disposable directory which points at them. The image name must have
+    # .vexpress-nor suffix, so that mender-qemu will know how to handle it.
+    img_dir = tempfile.mkdtemp(prefix="test-image")
+    img_path = os.path.join(img_dir, "test-image.vexpress-nor")
+
+    if os.path.exists(latest_vexpress_nor + ".nor0") and \
+       os.path.exists(latest_vexpress_nor + ".nor1"):
+        os.symlink(os.path.realpath(latest_vexpress_nor), img_path)
+        for bank in ["nor0", "nor1"]:
+            os.symlink(os.path.realpath(latest_vexpress_nor + "." + bank),
+                       img_path + "." + bank)
+    else:
+        # Older build without the bank files, make a disposable copy of flash
+        # image file.
+        shutil.copyfile(latest_vexpress_nor, img_path)
 
     qenv = {}
     # pass QEMU drive directly
@@ -148,10 +155,10 @@ def start_qemu_flash(latest_vexpress_nor):
     try:
         qemu = start_qemu(qenv)
     except:
-        os.remove(img_path)
+        shutil.rmtree(img_dir)
         raise
 
-    return qemu, img_path
+    return qemu, img_dir
 
 
 def reboot(wait = 120):
@@ -0,0 +1,222 @@
+#!/usr/bin/python
+# Copyright 2019 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Partitioned disk images, such as sdimg, uefiimg, biosimg and gptimg.
+#
+# The partition table, MBR (including logical partitions) or GPT, is read
+# directly from the image, and each partition is available as a
+# PartitionView: a file-like window on the byte range of the partition in the
+# memory mapped image. Nothing is copied out of the image until it is read.
+# Images are opened read-only, unless they are opened writable, which allows
+# changing bytes in place, but not resizing anything.
+
+import mmap
+import struct
+import uuid
+
+SECTOR_SIZE = 512
+
+MBR_EXTENDED_TYPES = [0x05, 0x0f, 0x85]
+MBR_GPT_PROTECTIVE_TYPE = 0xee
+
+_MBR_ENTRY = struct.Struct("<B3xB3xII")
+_GPT_HEADER = struct.Struct("<8s4xI8x8x8x8x8x16sQII")
+_GPT_ENTRY = struct.Struct("<16s16sQQQ72s")
+
+
+class DiskImageError(Exception):
+    pass
+
+
+class Partition(object):
+    """A partition in a partition table. start and size are in bytes. type is
+    the MBR partition type as an integer, or the GPT partition type GUID as a
+    string. name is the GPT partition name, or None."""
+
+    def __init__(self, number, start, size, type, name=None):
+        self.number = number
+        self.start = start
+        self.size = size
+        self.type = type
+        self.name = name
+
+
+class PartitionView(object):
+    """A file-like view of size bytes at offset in a memory map. Slicing a
+    view returns those bytes of it, and len() its size. If the memory map is
+    writable, assigning to a slice of the same length changes the image."""
+
+    def __init__(self, mmap, offset, size):
+        if offset < 0 or offset + size > len(mmap):
+            raise DiskImageError("Range %d-%d is outside of the image" % (offset, offset + size))
+        self.mmap = mmap
+        self.offset = offset
+        self.size = size
+        self._pos = 0
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.size)
+            if step != 1:
+                raise ValueError("PartitionView slices must be contiguous")
+            return self.mmap[self.offset + start:self.offset + max(start, stop)]
+        if key < 0:
+            key += self.size
+        if key < 0 or key >= self.size:
+            raise IndexError("PartitionView index out of range")
+        return self.mmap[self.offset + key:self.offset + key + 1]
+
+    def __setitem__(self, key, data):
+        if not isinstance(key, slice):
+            raise TypeError("PartitionView only supports assigning to slices")
+        start, stop, step = key.indices(self.size)
+        if step != 1 or stop - start != len(data):
+            raise ValueError("PartitionView slice assignment can't change the size")
+        self.mmap[self.offset + start:self.offset + stop] = data
+
+    def buffer(self):
+        """Returns the bytes of the view as a buffer, without copying."""
+
+        try:
+            return memoryview(self.mmap)[self.offset:self.offset + self.size]
+        except TypeError:
+            # Python 2, where mmap has no memoryview support.
+            return buffer(self.mmap, self.offset, self.size)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self._pos
+        data = self[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("Negative seek position %d" % offset)
+        self._pos = offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def chunks(self, chunk_size=1048576):
+        """Yields the contents of the view in pieces of chunk_size."""
+
+        for start in range(0, self.size, chunk_size):
+            yield self[start:start + chunk_size]
+
+
+def map_file(fd, writable=False):
+    """Returns a memory map of all of the open file fd."""
+
+    return mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+
+
+class DiskImage(object):
+    """A disk image. partitions is the list of partitions, in the order of
+    their numbers. With writable, the views of the partitions can be changed
+    in place."""
+
+    def __init__(self, path, writable=False):
+        self.path = path
+        self._fd = open(path, "r+b" if writable else "rb")
+        self.mmap = None
+        try:
+            self.mmap = map_file(self._fd, writable)
+            self.partitions = self._read_partition_table()
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self.mmap is not None:
+            # Flushing a read-only mapping is a no-op.
+            self.mmap.flush()
+            self.mmap.close()
+            self.mmap = None
+        self._fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _mbr_entries(self, sector):
+        offset = sector * SECTOR_SIZE
+        if self.mmap[offset + 510:offset + 512] != b"\x55\xaa":
+            raise DiskImageError("%s: No partition table at sector %d" % (self.path, sector))
+        return [_MBR_ENTRY.unpack_from(self.mmap, offset + 446 + i * 16) for i in range(4)]
+
+    def _read_partition_table(self):
+        entries = self._mbr_entries(0)
+        if any([type == MBR_GPT_PROTECTIVE_TYPE for status, type, start, sectors in entries]):
+            return self._read_gpt()
+
+        partitions = []
+        extended = None
+        for i, (status, type, start, sectors) in enumerate(entries):
+            if type == 0:
+                continue
+            if type in MBR_EXTENDED_TYPES:
+                extended = start
+            partitions.append(Partition(i + 1, start * SECTOR_SIZE, sectors * SECTOR_SIZE, type))
+
+        # Logical partitions are a chain of EBRs in the extended partition.
+        # The first entry of each is the partition, relative to the EBR, and
+        # the second the next EBR, relative to the extended partition.
+        number = 5
+        ebr = extended
+        seen = set()
+        while ebr is not None and ebr not in seen:
+            seen.add(ebr)
+            logical, link = self._mbr_entries(ebr)[:2]
+            if logical[1] != 0:
+                partitions.append(Partition(number, (ebr + logical[2]) * SECTOR_SIZE,
+                                            logical[3] * SECTOR_SIZE, logical[1]))
+                number += 1
+            ebr = extended + link[2] if link[1] != 0 else None
+        return partitions
+
+    def _read_gpt(self):
+        signature, header_size, disk_guid, entries_lba, count, entry_size \
+            = _GPT_HEADER.unpack_from(self.mmap, SECTOR_SIZE)
+        if signature != b"EFI PART":
+            raise DiskImageError("%s: Protective MBR, but no GPT header" % self.path)
+        partitions = []
+        for i in range(count):
+            type_guid, part_guid, first, last, attributes, name \
+                = _GPT_ENTRY.unpack_from(self.mmap, entries_lba * SECTOR_SIZE + i * entry_size)
+            if type_guid == b"\0" * 16:
+                continue
+            name = name.decode("utf-16-le").split(u"\0")[0]
+            partitions.append(Partition(i + 1, first * SECTOR_SIZE, (last - first + 1) * SECTOR_SIZE,
+                                        str(uuid.UUID(bytes_le=type_guid)), name))
+        return partitions
+
+    def partition(self, number):
+        """Returns a PartitionView of partition number number."""
+
+        for part in self.partitions:
+            if part.number == number:
+                return PartitionView(self.mmap, part.start, part.size)
+        raise DiskImageError("%s: No partition %d" % (self.path, number))
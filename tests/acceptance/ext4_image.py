@@ -0,0 +1,486 @@
+#!/usr/bin/python
+# Copyright 2019 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Read-only reader for ext2, ext3 and ext4 images, used instead of running
+# "debugfs -R ..." once per query.
+#
+# The image is mapped into memory once, and paths are resolved by reading only
+# the inodes and directory blocks on the way. Directories with an htree index
+# are searched by hash, and file contents are located through extents, or the
+# block maps of ext2 and ext3.
+
+import mmap
+import struct
+
+from bytestr import to_bytes, to_str
+
+EXT4_SUPER_MAGIC = 0xef53
+EXT4_ROOT_INO = 2
+EXT4_EXTENT_MAGIC = 0xf30a
+
+EXT4_INDEX_FL = 0x1000
+EXT4_EXTENTS_FL = 0x80000
+EXT4_INLINE_DATA_FL = 0x10000000
+
+EXT4_FEATURE_INCOMPAT_FILETYPE = 0x2
+EXT4_FEATURE_INCOMPAT_META_BG = 0x10
+EXT4_FEATURE_INCOMPAT_64BIT = 0x80
+
+EXT2_FLAGS_UNSIGNED_HASH = 0x2
+
+DX_HASH_LEGACY = 0
+DX_HASH_HALF_MD4 = 1
+DX_HASH_TEA = 2
+DX_HASH_LEGACY_UNSIGNED = 3
+DX_HASH_HALF_MD4_UNSIGNED = 4
+DX_HASH_TEA_UNSIGNED = 5
+
+MAX_SYMLINKS = 40
+
+_MASK = 0xffffffff
+
+_SUPERBLOCK_OFFSET = 1024
+_INODE = struct.Struct("<HHIIIIIHHII")
+_EXTENT_HEADER = struct.Struct("<HHHHI")
+_EXTENT = struct.Struct("<IHHI")
+_EXTENT_INDEX = struct.Struct("<IIH2x")
+_DIRENT = struct.Struct("<IHBB")
+_DX_ROOT_INFO = struct.Struct("<IBBBB")
+_DX_COUNTLIMIT = struct.Struct("<HHI")
+_DX_ENTRY = struct.Struct("<II")
+
+
+class Ext4Error(Exception):
+    pass
+
+
+def _rol32(value, shift):
+    return ((value << shift) | (value >> (32 - shift))) & _MASK
+
+
+def _str2hashbuf(name, num, signed):
+    # Packs up to num * 4 bytes of name into num words, as the kernel's
+    # str2hashbuf_signed() and str2hashbuf_unsigned().
+    length = len(name)
+    pad = length | (length << 8)
+    pad = (pad | (pad << 16)) & _MASK
+    val = pad
+    buf = []
+    for i, byte in enumerate(bytearray(name[:num * 4])):
+        if signed and byte >= 0x80:
+            byte -= 0x100
+        val = (byte + (val << 8)) & _MASK
+        if i % 4 == 3:
+            buf.append(val)
+            val = pad
+    if len(buf) < num:
+        buf.append(val)
+    while len(buf) < num:
+        buf.append(pad)
+    return buf
+
+
+def _half_md4_transform(buf, data):
+    def f(x, y, z):
+        return z ^ (x & (y ^ z))
+
+    def g(x, y, z):
+        return ((x & y) + ((x ^ y) & z)) & _MASK
+
+    def h(x, y, z):
+        return x ^ y ^ z
+
+    k2 = 0o13240474631
+    k3 = 0o15666365641
+    a, b, c, d = buf
+
+    for fn, k, order, shifts in [(f, 0, [0, 1, 2, 3, 4, 5, 6, 7], [3, 7, 11, 19]),
+                                 (g, k2, [1, 3, 5, 7, 0, 2, 4, 6], [3, 5, 9, 13]),
+                                 (h, k3, [3, 7, 2, 6, 1, 5, 0, 4], [3, 9, 11, 15])]:
+        for i, index in enumerate(order):
+            x = (data[index] + k) & _MASK
+            shift = shifts[i % 4]
+            if i % 4 == 0:
+                a = _rol32((a + fn(b, c, d) + x) & _MASK, shift)
+            elif i % 4 == 1:
+                d = _rol32((d + fn(a, b, c) + x) & _MASK, shift)
+            elif i % 4 == 2:
+                c = _rol32((c + fn(d, a, b) + x) & _MASK, shift)
+            else:
+                b = _rol32((b + fn(c, d, a) + x) & _MASK, shift)
+
+    return [(buf[0] + a) & _MASK, (buf[1] + b) & _MASK,
+            (buf[2] + c) & _MASK, (buf[3] + d) & _MASK]
+
+
+def _tea_transform(buf, data):
+    total = 0
+    b0, b1 = buf[0], buf[1]
+    a, b, c, d = data
+    for i in range(16):
+        total = (total + 0x9e3779b9) & _MASK
+        b0 = (b0 + ((((b1 << 4) + a) & _MASK) ^ ((b1 + total) & _MASK) ^ ((b1 >> 5) + b))) & _MASK
+        b1 = (b1 + ((((b0 << 4) + c) & _MASK) ^ ((b0 + total) & _MASK) ^ ((b0 >> 5) + d))) & _MASK
+    return [(buf[0] + b0) & _MASK, (buf[1] + b1) & _MASK, buf[2], buf[3]]
+
+
+def _legacy_hash(name, signed):
+    hash0, hash1 = 0x12a3fe2d, 0x37abe8f9
+    for byte in bytearray(name):
+        if signed and byte >= 0x80:
+            byte -= 0x100
+        value = (hash1 + (hash0 ^ ((byte * 7152373) & _MASK))) & _MASK
+        if value & 0x80000000:
+            value = (value - 0x7fffffff) & _MASK
+        hash1, hash0 = hash0, value
+    return (hash0 << 1) & _MASK
+
+
+def dirhash(name, version, seed):
+    """Returns the major htree hash of name, as ext4fs_dirhash()."""
+
+    signed = version < DX_HASH_LEGACY_UNSIGNED
+    version %= 3
+    if version == DX_HASH_LEGACY:
+        value = _legacy_hash(name, signed)
+    else:
+        buf = list(seed) if any(seed) else [0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476]
+        chunk = 32 if version == DX_HASH_HALF_MD4 else 16
+        for start in range(0, len(name), chunk):
+            if version == DX_HASH_HALF_MD4:
+                buf = _half_md4_transform(buf, _str2hashbuf(name[start:], 8, signed))
+            else:
+                buf = _tea_transform(buf, _str2hashbuf(name[start:], 4, signed))
+        value = buf[1] if version == DX_HASH_HALF_MD4 else buf[0]
+    value &= ~1 & _MASK
+    if value == 0x7fffffff << 1:
+        value = (0x7fffffff - 1) << 1
+    return value
+
+
+class Ext4Inode(object):
+    """An inode. mode is the full st_mode, and target the target of a
+    symbolic link."""
+
+    def __init__(self, image, number, offset):
+        fields = _INODE.unpack_from(image.mmap, offset)
+        self.image = image
+        self.number = number
+        self.mode = fields[0]
+        self.uid = fields[1] | (struct.unpack_from("<H", image.mmap, offset + 0x78)[0] << 16)
+        self.size = fields[2] | (struct.unpack_from("<I", image.mmap, offset + 0x6c)[0] << 32)
+        self.gid = fields[7] | (struct.unpack_from("<H", image.mmap, offset + 0x7a)[0] << 16)
+        self.links = fields[8]
+        self.flags = fields[10]
+        self.i_block = image.mmap[offset + 0x28:offset + 0x28 + 60]
+
+    def is_dir(self):
+        return (self.mode & 0o170000) == 0o040000
+
+    def is_file(self):
+        return (self.mode & 0o170000) == 0o100000
+
+    def is_link(self):
+        return (self.mode & 0o170000) == 0o120000
+
+    @property
+    def target(self):
+        if not self.is_link():
+            return None
+        if self.size < 60 and not self.flags & EXT4_EXTENTS_FL:
+            # Fast symlink, stored in the block pointers.
+            return self.i_block[:self.size]
+        return self.image._read_inode(self)
+
+
+class Ext4Image(object):
+    """An ext2, ext3 or ext4 file system image. offset is where the file
+    system starts in the file, for images inside partitioned disk images."""
+
+    def __init__(self, path, offset=0):
+        self.path = path
+        self.offset = offset
+        self._fd = open(path, "rb")
+        self.mmap = None
+        try:
+            self.mmap = mmap.mmap(self._fd.fileno(), 0, access=mmap.ACCESS_READ)
+            self._superblock()
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        self._fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _u16(self, offset):
+        return struct.unpack_from("<H", self.mmap, offset)[0]
+
+    def _u32(self, offset):
+        return struct.unpack_from("<I", self.mmap, offset)[0]
+
+    def _superblock(self):
+        sb = self.offset + _SUPERBLOCK_OFFSET
+        if sb + 1024 > len(self.mmap) or self._u16(sb + 0x38) != EXT4_SUPER_MAGIC:
+            raise Ext4Error("%s: Not an ext2/3/4 file system" % self.path)
+        self.block_size = 1024 << self._u32(sb + 0x18)
+        self.first_data_block = self._u32(sb + 0x14)
+        self.inodes_per_group = self._u32(sb + 0x28)
+        rev_level = self._u32(sb + 0x4c)
+        self.inode_size = self._u16(sb + 0x58) if rev_level > 0 else 128
+        self.feature_incompat = self._u32(sb + 0x60)
+        if self.feature_incompat & EXT4_FEATURE_INCOMPAT_META_BG:
+            raise Ext4Error("%s: meta_bg is not supported" % self.path)
+        if self.feature_incompat & EXT4_FEATURE_INCOMPAT_64BIT:
+            self.desc_size = self._u16(sb + 0xfe)
+        else:
+            self.desc_size = 32
+        self.hash_seed = struct.unpack_from("<IIII", self.mmap, sb + 0xec)
+        self.unsigned_hash = bool(self._u32(sb + 0x160) & EXT2_FLAGS_UNSIGNED_HASH)
+        self.label = self.mmap[sb + 0x78:sb + 0x88].rstrip(b"\0").decode("utf-8")
+
+    def _block(self, number, offset=0, length=None):
+        if length is None:
+            length = self.block_size - offset
+        start = self.offset + number * self.block_size + offset
+        return self.mmap[start:start + length]
+
+    def inode(self, number):
+        group, index = divmod(number - 1, self.inodes_per_group)
+        desc = (self.offset + (self.first_data_block + 1) * self.block_size
+                + group * self.desc_size)
+        table = self._u32(desc + 0x8)
+        if self.desc_size >= 64:
+            table |= self._u32(desc + 0x28) << 32
+        return Ext4Inode(self, number,
+                         self.offset + table * self.block_size + index * self.inode_size)
+
+    def _extents(self, node):
+        # Yields (logical block, physical block, length) of the extent tree
+        # starting at node. Uninitialized extents have a physical block of
+        # None, since they read as zeros.
+        magic, entries, max_entries, depth, generation = _EXTENT_HEADER.unpack_from(node)
+        if magic != EXT4_EXTENT_MAGIC:
+            raise Ext4Error("%s: Bad extent header" % self.path)
+        for i in range(entries):
+            offset = _EXTENT_HEADER.size + i * 12
+            if depth == 0:
+                logical, length, start_hi, start_lo = _EXTENT.unpack_from(node, offset)
+                if length > 32768:
+                    yield logical, None, length - 32768
+                else:
+                    yield logical, (start_hi << 32) | start_lo, length
+            else:
+                logical, leaf_lo, leaf_hi = _EXTENT_INDEX.unpack_from(node, offset)
+                for extent in self._extents(self._block((leaf_hi << 32) | leaf_lo)):
+                    yield extent
+
+    def _indirect(self, block, level, logical, count):
+        # Yields (logical block, physical block, 1) for a block map, starting
+        # at the indirect block block of the given level.
+        per_block = self.block_size // 4
+        span = per_block ** level
+        pointers = struct.unpack_from("<%dI" % per_block, self._block(block))
+        for i, pointer in enumerate(pointers):
+            if logical + i * span >= count:
+                return
+            if pointer == 0:
+                continue
+            if level == 0:
+                yield logical + i, pointer, 1
+            else:
+                for mapping in self._indirect(pointer, level - 1, logical + i * span, count):
+                    yield mapping
+
+    def _block_map(self, inode):
+        count = (inode.size + self.block_size - 1) // self.block_size
+        pointers = struct.unpack("<15I", inode.i_block)
+        for i in range(12):
+            if i < count and pointers[i]:
+                yield i, pointers[i], 1
+        logical = 12
+        per_block = self.block_size // 4
+        for level in range(3):
+            if logical >= count:
+                return
+            if pointers[12 + level]:
+                for mapping in self._indirect(pointers[12 + level], level, logical, count):
+                    yield mapping
+            logical += per_block ** (level + 1)
+
+    def _mappings(self, inode):
+        if inode.flags & EXT4_INLINE_DATA_FL:
+            raise Ext4Error("%s: Inline data is not supported" % self.path)
+        if inode.flags & EXT4_EXTENTS_FL:
+            return self._extents(inode.i_block)
+        return self._block_map(inode)
+
+    def _map_block(self, inode, logical):
+        # Returns the physical block holding logical block logical of inode,
+        # or None for a hole.
+        for start, physical, length in self._mappings(inode):
+            if start <= logical < start + length:
+                return None if physical is None else physical + logical - start
+        return None
+
+    def _read_inode(self, inode):
+        if inode.flags & EXT4_INLINE_DATA_FL and inode.size <= 60:
+            return inode.i_block[:inode.size]
+        data = bytearray(inode.size)
+        for logical, physical, length in self._mappings(inode):
+            start = logical * self.block_size
+            if physical is None or start >= inode.size:
+                continue
+            end = min(start + length * self.block_size, inode.size)
+            data[start:end] = self._block(physical, 0, end - start)
+        return bytes(data)
+
+    def _dirents(self, block):
+        # Yields (name, inode number) of the entries in a directory block.
+        offset = 0
+        while offset + _DIRENT.size <= self.block_size:
+            number, rec_len, name_len, file_type = _DIRENT.unpack_from(block, offset)
+            if rec_len < _DIRENT.size:
+                break
+            if number != 0:
+                if not self.feature_incompat & EXT4_FEATURE_INCOMPAT_FILETYPE:
+                    name_len |= file_type << 8
+                yield block[offset + 8:offset + 8 + name_len], number
+            offset += rec_len
+
+    def _dir_blocks(self, inode):
+        for logical, physical, length in self._mappings(inode):
+            if physical is None:
+                continue
+            for i in range(length):
+                yield self._block(physical + i)
+
+    def _htree_lookup(self, inode, name):
+        # Returns the inode number of name in the htree directory inode, or
+        # None if it is not there.
+        root = self._block(self._map_block(inode, 0))
+        reserved, version, info_length, levels, flags = _DX_ROOT_INFO.unpack_from(root, 24)
+        if version <= DX_HASH_TEA and self.unsigned_hash:
+            version += 3
+        target = dirhash(name, version, self.hash_seed)
+
+        node = root
+        offset = 24 + info_length
+        for level in range(levels + 1):
+            limit, count, block0 = _DX_COUNTLIMIT.unpack_from(node, offset)
+            entries = [(0, block0)] + [_DX_ENTRY.unpack_from(node, offset + i * 8)
+                                       for i in range(1, count)]
+            index = 0
+            for i in range(1, count):
+                if entries[i][0] > target:
+                    break
+                index = i
+            if level < levels:
+                node = self._block(self._map_block(inode, entries[index][1]))
+                # Index nodes start with an empty directory entry.
+                offset = 8
+                continue
+
+            # Names with the same hash may continue in the following leaf
+            # blocks, marked by the lowest bit of their hash.
+            while True:
+                block = self._block(self._map_block(inode, entries[index][1]))
+                for entry_name, number in self._dirents(block):
+                    if entry_name == name:
+                        return number
+                index += 1
+                if index >= count or (entries[index][0] & ~1) != target:
+                    return None
+
+    def _find(self, inode, name):
+        if inode.flags & EXT4_INDEX_FL:
+            return self._htree_lookup(inode, name)
+        for block in self._dir_blocks(inode):
+            for entry_name, number in self._dirents(block):
+                if entry_name == name:
+                    return number
+        return None
+
+    def _resolve(self, path, follow, depth=0):
+        if depth > MAX_SYMLINKS:
+            raise Ext4Error("Too many levels of symbolic links: %s" % path)
+        components = [c for c in to_bytes(path).split(b"/") if c and c != b"."]
+        inode = self.inode(EXT4_ROOT_INO)
+        # ".." is resolved here, since in htree directories it is only in the
+        # index root block, which _htree_lookup() does not search.
+        parents = []
+        for i, component in enumerate(components):
+            if component == b"..":
+                if parents:
+                    inode = parents.pop()
+                continue
+            if not inode.is_dir():
+                return None
+            number = self._find(inode, component)
+            if number is None:
+                return None
+            child = self.inode(number)
+            if child.is_link() and (follow or i + 1 < len(components)):
+                target = child.target
+                if not target.startswith(b"/"):
+                    target = b"/" + b"/".join(components[:i]) + b"/" + target
+                rest = b"/".join(components[i + 1:])
+                return self._resolve(target + b"/" + rest if rest else target,
+                                     follow, depth + 1)
+            parents.append(inode)
+            inode = child
+        return inode
+
+    def lookup(self, path, follow=True):
+        """Returns the Ext4Inode at path, or None if it doesn't exist.
+        Symbolic links are followed, except for the last component if follow
+        is False."""
+
+        return self._resolve(path, follow)
+
+    def exists(self, path):
+        return self.lookup(path) is not None
+
+    def listdir(self, path):
+        """Returns the sorted names in the directory at path, without "." and
+        ".."."""
+
+        inode = self.lookup(path)
+        if inode is None or not inode.is_dir():
+            raise Ext4Error("Not a directory: %s" % path)
+        names = []
+        for block in self._dir_blocks(inode):
+            for name, number in self._dirents(block):
+                if name not in (b".", b".."):
+                    names.append(to_str(name))
+        return sorted(names)
+
+    def read(self, path):
+        """Returns the contents of the file at path."""
+
+        inode = self.lookup(path)
+        if inode is None:
+            raise Ext4Error("No such file: %s" % path)
+        if inode.is_dir():
+            raise Ext4Error("Is a directory: %s" % path)
+        return self._read_inode(inode)
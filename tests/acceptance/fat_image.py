@@ -0,0 +1,366 @@
+#!/usr/bin/python
+# Copyright 2019 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Reader for FAT12, FAT16 and FAT32 file systems, used instead of mtools for
+# the boot partition.
+#
+# The file system is read through a PartitionView from disk_image.py, or from
+# a memory mapped bootimg, so nothing is copied out of the image except the
+# directories and files that are looked at. Long file names (VFAT) are
+# supported, and names are matched case insensitively, like FAT does. If the
+# view is writable, the contents of existing files can be replaced with new
+# contents of the same size, which is enough for fixed size files like GRUB
+# environment blocks. Nothing else is ever changed.
+
+import struct
+
+from bytestr import to_bytes, to_str
+from disk_image import PartitionView, map_file
+
+ATTR_VOLUME_ID = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_LONG_NAME = 0x0f
+
+# Flags in the reserved byte of short entries, set by Windows and Linux for
+# names which are all lower case in the base name or extension.
+NT_LOWERCASE_BASE = 0x08
+NT_LOWERCASE_EXT = 0x10
+
+_BOOT_SECTOR = struct.Struct("<HBHBHHxHxxxxxxxxI")
+_DIRENT = struct.Struct("<11sBB7xHxxxxHI")
+_DIRENT_SIZE = 32
+
+
+class FatError(Exception):
+    pass
+
+
+def _path_components(path):
+    return [c for c in to_str(to_bytes(path)).split("/") if c and c != "."]
+
+
+def _checksum(short_name):
+    # Checksum of the 8.3 name, stored in the long name entries belonging to
+    # it.
+    total = 0
+    for c in bytearray(short_name):
+        total = (((total & 1) << 7) + (total >> 1) + c) & 0xff
+    return total
+
+
+class FatEntry(object):
+    """A directory entry. name is the long name if there is one, otherwise the
+    8.3 name."""
+
+    def __init__(self, name, short_name, attributes, cluster, size, offset):
+        self.name = name
+        self.short_name = short_name
+        self.attributes = attributes
+        self.cluster = cluster
+        self.size = size
+        # Position of the entry in the file system.
+        self.offset = offset
+
+    def is_dir(self):
+        return bool(self.attributes & ATTR_DIRECTORY)
+
+    def is_file(self):
+        return not self.is_dir()
+
+
+class FatImage(object):
+    """A FAT file system. image is either a PartitionView, or the path of a
+    file holding only the file system, such as a bootimg, which is opened
+    writable if writable is True."""
+
+    def __init__(self, image, writable=False):
+        self._fd = None
+        self._mmap = None
+        if isinstance(image, PartitionView):
+            self.path = "partition at offset %d" % image.offset
+            self.view = image
+        else:
+            self.path = image
+            self._fd = open(image, "r+b" if writable else "rb")
+            try:
+                self._mmap = map_file(self._fd, writable)
+                self.view = PartitionView(self._mmap, 0, len(self._mmap))
+            except Exception:
+                self.close()
+                raise
+        try:
+            self._boot_sector()
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.flush()
+            self._mmap.close()
+            self._mmap = None
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _boot_sector(self):
+        view = self.view
+        if len(view) < 512 or view[510:512] != b"\x55\xaa":
+            raise FatError("%s: Not a FAT file system" % self.path)
+        (self.sector_size, self.sectors_per_cluster, reserved, fats, root_entries,
+         total_sectors, fat_sectors, total_sectors_32) = _BOOT_SECTOR.unpack_from(view[11:36])
+        if (self.sector_size not in (512, 1024, 2048, 4096) or self.sectors_per_cluster == 0
+                or fats == 0):
+            raise FatError("%s: Not a FAT file system" % self.path)
+        if total_sectors == 0:
+            total_sectors = total_sectors_32
+        self.root_cluster = None
+        if fat_sectors == 0:
+            fat_sectors, self.root_cluster = struct.unpack("<I4xI", view[36:48])
+        self.cluster_size = self.sector_size * self.sectors_per_cluster
+        self.fat_offset = reserved * self.sector_size
+        self.fat_size = fat_sectors * self.sector_size
+        self.root_offset = self.fat_offset + fats * self.fat_size
+        root_size = root_entries * _DIRENT_SIZE
+        root_size += -root_size % self.sector_size
+        self.root_size = root_size
+        self.data_offset = self.root_offset + root_size
+        self.cluster_count = ((total_sectors * self.sector_size - self.data_offset)
+                              // self.cluster_size)
+
+        # The number of clusters alone decides the FAT type.
+        if self.cluster_count < 4085:
+            self.fat_type = 12
+        elif self.cluster_count < 65525:
+            self.fat_type = 16
+        else:
+            self.fat_type = 32
+        if self.fat_type != 32:
+            self.root_cluster = None
+            label_offset = 43
+        elif self.root_cluster is None:
+            raise FatError("%s: FAT32 file system without FAT32 boot sector" % self.path)
+        else:
+            label_offset = 71
+        self.label = view[label_offset:label_offset + 11].decode("ascii", "replace").rstrip()
+
+    def _next_cluster(self, cluster):
+        # Returns the cluster following cluster in its chain, or None at the
+        # end of it.
+        if self.fat_type == 12:
+            offset = self.fat_offset + cluster + cluster // 2
+            value = struct.unpack("<H", self.view[offset:offset + 2])[0]
+            value = value >> 4 if cluster & 1 else value & 0xfff
+            end = 0xff8
+        elif self.fat_type == 16:
+            offset = self.fat_offset + cluster * 2
+            value = struct.unpack("<H", self.view[offset:offset + 2])[0]
+            end = 0xfff8
+        else:
+            offset = self.fat_offset + cluster * 4
+            value = struct.unpack("<I", self.view[offset:offset + 4])[0] & 0x0fffffff
+            end = 0x0ffffff8
+        if value >= end:
+            return None
+        if value < 2 or value >= self.cluster_count + 2:
+            raise FatError("%s: Bad cluster %#x in the chain of %d" % (self.path, value, cluster))
+        return value
+
+    def _chain(self, cluster):
+        # Yields the clusters of the chain starting at cluster.
+        for i in range(self.cluster_count + 1):
+            if cluster is None:
+                return
+            yield cluster
+            cluster = self._next_cluster(cluster)
+        raise FatError("%s: Loop in the cluster chain" % self.path)
+
+    def _cluster_offset(self, cluster):
+        return self.data_offset + (cluster - 2) * self.cluster_size
+
+    def _extents(self, cluster):
+        # Yields (offset, size) of the ranges of the file system holding the
+        # chain starting at cluster. Consecutive clusters are merged.
+        start = None
+        size = 0
+        for cluster in self._chain(cluster):
+            offset = self._cluster_offset(cluster)
+            if start is not None and start + size == offset:
+                size += self.cluster_size
+                continue
+            if start is not None:
+                yield start, size
+            start = offset
+            size = self.cluster_size
+        if start is not None:
+            yield start, size
+
+    def _dir_extents(self, entry):
+        if entry is None:
+            # The root directory.
+            if self.root_cluster is None:
+                return [(self.root_offset, self.root_size)]
+            return self._extents(self.root_cluster)
+        return self._extents(entry.cluster)
+
+    def _entries(self, directory):
+        # Yields the FatEntry objects in directory, a FatEntry, or None for
+        # the root directory. Volume labels, "." and ".." are left out.
+        long_parts = []
+        long_checksum = None
+        for start, size in self._dir_extents(directory):
+            for offset in range(start, start + size, _DIRENT_SIZE):
+                raw = self.view[offset:offset + _DIRENT_SIZE]
+                short_name, attributes, nt_flags, cluster_hi, cluster_lo, file_size \
+                    = _DIRENT.unpack(raw)
+                first = bytearray(short_name[:1])[0]
+                if first == 0x00:
+                    return
+                if first == 0xe5:
+                    long_parts = []
+                    continue
+                if attributes & 0x3f == ATTR_LONG_NAME:
+                    order = first
+                    if order & 0x40:
+                        long_parts = []
+                        long_checksum = bytearray(raw[13:14])[0]
+                    elif bytearray(raw[13:14])[0] != long_checksum:
+                        long_parts = []
+                    long_parts.append(raw[1:11] + raw[14:26] + raw[28:32])
+                    continue
+                if attributes & ATTR_VOLUME_ID:
+                    long_parts = []
+                    continue
+
+                short = self._short_name(short_name, nt_flags)
+                name = short
+                if long_parts and long_checksum == _checksum(short_name):
+                    name = b"".join(reversed(long_parts)).decode("utf-16-le")
+                    name = name.split(u"\0")[0]
+                long_parts = []
+                if name in (u".", u".."):
+                    continue
+                cluster = cluster_lo
+                if self.fat_type == 32:
+                    cluster |= cluster_hi << 16
+                yield FatEntry(to_str(name.encode("utf-8")), to_str(short.encode("utf-8")),
+                               attributes, cluster, file_size, offset)
+
+    @staticmethod
+    def _short_name(raw, nt_flags):
+        if raw[:1] == b"\x05":
+            raw = b"\xe5" + raw[1:]
+        base = raw[:8].decode("cp437").rstrip(u" ")
+        ext = raw[8:].decode("cp437").rstrip(u" ")
+        if nt_flags & NT_LOWERCASE_BASE:
+            base = base.lower()
+        if nt_flags & NT_LOWERCASE_EXT:
+            ext = ext.lower()
+        return base + u"." + ext if ext else base
+
+    def lookup(self, path):
+        """Returns the FatEntry at path, or None if it doesn't exist. The
+        root directory has no entry, and is returned as None as well, so use
+        exists() to check for existence."""
+
+        entry = None
+        for component in _path_components(path):
+            if entry is not None and not entry.is_dir():
+                return None
+            wanted = component.lower()
+            for child in self._entries(entry):
+                if child.name.lower() == wanted or child.short_name.lower() == wanted:
+                    entry = child
+                    break
+            else:
+                return None
+        return entry
+
+    def _is_root(self, path):
+        return not _path_components(path)
+
+    def exists(self, path):
+        return self._is_root(path) or self.lookup(path) is not None
+
+    def listdir(self, path):
+        """Returns the sorted names in the directory at path."""
+
+        entry = self.lookup(path)
+        if not self._is_root(path) and (entry is None or not entry.is_dir()):
+            raise FatError("Not a directory: %s" % path)
+        return sorted([child.name for child in self._entries(entry)])
+
+    def walk(self, path="/"):
+        """Yields the absolute paths of all files under the directory at path,
+        but not the directories themselves."""
+
+        entry = self.lookup(path)
+        if not self._is_root(path) and (entry is None or not entry.is_dir()):
+            raise FatError("Not a directory: %s" % path)
+        top = "/" + "/".join(_path_components(path))
+        for child in self._entries(entry):
+            child_path = top.rstrip("/") + "/" + child.name
+            if child.is_dir():
+                for file_path in self.walk(child_path):
+                    yield file_path
+            else:
+                yield child_path
+
+    def _file_extents(self, path):
+        # Returns the (offset, size) ranges holding the contents of the file
+        # at path.
+        entry = self.lookup(path)
+        if entry is None:
+            raise FatError("No such file: %s" % path)
+        if entry.is_dir():
+            raise FatError("Is a directory: %s" % path)
+        extents = []
+        remaining = entry.size
+        if remaining == 0:
+            return extents
+        for start, size in self._extents(entry.cluster):
+            size = min(size, remaining)
+            extents.append((start, size))
+            remaining -= size
+            if remaining == 0:
+                break
+        if remaining != 0:
+            raise FatError("%s: Cluster chain of %s is too short" % (self.path, path))
+        return extents
+
+    def read(self, path):
+        """Returns the contents of the file at path."""
+
+        return b"".join([self.view[start:start + size]
+                         for start, size in self._file_extents(path)])
+
+    def write(self, path, data):
+        """Replaces the contents of the file at path with data, which must be
+        as long as the file."""
+
+        extents = self._file_extents(path)
+        if len(data) != sum([size for start, size in extents]):
+            raise FatError("%s: Can only replace the contents of %s with as many bytes"
+                           % (self.path, path))
+        done = 0
+        for start, size in extents:
+            self.view[start:start + size] = data[done:done + size]
+            done += size
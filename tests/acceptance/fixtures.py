@@ -125,7 +125,10 @@ def qemu_running(request, clean_image):
                     raise
 
             qemu.wait()
-            os.remove(img_path)
+            if os.path.isdir(img_path):
+                shutil.rmtree(img_path)
+            else:
+                os.remove(img_path)
 
         execute(qemu_finalizer_impl, hosts=conftest.current_hosts())
 
@@ -0,0 +1,216 @@
+#!/usr/bin/python
+# Copyright 2019 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Offline editor for the Mender GRUB environments, mender_grubenv1 and
+# mender_grubenv2, in the boot partition of a uefiimg or biosimg, or in a
+# bootimg.
+#
+# Each environment is a directory with an "env" and a "lock" file, both GRUB
+# environment blocks as written by grub-editenv, and "lock.sha256sum", which
+# GRUB checks the lock against. The blocks have a fixed size, so they are
+# changed in place through a writable FatImage, without mounting anything,
+# which lets tests set up a boot scenario in an image before booting it.
+#
+# Can also be run as a script, see main().
+
+import argparse
+import collections
+import hashlib
+import re
+import sys
+
+from bytestr import to_bytes, to_str
+from disk_image import DiskImage, DiskImageError
+from fat_image import FatImage, FatError
+
+GRUBENV_HEADER = b"# GRUB Environment Block\n"
+GRUBENV_SIZE = 1024
+
+MENDER_GRUBENV_DIRS = ["/EFI/BOOT", "/"]
+MENDER_GRUBENV_FILES = ["env", "lock"]
+
+
+class GrubEnvError(Exception):
+    pass
+
+
+def parse_envblk(data):
+    """Returns the variables in the GRUB environment block data, as an
+    ordered dictionary."""
+
+    if not data.startswith(GRUBENV_HEADER):
+        raise GrubEnvError("Not a GRUB environment block")
+    variables = collections.OrderedDict()
+    # Newlines and backslashes in values are escaped with a backslash.
+    for match in re.finditer(br"^([^#\n=][^=\n]*)=((?:[^\\\n]|\\.)*)\n",
+                             data[len(GRUBENV_HEADER):], re.MULTILINE | re.DOTALL):
+        value = re.sub(br"\\(.)", br"\1", match.group(2), flags=re.DOTALL)
+        variables[to_str(match.group(1), errors="strict")] = to_str(value, errors="strict")
+    return variables
+
+
+def pack_envblk(variables, size=GRUBENV_SIZE):
+    """Returns variables as a GRUB environment block of size bytes, padded
+    with "#" like grub-editenv does."""
+
+    data = GRUBENV_HEADER
+    for name, value in variables.items():
+        name = to_bytes(name, errors="strict")
+        if not name or b"=" in name or b"\n" in name:
+            raise GrubEnvError("Invalid variable name: '%s'" % to_str(name))
+        value = re.sub(br"([\\\n])", br"\\\1", to_bytes(value, errors="strict"))
+        data += name + b"=" + value + b"\n"
+    if len(data) > size:
+        raise GrubEnvError("The variables need %d bytes, but the environment block only has %d"
+                           % (len(data), size))
+    return data + b"#" * (size - len(data))
+
+
+class MenderGrubEnv(object):
+    """The Mender GRUB environments in the boot partition of the image at
+    path. part is the number of the boot partition, or None if the image is a
+    bootimg, with only the file system. With writable, the environments can
+    be changed."""
+
+    def __init__(self, path, part=1, writable=False):
+        self._disk = None
+        self.fat = None
+        try:
+            if part is None:
+                self.fat = FatImage(path, writable=writable)
+            else:
+                self._disk = DiskImage(path, writable=writable)
+                self.fat = FatImage(self._disk.partition(part))
+            for env_dir in MENDER_GRUBENV_DIRS:
+                if self.fat.exists(env_dir.rstrip("/") + "/mender_grubenv1"):
+                    self.env_dir = env_dir.rstrip("/")
+                    break
+            else:
+                raise GrubEnvError("%s: No Mender GRUB environment in the boot partition" % path)
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self.fat is not None:
+            self.fat.close()
+            self.fat = None
+        if self._disk is not None:
+            self._disk.close()
+            self._disk = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _path(self, env, name):
+        if env not in (1, 2):
+            raise GrubEnvError("There is no Mender GRUB environment %s" % env)
+        if name not in MENDER_GRUBENV_FILES and name != "lock.sha256sum":
+            raise GrubEnvError("Unknown file in the Mender GRUB environment: %s" % name)
+        return "%s/mender_grubenv%d/%s" % (self.env_dir, env, name)
+
+    def read(self, env, name="env"):
+        """Returns the variables in the "env" or "lock" block of environment
+        env, 1 or 2."""
+
+        return parse_envblk(self.fat.read(self._path(env, name)))
+
+    def lock_checksum_valid(self, env):
+        """Returns whether the lock of environment env matches its
+        lock.sha256sum, which GRUB requires. Older versions of
+        grub-mender-grubenv have no checksum, and then it is always True."""
+
+        checksum_path = self._path(env, "lock.sha256sum")
+        if not self.fat.exists(checksum_path):
+            return True
+        checksum = self.fat.read(checksum_path).split()[0]
+        digest = hashlib.sha256(self.fat.read(self._path(env, "lock"))).hexdigest()
+        return to_str(checksum) == digest
+
+    def write(self, env, variables, name="env"):
+        """Replaces the variables in the "env" or "lock" block of environment
+        env. The lock's checksum is updated too, unless it was wrong
+        already."""
+
+        path = self._path(env, name)
+        size = len(self.fat.read(path))
+        update_checksum = name == "lock" and self.lock_checksum_valid(env)
+        data = pack_envblk(variables, size)
+        self.fat.write(path, data)
+        checksum_path = self._path(env, "lock.sha256sum")
+        if update_checksum and self.fat.exists(checksum_path):
+            # Keep the rest of the line, the path of the lock, unchanged.
+            line = self.fat.read(checksum_path)
+            self.fat.write(checksum_path, to_bytes(hashlib.sha256(data).hexdigest())
+                           + line[64:])
+
+    def update(self, changes, envs=(1, 2), name="env"):
+        """Sets the variables in changes, and removes the ones whose value is
+        None, in the "env" or "lock" block of each of envs. Mender always
+        updates both environments."""
+
+        for env in envs:
+            variables = self.read(env, name)
+            for var, value in changes.items():
+                if value is None:
+                    variables.pop(var, None)
+                else:
+                    variables[var] = value
+            self.write(env, variables, name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print or change the Mender GRUB "
+                                     + "environments in an image.")
+    parser.add_argument("--part", type=int, default=1,
+                        help="Number of the boot partition, or 0 if the image is a bootimg.")
+    parser.add_argument("--env", type=int, choices=[1, 2], action="append",
+                        help="Environment to use. Defaults to both.")
+    parser.add_argument("--file", choices=MENDER_GRUBENV_FILES, default="env",
+                        help="Block to use in each environment.")
+    parser.add_argument("image")
+    parser.add_argument("assignment", nargs="*",
+                        help="name=value to set, or name= to remove. Without any, the "
+                        + "variables are printed.")
+    args = parser.parse_args()
+
+    envs = args.env or [1, 2]
+    try:
+        changes = collections.OrderedDict()
+        for assignment in args.assignment:
+            name, sep, value = assignment.partition("=")
+            if not sep:
+                raise GrubEnvError("Expected name=value, got '%s'" % assignment)
+            changes[name] = value if value else None
+        with MenderGrubEnv(args.image, args.part or None, writable=bool(changes)) as grubenv:
+            if changes:
+                grubenv.update(changes, envs, args.file)
+            else:
+                for env in envs:
+                    valid = args.file != "lock" or grubenv.lock_checksum_valid(env)
+                    print("mender_grubenv%d/%s%s:" % (env, args.file,
+                                                      "" if valid else " (bad checksum)"))
+                    for name, value in grubenv.read(env, args.file).items():
+                        print("%s=%s" % (name, value))
+    except (GrubEnvError, DiskImageError, FatError, EnvironmentError) as e:
+        sys.stderr.write("grub_env.py: %s\n" % e)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
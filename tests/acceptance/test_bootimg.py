@@ -15,10 +15,10 @@
 
 import os
 import pytest
-import subprocess
 
 # Make sure common is imported after fabric, because we override some functions.
 from common import *
+from fat_image import FatImage
 
 class TestBootImg:
     @pytest.mark.min_mender_version('1.0.0')
@@ -32,5 +32,5 @@ class TestBootImg:
 
         distro_features = bitbake_variables['DISTRO_FEATURES'].split()
         if "mender-grub" in distro_features and "mender-image-uefi" in distro_features:
-            output = subprocess.check_output(["mdir", "-i", built_img, "-b", "/EFI/BOOT"])
-            assert "mender_grubenv1" in output.split('/')
+            with FatImage(built_img) as fat:
+                assert "mender_grubenv1" in fat.listdir("/EFI/BOOT")
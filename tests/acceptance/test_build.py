@@ -18,25 +18,18 @@ import pytest
 import subprocess
 import re
 import json
+import random
+import shutil
+import struct
+import uuid
+import zlib
 
 # Make sure common is imported after fabric, because we override some functions.
 from common import *
-
-def extract_partition(img, number):
-    output = subprocess.Popen(["fdisk", "-l", "-o", "device,start,end", img],
-                              stdout=subprocess.PIPE)
-    for line in output.stdout:
-        if re.search("img%d" % number, line) is None:
-            continue
-
-        match = re.match("\s*\S+\s+(\S+)\s+(\S+)", line)
-        assert(match is not None)
-        start = int(match.group(1))
-        end = (int(match.group(2)) + 1)
-    output.wait()
-
-    subprocess.check_call(["dd", "if=" + img, "of=img%d.fs" % number,
-                           "skip=%d" % start, "count=%d" % (end - start)])
+from disk_image import DiskImage
+from ext4_image import Ext4Image
+from fat_image import FatImage
+from grub_env import MenderGrubEnv
 
 class EmbeddedBootloader:
     loader = None
@@ -138,16 +131,9 @@ class TestBuild:
 
         built_rootfs = latest_build_artifact(prepared_test_build['build_dir'], "core-image*.dataimg")
 
-        subprocess.check_call(["debugfs", "-R",
-                                   "dump -p /etc/mender/mender.conf mender.conf", built_rootfs])
-
-        try:
-            with open("mender.conf") as fd:
-                data = json.load(fd)
-            assert data['TenantToken'] == "authtentoken"
-
-        finally:
-            os.remove("mender.conf")
+        with Ext4Image(built_rootfs) as fs:
+            data = json.loads(fs.read("/etc/mender/mender.conf").decode())
+        assert data['TenantToken'] == "authtentoken"
 
 
 
@@ -167,19 +153,17 @@ class TestBuild:
         built_rootfs = latest_build_artifact(prepared_test_build['build_dir'], "core-image*.ext[234]")
         # Copy out the key we just added from the image and use that to
         # verify instead of the original, just to be sure.
-        subprocess.check_call(["debugfs", "-R",
-                               "dump -p /etc/mender/artifact-verify-key.pem artifact-verify-key.pem",
-                               built_rootfs])
-        try:
+        with Ext4Image(built_rootfs) as fs:
+            verify_key = fs.read("/etc/mender/artifact-verify-key.pem")
+        with make_tempdir() as tmpdir:
+            verify_key_file = os.path.join(tmpdir, "artifact-verify-key.pem")
+            with open(verify_key_file, "wb") as fd:
+                fd.write(verify_key)
             built_artifact = latest_build_artifact(prepared_test_build['build_dir'], "core-image*.mender")
-            output = subprocess.check_output(["mender-artifact", "read", "-k",
-                                              os.path.join(os.getcwd(), "artifact-verify-key.pem"),
+            output = subprocess.check_output(["mender-artifact", "read", "-k", verify_key_file,
                                               built_artifact])
             assert(output.find("Signature: signed and verified correctly") >= 0)
 
-        finally:
-            os.remove("artifact-verify-key.pem")
-
     @pytest.mark.only_with_image('ext4', 'ext3', 'ext2')
     @pytest.mark.min_mender_version("1.2.0")
     def test_state_scripts(self, prepared_test_build, bitbake_variables, bitbake_path, latest_rootfs, latest_mender_image):
@@ -188,23 +172,12 @@ class TestBuild:
 
         # First verify that the base build does *not* contain any state scripts.
         # Check rootfs.
-        output = subprocess.check_output(["debugfs", "-R", "ls -p /etc/mender", latest_rootfs])
-        for line in output.split('\n'):
-            if len(line) == 0:
-                continue
-
-            entry = line.split('/')
-            if entry[5] == "scripts":
+        with Ext4Image(latest_rootfs) as fs:
+            if "scripts" in fs.listdir("/etc/mender"):
                 # The scripts directory exists. That is fine in itself, but it
                 # should not contain any script files ("version" is allowed).
-                output = subprocess.check_output(["debugfs", "-R", "ls -p /etc/mender/scripts", latest_rootfs])
-                for line in output.split('\n'):
-                    if len(line) == 0:
-                        continue
-
-                    entry = line.split('/')
-                    assert entry[5] == "." or entry[5] == ".." or entry[5] == "version", "There should be no script file in /etc/mender/scripts"
-                break
+                for entry in fs.listdir("/etc/mender/scripts"):
+                    assert entry == "version", "There should be no script file in /etc/mender/scripts"
 
         # Check artifact.
         output = subprocess.check_output("tar xOf %s header.tar.gz| tar tz"
@@ -236,18 +209,10 @@ class TestBuild:
 
             # Check new rootfs.
             built_rootfs = latest_build_artifact(prepared_test_build['build_dir'], "core-image*.ext[234]")
-            output = subprocess.check_output(["debugfs", "-R", "ls -p /etc/mender/scripts", built_rootfs])
-            for line in output.split('\n'):
-                if len(line) == 0:
-                    continue
-
-                entry = line.split('/')
-
-                if entry[5] == "." or entry[5] == "..":
-                    continue
-
-                assert found_rootfs_scripts.get(entry[5]) is not None, "Unexpected script in rootfs %s" % entry[5]
-                found_rootfs_scripts[entry[5]] = True
+            with Ext4Image(built_rootfs) as fs:
+                for entry in fs.listdir("/etc/mender/scripts"):
+                    assert found_rootfs_scripts.get(entry) is not None, "Unexpected script in rootfs %s" % entry
+                    found_rootfs_scripts[entry] = True
 
             for script in found_rootfs_scripts:
                 assert found_rootfs_scripts[script], "%s not found in rootfs script list" % script
@@ -419,30 +384,28 @@ deployed-test-dir9/*;renamed-deployed-test-dir9/ \
         run_bitbake(prepared_test_build)
 
         image = latest_build_artifact(prepared_test_build['build_dir'], "core-image*.*img")
-        extract_partition(image, 1)
+        with DiskImage(image) as disk:
+            with FatImage(disk.partition(1)) as fat:
+                listing = list(fat.walk())
+        expected = [
+            "/deployed-test1",
+            "/deployed-test2",
+            "/renamed-deployed-test3",
+            "/renamed-deployed-test4",
+            "/renamed-deployed-test-dir5/renamed-deployed-test5",
+            "/renamed-deployed-test-dir6/renamed-deployed-test6",
+            "/deployed-test7",
+            "/deployed-test8",
+            "/renamed-deployed-test-dir9/deployed-test9",
+        ]
+        assert(all([item in listing for item in expected]))
+
+        add_to_local_conf(prepared_test_build, 'IMAGE_BOOT_FILES_append = " conflict-test1"')
         try:
-            listing = run_verbose("mdir -i img1.fs -b -/", capture=True).split()
-            expected = [
-                "::/deployed-test1",
-                "::/deployed-test2",
-                "::/renamed-deployed-test3",
-                "::/renamed-deployed-test4",
-                "::/renamed-deployed-test-dir5/renamed-deployed-test5",
-                "::/renamed-deployed-test-dir6/renamed-deployed-test6",
-                "::/deployed-test7",
-                "::/deployed-test8",
-                "::/renamed-deployed-test-dir9/deployed-test9",
-            ]
-            assert(all([item in listing for item in expected]))
-
-            add_to_local_conf(prepared_test_build, 'IMAGE_BOOT_FILES_append = " conflict-test1"')
-            try:
-                run_bitbake(prepared_test_build)
-                pytest.fail("Bitbake succeeded, but should have failed with a file conflict")
-            except subprocess.CalledProcessError:
-                pass
-        finally:
-            os.remove("img1.fs")
+            run_bitbake(prepared_test_build)
+            pytest.fail("Bitbake succeeded, but should have failed with a file conflict")
+        except subprocess.CalledProcessError:
+            pass
 
     @pytest.mark.only_with_image('sdimg', 'uefiimg')
     @pytest.mark.min_mender_version('2.0.0')
@@ -453,8 +416,8 @@ deployed-test-dir9/*;renamed-deployed-test-dir9/ \
         else:
             originally_on = False
 
-        output = subprocess.check_output(["debugfs", "-R", "ls -p /usr/share/mender", latest_rootfs])
-        entries = [elem.split('/')[5] for elem in output.split('\n') if elem.startswith('/')]
+        with Ext4Image(latest_rootfs) as fs:
+            entries = fs.listdir("/usr/share/mender")
 
         if originally_on:
             assert "modules" in entries
@@ -466,8 +429,8 @@ deployed-test-dir9/*;renamed-deployed-test-dir9/ \
 
         new_rootfs = latest_build_artifact(prepared_test_build['build_dir'], "core-image*.ext4")
 
-        output = subprocess.check_output(["debugfs", "-R", "ls -p /usr/share/mender", new_rootfs])
-        entries = [elem.split('/')[5] for elem in output.split('\n') if elem.startswith('/')]
+        with Ext4Image(new_rootfs) as fs:
+            entries = fs.listdir("/usr/share/mender")
 
         if originally_on:
             assert "modules" not in entries
@@ -568,6 +531,398 @@ deployed-test-dir9/*;renamed-deployed-test-dir9/ \
         else:
             assert False, "Should not get here!"
 
+    @pytest.mark.only_with_image('sdimg', 'uefiimg', 'gptimg', 'biosimg')
+    @pytest.mark.min_mender_version('1.0.0')
+    def test_part_image_fixup(self, latest_part_image, bitbake_variables):
+        """Test that the one pass partition table post-processing gives the
+        same result as the fdisk/sgdisk sequence it replaced."""
+
+        gpt = latest_part_image.endswith(".uefiimg") or latest_part_image.endswith(".gptimg")
+        alignment = int(bitbake_variables['MENDER_PARTITION_ALIGNMENT'])
+        numbers = [bitbake_variables['MENDER_BOOT_PART_NUMBER'],
+                   bitbake_variables['MENDER_ROOTFS_PART_A_NUMBER'],
+                   bitbake_variables['MENDER_ROOTFS_PART_B_NUMBER'],
+                   bitbake_variables['MENDER_DATA_PART_NUMBER']]
+        uuids = [str(uuid.uuid4()) for _ in numbers]
+        disk_id = "%08x" % random.getrandbits(32)
+
+        with make_tempdir() as tmpdir:
+            reference = os.path.join(tmpdir, "reference.img")
+            native = os.path.join(tmpdir, "native.img")
+            for img in [reference, native]:
+                shutil.copyfile(latest_part_image, img)
+                # Unalign the image, so that it needs padding, and on GPT, so
+                # that the backup header needs to be relocated.
+                subprocess.check_call(["truncate", "-s", "+512", img])
+                if not gpt:
+                    # Change the types, so that they need fixing.
+                    for number in numbers[1:]:
+                        subprocess.check_call(["sfdisk", "--part-type", img, number, "8e"])
+
+            # The old post-processing steps.
+            pad_size = (os.stat(reference).st_size + alignment - 1) // alignment * alignment
+            subprocess.check_call(["truncate", "-s", str(pad_size), reference])
+            if gpt:
+                subprocess.check_call(["sgdisk", "-e", reference])
+                for number, partuuid in zip(numbers, uuids):
+                    subprocess.check_call(["sgdisk", "-u", "%s:%s" % (number, partuuid), reference])
+            else:
+                script = ""
+                for number in numbers[1:]:
+                    script += "t\n%s\n83\n" % number
+                script += "x\ni\n0x%s\nr\nw\n" % disk_id
+                fdisk = subprocess.Popen(["fdisk", reference], stdin=subprocess.PIPE)
+                fdisk.communicate(script)
+                assert fdisk.returncode == 0
+
+            # The new one.
+            cmd = ["python3", "../../meta-mender-core/scripts/mender-part-image", "fixup",
+                   "--align", str(alignment)]
+            if gpt:
+                for number, partuuid in zip(numbers, uuids):
+                    cmd += ["--partuuid", "%s:%s" % (number, partuuid)]
+            else:
+                for number in numbers[1:]:
+                    cmd += ["--type", "%s:83" % number]
+                cmd += ["--disk-id", disk_id]
+            subprocess.check_call(cmd + [native])
+
+            assert os.stat(reference).st_size == os.stat(native).st_size
+
+            def dump(img):
+                output = subprocess.check_output(["sfdisk", "--dump", img])
+                return output.replace(img, "image")
+
+            assert dump(reference) == dump(native)
+
+            if gpt:
+                output = subprocess.check_output(["sgdisk", "-v", native])
+                assert "No problems found" in output, output
+
+    @pytest.mark.only_with_image('sdimg', 'uefiimg', 'gptimg', 'biosimg')
+    @pytest.mark.min_mender_version('1.0.0')
+    def test_part_image_matches_wic(self, latest_part_image, bitbake_variables):
+        """Test that mender-part-image places the partitions exactly where wic
+        places them for the same wks description, and that the boot partition
+        keeps the "boot" label it had when wic made it."""
+
+        suffix = latest_part_image.rsplit(".", 1)[1]
+        wks = os.path.join(bitbake_variables['WORKDIR'], "mender-part-image-%s" % suffix,
+                           "mender-%s.wks" % suffix)
+        if not os.path.exists(wks):
+            pytest.skip("%s is gone, was the image built from sstate or with rm_work?" % wks)
+
+        with make_tempdir() as tmpdir:
+            # The payloads in IMGDEPLOYDIR may be gone, but they are deployed.
+            with open(wks) as fd:
+                content = fd.read().replace(bitbake_variables['IMGDEPLOYDIR'],
+                                            bitbake_variables['DEPLOY_DIR_IMAGE'])
+            wic_wks = os.path.join(tmpdir, os.path.basename(wks))
+            with open(wic_wks, "w") as fd:
+                fd.write(content)
+
+            run_verbose("cd %s && wic create %s -e %s -o %s"
+                        % (os.environ['BUILDDIR'], wic_wks, bitbake_variables['IMAGE_BASENAME'],
+                           tmpdir))
+            wic_image = [os.path.join(tmpdir, name) for name in os.listdir(tmpdir)
+                         if name.endswith(".direct")][0]
+
+            def layout(disk):
+                return [(part.number, part.start, part.size) for part in disk.partitions]
+
+            with DiskImage(wic_image) as wic, DiskImage(latest_part_image) as native:
+                assert layout(native) == layout(wic)
+
+                if bitbake_variables['MENDER_BOOT_PART_SIZE_MB'] != "0":
+                    boot = native.partition(int(bitbake_variables['MENDER_BOOT_PART_NUMBER']))
+                    with FatImage(boot) as fat:
+                        assert fat.label == "boot"
+
+    @pytest.mark.min_mender_version('1.0.0')
+    def test_part_image_mbr_types(self):
+        """Test that mender-part-image gives msdos partitions the type from
+        their --system-id, or else the one wic chooses for their file system,
+        and that unsupported wic options only give a warning."""
+
+        with make_tempdir() as tmpdir:
+            payload = os.path.join(tmpdir, "payload.img")
+            with open(payload, "wb") as fd:
+                fd.write(b"\xa5" * 1024 * 1024)
+            wks = os.path.join(tmpdir, "test.wks")
+            with open(wks, "w") as fd:
+                for params in ["--fstype=vfat --system-id 0x0e",
+                               "--fstype=vfat",
+                               "--fstype=msdos",
+                               ""]:
+                    fd.write('part --source rawcopy --sourceparams="file=%s" --align 1024 %s\n'
+                             % (payload, params))
+                fd.write("bootloader --ptable msdos\n")
+
+            img = os.path.join(tmpdir, "test.img")
+            proc = subprocess.Popen(["python3", "../../meta-mender-core/scripts/mender-part-image",
+                                     "assemble", "--wic-args=-e core-image --no-such-option 42",
+                                     wks, img],
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            _, errors = proc.communicate()
+            assert proc.returncode == 0, errors
+            assert b"--no-such-option 42" in errors
+
+            with DiskImage(img) as disk:
+                assert [part.type for part in disk.partitions] == [0x0e, 0x0c, 0x06, 0x83]
+
+    @pytest.mark.min_mender_version('1.0.0')
+    @pytest.mark.parametrize('fill', [None, 0xff])
+    def test_mtdimg_program_map(self, fill):
+        """Test that the blocks which the mtdimg program map leaves out hold
+        exactly the erase value it declares, and that the listed ones don't."""
+
+        block_size = 4096
+        with make_tempdir() as tmpdir:
+            uboot = os.path.join(tmpdir, "u-boot.bin")
+            with open(uboot, "wb") as fd:
+                # Ends in the middle of the second block, which is also
+                # partly unused.
+                fd.write(b"\x5a" * (block_size + 100))
+            ubi = os.path.join(tmpdir, "ubi.img")
+            with open(ubi, "wb") as fd:
+                # A block of zeros, a block of 0xff and a block of data.
+                fd.write(b"\0" * block_size + b"\xff" * block_size + b"\xa5" * block_size)
+
+            img = os.path.join(tmpdir, "test.mtdimg")
+            cmd = ["python3", "../../meta-mender-core/scripts/mender-mtd-image",
+                   "--part", "u-boot:0:%d:%s" % (4 * block_size, uboot),
+                   "--part", "u-boot-env:%d:%d:" % (4 * block_size, 2 * block_size),
+                   "--part", "ubi:%d:-:%s" % (6 * block_size, ubi),
+                   "--storage-size", str(12 * block_size),
+                   "--block-size", str(block_size),
+                   "--map", img + ".map"]
+            if fill is not None:
+                cmd += ["--fill", "0x%02x" % fill]
+            subprocess.check_call(cmd + [img])
+
+            listed = set()
+            erase_value = None
+            with open(img + ".map") as fd:
+                for line in fd:
+                    if line.startswith("# EraseValue:"):
+                        erase_value = int(line.split(":")[1], 0)
+                    elif not line.startswith("#"):
+                        first, last = [int(n) for n in line.split()[0].split("-")]
+                        listed.update(range(first, last + 1))
+            assert erase_value == (0 if fill is None else fill)
+
+            with open(img, "rb") as fd:
+                data = fd.read()
+            assert len(data) == 12 * block_size
+            erased = struct.pack("B", erase_value) * block_size
+            for block in range(12):
+                contents = data[block * block_size:(block + 1) * block_size]
+                assert (contents != erased) == (block in listed), \
+                    "Block %d disagrees with the program map" % block
+
+    @pytest.mark.min_mender_version('1.0.0')
+    @pytest.mark.parametrize('ptable,swap_mb,overhead_blocks,data_part,fits', [
+        ('msdos', 0, None, 4, True),
+        ('gpt', 0, None, 4, True),
+        ('gpt', 64, None, 5, True),
+        # Swap and data are logical partitions, and each of them loses an
+        # alignment block to its EBR, which the default overhead accounts for.
+        ('msdos', 64, None, 6, True),
+        # But not an overhead which leaves that out.
+        ('msdos', 64, 2, 6, False),
+    ])
+    def test_storage_layout_plan(self, ptable, swap_mb, overhead_blocks, data_part, fits):
+        """Test that the storage layout planner places the partitions where the
+        layout variables say they are, and reports partitions which do not fit
+        in the storage."""
+
+        total_mb = 1024
+        alignment = 8388608
+        cmd = ["python3", "../../meta-mender-core/scripts/mender-storage-layout",
+               "--total-mb", str(total_mb),
+               "--swap-mb", str(swap_mb),
+               "--alignment", str(alignment),
+               "--ptable", ptable]
+        if overhead_blocks is None:
+            overhead_blocks = 2
+            if ptable == "msdos" and swap_mb:
+                overhead_blocks += 2
+        else:
+            cmd += ["--overhead-kb", str(overhead_blocks * alignment // 1024)]
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        output = proc.communicate()[0].decode()
+        assert (proc.returncode == 0) == fits, output
+
+        # Same as MENDER_CALC_ROOTFS_SIZE, with the default boot and data
+        # partition sizes.
+        rootfs_kb = (((total_mb - 16 - 128 - swap_mb) * 1048576 - overhead_blocks * alignment) // 2
+                     // alignment * alignment // 1024)
+        assert "Rootfs size:        %d KiB" % rootfs_kb in output
+        assert "Data partition:     %d" % data_part in output
+
+        regions = {}
+        disk_end = None
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) == 5 and fields[0] != "Num":
+                regions[fields[1]] = (fields[0], int(fields[2], 16), int(fields[3], 16))
+            elif line.startswith("Disk end:"):
+                disk_end = int(fields[2], 16)
+
+        assert regions["rootfs-a"][2] == rootfs_kb * 1024
+        assert regions["rootfs-b"][2] == rootfs_kb * 1024
+        assert regions["data"][0] == str(data_part)
+        assert ("swap" in regions) == (swap_mb != 0)
+        for name, (_, offset, size) in regions.items():
+            assert offset % alignment == 0, "%s is not aligned" % name
+        assert (disk_end <= total_mb * 1048576) == fits
+        if not fits:
+            assert "Problem: The partitions need" in output
+
+    @pytest.mark.only_with_image('sdimg', 'uefiimg', 'gptimg', 'biosimg')
+    @pytest.mark.min_mender_version('1.0.0')
+    def test_empty_rootfs_part_b(self, prepared_test_build, bitbake_variables):
+        """Test that MENDER_ROOTFS_PART_B_EMPTY keeps the layout, but leaves the
+        second rootfs partition unwritten."""
+
+        add_to_local_conf(prepared_test_build, 'MENDER_ROOTFS_PART_B_EMPTY = "1"')
+        run_bitbake(prepared_test_build)
+
+        image = latest_build_artifact(prepared_test_build['build_dir'], "core-image*.*img")
+        part_a = int(bitbake_variables['MENDER_ROOTFS_PART_A_NUMBER'])
+        part_b = int(bitbake_variables['MENDER_ROOTFS_PART_B_NUMBER'])
+        with DiskImage(image) as disk:
+            view_a = disk.partition(part_a)
+            view_b = disk.partition(part_b)
+            assert len(view_a) == len(view_b)
+
+            assert view_a[:1024 * 1024].strip(b"\0") != b""
+
+            for buf in view_b.chunks():
+                assert buf.strip(b"\0") == b"", "Partition %d is not empty" % part_b
+
+    @pytest.mark.min_mender_version('1.0.0')
+    @pytest.mark.parametrize('fstype', ['ext2', 'ext4'])
+    def test_ext4_image_dot_dot(self, fstype):
+        """Test that Ext4Image resolves ".." in directories with an htree
+        index, where it is only stored in the index root."""
+
+        with make_tempdir() as tmpdir:
+            top = os.path.join(tmpdir, "root")
+            big = os.path.join(top, "big")
+            os.makedirs(os.path.join(top, "sub"))
+            os.makedirs(big)
+            with open(os.path.join(top, "sub", "file"), "w") as fd:
+                fd.write("contents")
+            for i in range(3000):
+                open(os.path.join(big, "entry-%04d" % i), "w").close()
+            os.symlink("../sub", os.path.join(big, "lnk"))
+
+            img = os.path.join(tmpdir, "test.%s" % fstype)
+            subprocess.check_call(["mke2fs", "-q", "-t", fstype, "-O", "dir_index",
+                                   "-d", top, img, "16M"])
+            # mke2fs -d does not index directories, but "e2fsck -D" does. Exit
+            # code 1 means that the file system was modified.
+            assert subprocess.call(["e2fsck", "-f", "-y", "-D", img]) in (0, 1)
+
+            with Ext4Image(img) as fs:
+                assert fs.lookup("/big").flags & 0x1000, "Directory is not indexed"
+                assert fs.lookup("/big/..").number == fs.lookup("/").number
+                assert fs.lookup("/big/../sub").number == fs.lookup("/sub").number
+                assert fs.read("/big/lnk/file") == b"contents"
+                assert fs.listdir("/big/lnk") == ["file"]
+
+    @pytest.mark.only_with_image('sdimg', 'ubimg')
+    @pytest.mark.only_with_distro_feature('mender-uboot')
+    @pytest.mark.min_mender_version('1.0.0')
+    def test_uboot_env_offline(self, bitbake_variables):
+        """Test that mender-uboot-env can preset the boot state in an image,
+        without booting it."""
+
+        uboot_variables = get_bitbake_variables("u-boot")
+        env_size = int(uboot_variables['BOOTENV_SIZE'], 0)
+        if "ubimg" in bitbake_variables['IMAGE_FSTYPES'].split():
+            image = latest_build_artifact(os.environ['BUILDDIR'], "core-image*.ubimg")
+            offsets = []
+        else:
+            image = latest_build_artifact(os.environ['BUILDDIR'], "core-image*.sdimg")
+            offsets = [int(uboot_variables['MENDER_UBOOT_ENV_STORAGE_DEVICE_OFFSET_1'], 0),
+                       int(uboot_variables['MENDER_UBOOT_ENV_STORAGE_DEVICE_OFFSET_2'], 0)]
+
+        with make_tempdir() as tmpdir:
+            img = os.path.join(tmpdir, os.path.basename(image))
+            shutil.copyfile(image, img)
+            defaults = os.path.join(tmpdir, "defaults.txt")
+            with open(defaults, "w") as fd:
+                fd.write("bootcmd=run mender_setup\nbootcount=0\nupgrade_available=0\n"
+                         + "mender_boot_part=2\n")
+
+            cmd = ["python3", "../../meta-mender-core/scripts/mender-uboot-env",
+                   "--size", str(env_size)]
+            for offset in offsets:
+                cmd += ["--offset", str(offset)]
+            cmd.append(img)
+
+            subprocess.check_call(cmd + ["set", "--defaults", defaults, "upgrade_available=1",
+                                         "bootcount=1", "mender_boot_part=3"])
+            # Goes to the other copy.
+            subprocess.check_call(cmd + ["set", "bootcount=2"])
+
+            output = subprocess.check_output(cmd + ["print"]).decode()
+            assert output.split("\n") == ["bootcmd=run mender_setup", "bootcount=2",
+                                          "mender_boot_part=3", "upgrade_available=1", ""]
+            output = subprocess.check_output(cmd + ["info"]).decode()
+            assert output.count(", valid") == 2, output
+
+            # Check the raw copies in the disk image, the way U-Boot does.
+            with open(img, "rb") as fd:
+                for offset in offsets:
+                    fd.seek(offset)
+                    data = fd.read(env_size)
+                    assert struct.unpack("<I", data[:4])[0] == zlib.crc32(data[5:]) & 0xffffffff
+
+    @pytest.mark.only_with_image('uefiimg', 'biosimg')
+    @pytest.mark.only_with_distro_feature('mender-grub')
+    @pytest.mark.min_mender_version('1.0.0')
+    def test_grub_env_offline(self, latest_part_image, bitbake_variables):
+        """Test that the Mender GRUB environments in the boot partition can be
+        changed without mounting or booting the image."""
+
+        part = int(bitbake_variables['MENDER_BOOT_PART_NUMBER'])
+        with make_tempdir() as tmpdir:
+            img = os.path.join(tmpdir, os.path.basename(latest_part_image))
+            shutil.copyfile(latest_part_image, img)
+
+            with MenderGrubEnv(img, part) as grubenv:
+                orig_env = [grubenv.read(1), grubenv.read(2)]
+                assert grubenv.read(1, "lock")["editing"] == "0"
+                assert grubenv.lock_checksum_valid(1) and grubenv.lock_checksum_valid(2)
+
+            # Mark the first environment as being in the middle of an edit,
+            # the scenario of test_redundant_grub_env.
+            with MenderGrubEnv(img, part, writable=True) as grubenv:
+                grubenv.update({"editing": "1"}, envs=[1], name="lock")
+                grubenv.update({"upgrade_available": "1", "bootcount": None})
+
+            with MenderGrubEnv(img, part) as grubenv:
+                assert grubenv.read(1, "lock")["editing"] == "1"
+                assert grubenv.read(2, "lock")["editing"] == "0"
+                assert grubenv.lock_checksum_valid(1) and grubenv.lock_checksum_valid(2)
+                for env in [1, 2]:
+                    expected = orig_env[env - 1].copy()
+                    expected["upgrade_available"] = "1"
+                    expected.pop("bootcount", None)
+                    assert dict(grubenv.read(env)) == dict(expected)
+
+            # Nothing but the environment blocks changed.
+            with DiskImage(latest_part_image) as orig, DiskImage(img) as changed:
+                assert [(p.start, p.size) for p in orig.partitions] \
+                    == [(p.start, p.size) for p in changed.partitions]
+                for number in [p.number for p in orig.partitions if p.number != part]:
+                    for chunk_a, chunk_b in zip(orig.partition(number).chunks(),
+                                                changed.partition(number).chunks()):
+                        assert chunk_a == chunk_b, "Partition %d changed" % number
+
     class BuildDependsProvides(object):
         """
         BuildDependsProvides is a utility class for handling the depends and
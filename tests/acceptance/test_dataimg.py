@@ -13,12 +13,12 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
-import os
 import pytest
-import subprocess
 
 # Make sure common is imported after fabric, because we override some functions.
 from common import *
+from ext4_image import Ext4Image
+from ubi_image import UbifsImage
 
 class TestDataImg:
     @pytest.mark.min_mender_version('1.0.0')
@@ -31,15 +31,10 @@ class TestDataImg:
         built_img = latest_build_artifact(prepared_test_build['build_dir'], "core-image*.dataimg")
 
         # Check that it contains the device_type file, as we expect.
-        with make_tempdir() as tmpdir:
-            menderdir = os.path.join(tmpdir, "mender")
-            if bitbake_variables['ARTIFACTIMG_FSTYPE'] == "ubifs":
-                subprocess.check_call(["ubireader_extract_files", "-o", tmpdir, built_img])
-            else:
-                os.mkdir(menderdir)
-                subprocess.check_call(["debugfs", "-R",
-                                       "dump -p /mender/device_type %s" % os.path.join(menderdir, "device_type"),
-                                       built_img])
-            with open(os.path.join(menderdir, "device_type")) as fd:
-                content = fd.read()
-            assert content == "device_type=%s\n" % bitbake_variables['MENDER_DEVICE_TYPE']
+        if bitbake_variables['ARTIFACTIMG_FSTYPE'] == "ubifs":
+            with UbifsImage(built_img) as ubifs:
+                content = ubifs.read("/mender/device_type").decode()
+        else:
+            with Ext4Image(built_img) as fs:
+                content = fs.read("/mender/device_type").decode()
+        assert content == "device_type=%s\n" % bitbake_variables['MENDER_DEVICE_TYPE']
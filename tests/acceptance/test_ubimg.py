@@ -24,134 +24,13 @@ import tempfile
 
 # Make sure common is imported after fabric, because we override some functions.
 from common import *
-
-def extract_ubimg_files(path, outdir):
-    """Extract ubi image to a directory inside `outdir`. Returns path to a the
-    directory, where contents of each volume are in direct sub-directories.
-    Sub-directories are named after volumes.
-    """
-    subprocess.check_call("ubireader_extract_files -o {} {}".format(outdir, path),
-                          shell=True)
-    # extract to the following directories:
-    # /tmp/meta-mender-acceptance.xzkPVM/148052886/data
-    # /tmp/meta-mender-acceptance.xzkPVM/148052886/rootfsa
-    # /tmp/meta-mender-acceptance.xzkPVM/148052886/rootfsb
-    volumes_root = os.path.join(outdir, os.listdir(outdir)[0])
-    return volumes_root
-
-def extract_ubimg_images(path, outdir):
-    """Extract ubi image to a directory inside `outdir`. Returns path to a the
-    directory with each image, named after volumes.
-    """
-    subprocess.check_call("ubireader_extract_images -o {} {}".format(outdir, path),
-                          shell=True)
-    # extract to the following files:
-    # /tmp/tmpoJ1z_s/core-image-full-cmdline-vexpress-qemu-flash.ubimg/img-1823796814_vol-rootfsb.ubifs
-    # /tmp/tmpoJ1z_s/core-image-full-cmdline-vexpress-qemu-flash.ubimg/img-1823796814_vol-rootfsa.ubifs
-    # /tmp/tmpoJ1z_s/core-image-full-cmdline-vexpress-qemu-flash.ubimg/img-1823796814_vol-data.ubifs
-    volumes_root = os.path.join(outdir, os.listdir(outdir)[0])
-    return volumes_root
-
-
-def extract_ubimg_info(path):
-
-    output = subprocess.check_output("ubireader_utils_info -r {}".format(path), shell=True)
-
-    # Example output from ubireader_utils_info:
-    #
-    # Volume data
-    #     alignment       -a 1
-    #     default_compr   -x lzo
-    #     fanout          -f 8
-    #     image_seq       -Q 24735236
-    #     key_hash        -k r5
-    #     leb_size        -e 262016
-    #     log_lebs        -l 4
-    #     max_bud_bytes   -j 8388608
-    #     max_leb_cnt     -c 1024
-    #     min_io_size     -m 8
-    #     name            -N data
-    #     orph_lebs       -p 1
-    #     peb_size        -p 262144
-    #     sub_page_size   -s 64
-    #     version         -x 1
-    #     vid_hdr_offset  -O 64
-    #     vol_id          -n 2
-    #
-    #     #ubinize.ini#
-    #     [data]
-    #     vol_name=data
-    #     vol_size=17031040
-    #     vol_flags=0
-    #     vol_type=dynamic
-    #     vol_alignment=1
-    #     vol_id=2
-
-    data = {}
-    volume = None
-    ubinize = None
-
-    for line in output.split('\n'):
-        line = line.strip()
-        if not line:
-            continue
-
-        pieces = line.split()
-        # print("pieces", pieces, line)
-
-        if pieces[0] == 'Volume':
-            # reached 'Volume <volname>' banner
-
-            # save old volume information
-            if ubinize and volume:
-                volume['ubinize'] = ubinize
-            if volume:
-                data[volume['name']] = volume
-
-            # start new volume and ubinize
-            volume = {'name': pieces[1]}
-            ubinize = None
-
-        elif volume is not None:
-            # inside volume
-
-            if pieces[0] == '#ubinize.ini#':
-                # reached '#ubinize.ini#' banner
-                ubinize = {}
-
-            elif ubinize is not None:
-                # currently parsing ubninize.ini part
-
-                if pieces[0] == '[{}]'.format(volume['name']):
-                    # hit [<volname>] line
-                    continue
-
-                elif '=' in pieces[0]:
-                    param, val = pieces[0].split('=')
-                    ubinize[param] = val
-
-            else:
-                # currently parsing volume part
-                if len(pieces) == 3:
-                    volume[pieces[0]] = pieces[2]
-
-    # parsing finished
-
-    # save last parsed volume information
-    if ubinize and not 'ubinize' in volume:
-        volume['ubinize'] = ubinize
-    if volume and not volume['name'] in data:
-        data[volume['name']] = volume
-
-    # print('volume data:', data)
-    return data
-
+from ubi_image import UbiImage, UbifsImage
 
 @pytest.fixture(scope="session")
 def ubimg_without_uboot_env(request, latest_ubimg, prepared_test_build_base):
-    """The ubireader_utils_info tool and friends don't support our UBI volumes
-    that contain the U-Boot environment and hence not valid UBIFS structures.
-    Therefore, make a new temporary image that doesn't contain U-Boot."""
+    """The volume and size checks expect only the rootfs and data volumes, and
+    not the volumes containing the U-Boot environment. Therefore, make a new
+    temporary image that doesn't contain U-Boot."""
 
     # The tests are marked with "only_with_image('ubimg')", but that is checked
     # using a function fixture, and this is a session fixture, which cannot
@@ -213,11 +92,12 @@ class TestUbimg:
         """Test that ubimg has correnct number of volumes, each with correct size &
         config"""
 
-        ubinfo = extract_ubimg_info(ubimg_without_uboot_env)
+        with UbiImage(ubimg_without_uboot_env) as ubimg:
+            volumes = ubimg.volumes
 
         # we're expecting 3 volumes, rootfsa, rootfsb and data
-        assert len(ubinfo) == 3
-        assert all([volname in ubinfo for volname in ['rootfsa', 'rootfsb', 'data']])
+        assert len(volumes) == 3
+        assert all([volname in volumes for volname in ['rootfsa', 'rootfsb', 'data']])
 
         data_size = int(bitbake_variables['MENDER_DATA_PART_SIZE_MB']) * 1024 * 1024
         # rootfs size is in kB
@@ -225,27 +105,46 @@ class TestUbimg:
 
         # UBI adds overhead, so the actual volume size will be slightly more
         # than what requested. add 2% for overhead
-        assert int(ubinfo['data']['ubinize']['vol_size']) <= 1.02 * data_size
-        assert int(ubinfo['rootfsa']['ubinize']['vol_size']) <= 1.02 * rootfs_size
-        assert int(ubinfo['rootfsb']['ubinize']['vol_size']) <= 1.02 * rootfs_size
+        assert volumes['data'].size <= 1.02 * data_size
+        assert volumes['rootfsa'].size <= 1.02 * rootfs_size
+        assert volumes['rootfsb'].size <= 1.02 * rootfs_size
 
     def test_volume_contents(self, bitbake_variables, ubimg_without_uboot_env):
         """Test that data volume has correct contents"""
 
-        with make_tempdir() as tmpdir:
-            rootdir = extract_ubimg_files(ubimg_without_uboot_env, tmpdir)
-
-            assert os.path.exists(os.path.join(rootdir, 'rootfsa/usr/bin/mender'))
-            assert os.path.exists(os.path.join(rootdir, 'rootfsb/usr/bin/mender'))
+        with UbiImage(ubimg_without_uboot_env) as ubimg:
+            assert ubimg.volumes['rootfsa'].ubifs().exists('/usr/bin/mender')
+            assert ubimg.volumes['rootfsb'].ubifs().exists('/usr/bin/mender')
             # TODO: verify contents of data partition
 
+    def test_ubifs_max_leb_count(self, ubimg_without_uboot_env):
+        """Test that each UBIFS file system is sized for exactly the volume it
+        is in, so that it can use all of it without wasting space."""
+
+        with UbiImage(ubimg_without_uboot_env) as ubimg:
+            for name in ['rootfsa', 'rootfsb', 'data']:
+                volume = ubimg.volumes[name]
+                if not volume.leb_map:
+                    # Empty rootfsb, see MENDER_ROOTFS_PART_B_EMPTY.
+                    continue
+                assert volume.ubifs().superblock['max_leb_cnt'] == volume.reserved_pebs, name
+
+    def test_custom_mkubifs_args_apply_to_data(self, prepared_test_build):
+        """Test that a customized MKUBIFS_ARGS is still used for the data
+        partition, as long as MENDER_DATA_PART_FSOPTS is not set."""
+
+        add_to_local_conf(prepared_test_build,
+                          'MKUBIFS_ARGS = "-m ${MENDER_FLASH_MINIMUM_IO_UNIT} -e ${MENDER_UBI_LEB_SIZE} -c 4321"')
+        run_bitbake(prepared_test_build)
+
+        with UbiImage(latest_build_artifact(prepared_test_build['build_dir'], "*.ubimg")) as ubimg:
+            for name in ['rootfsa', 'data']:
+                assert ubimg.volumes[name].ubifs().superblock['max_leb_cnt'] == 4321, name
+
     @pytest.mark.min_yocto_version("warrior")
     def test_equal_checksum_ubimg_and_artifact(self, prepared_test_build):
         build_dir = prepared_test_build['build_dir']
 
-        # See ubimg_without_uboot_env() for why this is needed. We need to do it
-        # explicitly here because we need both the artifact and the ubimg.
-        add_to_local_conf(prepared_test_build, 'MENDER_FEATURES_DISABLE_append = " mender-uboot"')
         run_bitbake(prepared_test_build)
 
         bufsize = 1048576 # 1MiB
@@ -261,27 +160,21 @@ class TestUbimg:
                     break
                 hash.update(buf)
             artifact_hash = hash.hexdigest()
-            artifact_info = subprocess.check_output(["ubireader_display_info", tmp_artifact.name])
-            artifact_ls = subprocess.check_output(["ls", "-l", tmp_artifact.name])
+            with UbifsImage(tmp_artifact.name) as ubifs:
+                artifact_info = ubifs.superblock
 
-        tmpdir = tempfile.mkdtemp()
-        try:
-            ubifsdir = extract_ubimg_images(latest_build_artifact(build_dir, "*.ubimg"), tmpdir)
-            rootfsa = os.path.join(ubifsdir, [img for img in os.listdir(ubifsdir) if "rootfsa" in img][0])
+        # The volume is streamed straight from the ubimg, the volumes
+        # containing the U-Boot environment are simply not looked at.
+        with UbiImage(latest_build_artifact(build_dir, "*.ubimg")) as ubimg:
+            rootfsa = ubimg.volumes['rootfsa']
             bytes_read = 0
             hash = hashlib.md5()
-            with open(rootfsa) as fd:
-                while bytes_read < size:
-                    buf = fd.read(min(size - bytes_read, bufsize))
-                    if len(buf) == 0:
-                        break
-                    bytes_read += len(buf)
-                    hash.update(buf)
-                image_hash = hash.hexdigest()
-            image_info = subprocess.check_output(["ubireader_display_info", rootfsa])
-            image_ls = subprocess.check_output(["ls", "-l", rootfsa])
-        finally:
-            shutil.rmtree(tmpdir)
+            for buf in rootfsa.chunks(size):
+                bytes_read += len(buf)
+                hash.update(buf)
+            image_hash = hash.hexdigest()
+            image_info = rootfsa.ubifs().superblock
 
         assert artifact_info == image_info
-        assert artifact_hash == image_hash, "Artifact:\n%s\nImage:\n%s" % (artifact_ls, image_ls)
+        assert artifact_hash == image_hash, "Artifact: %d bytes, image: %d bytes read from volume of %d bytes" \
+            % (size, bytes_read, rootfsa.size)
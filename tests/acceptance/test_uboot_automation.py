@@ -14,47 +14,71 @@
 #    limitations under the License.
 
 import copy
-import math
 import multiprocessing
 import os
 import re
 import shutil
 import subprocess
+import time
 
 # Make sure common is imported after fabric, because we override some functions.
 from common import *
 
+import uboot_boards
+import uboot_results
+import uboot_scheduler
+from ext4_image import Ext4Image
+
 @pytest.mark.only_with_distro_feature('mender-uboot')
 class TestUbootAutomation:
     @staticmethod
     def parallel_job_count():
-        # Due to our extensive copying of sources, we are constrained by both
-        # I/O and CPU during compiling. Therefore we use the RAM disk to to
-        # store the temporary sources. So pick a parallel job number that
-        # doesn't exhaust neither memory nor CPU.
-
-        # Rough estimate, we assume that each source directory needs
-        # approximately 1G, and that we can use half of the memory for that.
-        with open("/proc/meminfo") as fd:
-            for line in fd.readlines():
-                match = re.match("^MemTotal:\s+([0-9]+)\s*kB", line)
-                if match:
-                    memory_kb = int(match.group(1))
-                    break
-        memory_jobs = int(memory_kb / 2 / 1048576)
-
-        return min(memory_jobs, multiprocessing.cpu_count())
+        # The upper limit of boards to run in parallel. The scheduler adjusts
+        # the actual number to the memory and CPU pressure while running.
+        return multiprocessing.cpu_count()
+
+    @staticmethod
+    def board_log_complete(log):
+        # Makefile.test_uboot_automation finishes every log with the wall time
+        # of the board. Logs without it are left over from an interrupted run.
+        with open(log) as fd:
+            return any(line.startswith("BoardWallTime: ") for line in fd)
 
     @staticmethod
-    def parallel_subjob_count():
-        # Since memory can be the constraining factor on number of parallel
-        # build directories (see comment for parallel_job_count), we should make
-        # sure that each build directory uses enough cores to utilize all cores
-        # total.
-        job_count = TestUbootAutomation.parallel_job_count()
-        cpu_count = multiprocessing.cpu_count()
-        # Pick the smallest number that makes NUMBER * job_count >= cpu_count
-        return int(math.ceil(float(cpu_count) / float(job_count)))
+    def ccache_stats(env):
+        # Returns (hits, misses) of the compiler cache, or None if there is no
+        # compiler cache.
+        try:
+            output = subprocess.check_output(["ccache", "--print-stats"], env=env)
+            stats = dict([line.split("\t", 1) for line in output.decode().splitlines() if "\t" in line])
+            return (int(stats.get("direct_cache_hit", 0)) + int(stats.get("preprocessed_cache_hit", 0)),
+                    int(stats.get("cache_miss", 0)))
+        except OSError:
+            return None
+        except subprocess.CalledProcessError:
+            # Older ccache, without --print-stats.
+            pass
+
+        output = subprocess.check_output(["ccache", "-s"], env=env).decode()
+        counts = []
+        for stat in ["cache hit \\(direct\\)", "cache hit \\(preprocessed\\)", "cache miss"]:
+            match = re.search("^%s\\s+([0-9]+)" % stat, output, re.MULTILINE)
+            counts.append(int(match.group(1)) if match else 0)
+        return (counts[0] + counts[1], counts[2])
+
+    @staticmethod
+    def report_board_times(results, history):
+        # Print the wall time of each board, as recorded by
+        # Makefile.test_uboot_automation, the slowest first, together with the
+        # peak RSS recorded by the scheduler.
+        times = sorted([(wall_time, defconfig) for defconfig, (_, wall_time, _) in results.items()
+                        if wall_time is not None], reverse=True)
+        if not times:
+            return
+        print("Per-board wall time (%d boards, %d seconds total, %.1f seconds on average):"
+              % (len(times), sum([t for t, _ in times]), float(sum([t for t, _ in times])) / len(times)))
+        for seconds, defconfig in times:
+            print("  %5d s  %7d MiB  %s" % (seconds, history.peak_rss_kb(defconfig) // 1024, defconfig))
 
     def check_if_should_run(self):
         # The logic here is this:
@@ -131,68 +155,44 @@ class TestUbootAutomation:
         print(msg)
         pytest.skip(msg)
 
-    def board_not_arm(self, bitbake_variables, config):
+    def board_not_arm(self, board_index, config):
         if config in ["xilinx_versal_virt_defconfig"]:
             # u-boot-v2019.01: There is some weird infinite loop in the conf
             # script of this particular board. Just mark it as "not ARM", which
             # will cause it to be skipped.
             return True
 
-        with open(os.path.join(bitbake_variables['S'], "configs", config)) as fd:
-            for line in fd.readlines():
-                line = line.strip()
-                if line.startswith("CONFIG_TARGET_") and line.endswith("=y"):
-                    # Extract target name.
-                    target = line.split("=", 2)[0]
-                    # Remove "CONFIG_" prefix.
-                    target = target[len("CONFIG_"):]
-                    break
-            else:
-                # We don't know, so we return that it's not definitely not ARM
-                # (yes, double negatives...)
-                return False
+        archs = uboot_boards.target_archs(board_index, config)
+        if archs is None:
+            # We don't know, so we return that it's not definitely not ARM
+            # (yes, double negatives...)
+            return False
 
-        # Look for that config value inside Kconfig files that are not in arm
-        # directory.
-        for walk in os.walk(os.path.join(bitbake_variables['S'], "arch"), topdown=True):
-            walk[1][:] = [dir for dir in walk[1] if dir != "arm"]
-
-            walk[2][:] = [file for file in walk[2] if file == "Kconfig"]
-
-            for file in walk[2]:
-                with open(os.path.join(walk[0], file)) as fd:
-                    if re.search("^config *%s *$" % target, fd.read(), re.MULTILINE):
-                        # Found the target in a non-arm directory. This is not
-                        # an ARM board.
-                        return True
-
-        return False
+        # If the target is defined inside Kconfig files that are not in the arm
+        # directory, this is not an ARM board.
+        return any([arch != "arm" for arch in archs])
 
     def collect_and_prepare_boards_to_test(self, bitbake_variables, env):
         # Find all the boards we need to test for the configuration in question.
         # For vexpress-qemu, we test all SD-based boards, for vexpress-qemu-flash
         # we test all Flash based boards.
         machine = bitbake_variables["MACHINE"]
-        available_configs = sorted(os.listdir(os.path.join(bitbake_variables['S'], "configs")))
-        configs_to_test = []
-        for config in available_configs:
-            if not config.endswith("_defconfig"):
-                continue
 
-            if self.board_not_arm(bitbake_variables, config):
+        # The index is kept in the work directory of U-Boot, and is reused
+        # until the U-Boot sources change.
+        start = time.time()
+        board_index = uboot_boards.load_index(bitbake_variables['S'],
+                                              os.path.join(bitbake_variables['WORKDIR'],
+                                                           "test_uboot_compile-index.json"))
+        print("Indexed %d boards in %.1f seconds." % (len(board_index["defconfigs"]),
+                                                      time.time() - start))
+
+        configs_to_test = []
+        for config in sorted(board_index["defconfigs"].keys()):
+            if self.board_not_arm(board_index, config):
                 continue
 
-            mtdids = None
-            mtdparts = None
-            with open(os.path.join(bitbake_variables['S'], "configs", config)) as fd:
-                for line in fd.readlines():
-                    line = line.strip()
-                    if line.startswith("CONFIG_MTDPARTS_DEFAULT="):
-                        mtdparts = line.split("=", 2)[1]
-                    elif line.startswith("CONFIG_MTDIDS_DEFAULT="):
-                        mtdids = line.split("=", 2)[1]
-
-            if mtdparts:
+            if board_index["defconfigs"][config]["mtdparts"]:
                 # Assume Flash board.
 
                 if machine != "vexpress-qemu-flash":
@@ -231,14 +231,23 @@ class TestUbootAutomation:
                                   shell=True)
         bitbake_variables = get_bitbake_variables("u-boot")
 
-        shutil.rmtree("/dev/shm/test_uboot_compile", ignore_errors=True)
+        # The per-board source trees are hard linked to the U-Boot sources, so
+        # they need to be on the same file system.
+        tmp_dir = os.path.join(bitbake_variables['WORKDIR'], "test_uboot_compile")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
 
         env = copy.copy(os.environ)
         env['UBOOT_SRC'] = bitbake_variables['S']
+        # Compiler cache shared by all boards. It is kept between runs, and the
+        # paths of the per-board trees are made relative so that boards can
+        # share results.
+        env['CCACHE_DIR'] = os.path.join(bitbake_variables['WORKDIR'], "test_uboot_compile-ccache")
+        env['CCACHE_BASEDIR'] = tmp_dir
+        env['CCACHE_NOHASHDIR'] = "1"
         env['TESTS_DIR'] = os.getcwd()
         env['LOGS'] = os.path.join(os.getcwd(), "test_uboot_compile-logs")
         if os.path.exists(env['LOGS']):
-            print("WARNING: %s already exists. Will use cached logs from there. Recreate to reset." % env['LOGS'])
+            print("WARNING: %s already exists. Will resume boards that were interrupted from there. Recreate to reset." % env['LOGS'])
         else:
             os.mkdir(env['LOGS'])
 
@@ -246,38 +255,77 @@ class TestUbootAutomation:
 
         env['BOARD_LOGS'] = " ".join(configs_to_test)
 
+        store = None
         try:
             sanitized_makeflags = bitbake_variables['EXTRA_OEMAKE']
             sanitized_makeflags = sanitized_makeflags.replace("\\\"", "\"")
             sanitized_makeflags = re.sub(" +", " ", sanitized_makeflags)
             env['MAYBE_UBI'] = "--ubi" if machine == "vexpress-qemu-flash" else ""
-            # Compile all boards. The reason for using a makefile is to get easy
-            # parallelization.
-            subprocess.check_call("make -j %d -f %s SUBJOBCOUNT=-j%d TMP=/dev/shm/test_uboot_compile %s"
-                                  % (self.parallel_job_count(),
-                                     os.path.join(env['TESTS_DIR'],
-                                                  "files/Makefile.test_uboot_automation"),
-                                     self.parallel_subjob_count(),
-                                     sanitized_makeflags),
-                                  shell=True,
-                                  env=env,
-                                  stderr=subprocess.STDOUT)
+            if self.ccache_stats(env) is not None:
+                subprocess.check_call(["ccache", "-z"], env=env)
+
+            makefile = os.path.join(env['TESTS_DIR'], "files/Makefile.test_uboot_automation")
+            uboot_recipe_dir = os.path.join(env['TESTS_DIR'], "../../meta-mender-core/recipes-bsp/u-boot")
+
+            # Results are kept between runs, so that only boards whose inputs
+            # have changed are tested again.
+            store = uboot_results.ResultStore(
+                os.path.join(os.environ['BUILDDIR'], "test_uboot_compile-results.sqlite"),
+                uboot_results.source_revision(bitbake_variables['S']),
+                uboot_results.inputs_hash(bitbake_variables['S'],
+                                          [makefile,
+                                           os.path.join(uboot_recipe_dir, "files"),
+                                           os.path.join(uboot_recipe_dir, "patches")],
+                                          [machine, env['MAYBE_UBI'], sanitized_makeflags]))
+
+            def record(defconfig, log):
+                store.record_log(defconfig, log)
+                os.remove(log)
+
+            # Compile all boards that don't have results yet. Boards which were
+            # completed by an earlier, interrupted run are not run again.
+            jobs = []
+            for log in configs_to_test:
+                defconfig = os.path.basename(log)
+                if store.has_result(defconfig):
+                    continue
+                if os.path.exists(log):
+                    if self.board_log_complete(log):
+                        record(defconfig, log)
+                        continue
+                    os.remove(log)
+                command = (lambda subjobs, log=log:
+                           "make -f %s SUBJOBCOUNT=-j%d TMP=%s %s %s"
+                           % (makefile, subjobs, tmp_dir, sanitized_makeflags, log))
+                jobs.append(uboot_scheduler.BoardJob(defconfig, command, output=log,
+                                                     done=lambda defconfig=defconfig, log=log:
+                                                     record(defconfig, log)))
+            print("%d of %d boards have results from earlier runs, testing the remaining %d."
+                  % (len(configs_to_test) - len(jobs), len(configs_to_test), len(jobs)))
+            scheduler = uboot_scheduler.AdaptiveScheduler(
+                self.parallel_job_count(),
+                history_file=os.path.join(bitbake_variables['WORKDIR'],
+                                          "test_uboot_compile-history.json"),
+                env=env)
+            scheduler.run(jobs)
+
+            results = store.results([os.path.basename(log) for log in configs_to_test])
+
+            self.report_board_times(results, scheduler.history)
+            stats = self.ccache_stats(env)
+            if stats is None:
+                print("No compiler cache available.")
+            elif stats[0] + stats[1] > 0:
+                print("Compiler cache hit rate: %.1f%% (%d hits, %d misses)"
+                      % (100.0 * stats[0] / (stats[0] + stats[1]), stats[0], stats[1]))
 
             # Now check that the ratio of compiled boards is as expected. This
             # number may change over time as U-Boot changes, but big discrepancies
             # should be checked out.
-            failed = 0.0
-            total = 0.0
-            for file in os.listdir(env['LOGS']):
-                if not file.endswith("_defconfig"):
-                    continue
-
-                total += 1
-                with open(os.path.join(env['LOGS'], file)) as fd:
-                    if "AutoPatchFailed\n" in fd.readlines():
-                        failed += 1
+            total = float(len(results))
+            failed = float(len([result for result in results.values() if result[0]]))
 
-            assert total == len(configs_to_test), "Number of logs do not match the number of boards we tested? Should not happen"
+            assert total == len(configs_to_test), "Number of results do not match the number of boards we tested? Should not happen"
 
             if machine == "vexpress-qemu":
                 # PLEASE UPDATE the version you used to find this number if you update it.
@@ -297,18 +345,19 @@ class TestUbootAutomation:
                 assert failed / total >= lower_bound, "Less boards failed than expected. Good? Or a mistake somewhere? Failed: %d, Total: %d" % (failed, total)
                 assert failed / total <= upper_bound, "More boards failed than expected. Failed: %d, Total: %d" % (failed, total)
             except AssertionError:
-                for file in os.listdir(env['LOGS']):
-                    with open(os.path.join(env['LOGS'], file)) as fd:
-                        log = fd.readlines()
-                        if "AutoPatchFailed\n" in log:
-                            print("Last 50 lines of output from failed board: " + file)
-                            print("".join(log[-50:]))
+                for defconfig, (board_failed, _, tail) in sorted(results.items()):
+                    if board_failed:
+                        print("Last %d lines of output from failed board: %s"
+                              % (uboot_results.LOG_TAIL_LINES, defconfig))
+                        print(tail)
                 raise
 
             shutil.rmtree(env['LOGS'])
 
         finally:
-            shutil.rmtree("/dev/shm/test_uboot_compile", ignore_errors=True)
+            if store is not None:
+                store.close()
+            shutil.rmtree(tmp_dir, ignore_errors=True)
 
     @pytest.mark.only_with_image('sdimg')
     @pytest.mark.min_mender_version('1.0.0')
@@ -316,14 +365,10 @@ class TestUbootAutomation:
         """Test that we can provide our own custom U-Boot provider, and that
         this will trigger auto provision of the corresponding fw-utils."""
 
-        subprocess.check_call(["debugfs", "-R", "dump /sbin/fw_setenv fw_setenv.tmp", latest_rootfs])
-
-        try:
-            with open("fw_setenv.tmp") as fd:
-                # The vanilla version should not have our custom string.
-                assert "TestStringThatMustOccur_Mender!#%&" not in fd.read(), "fw_setenv.tmp contains unexpected substring"
-        finally:
-            os.unlink("fw_setenv.tmp")
+        with Ext4Image(latest_rootfs) as fs:
+            # The vanilla version should not have our custom string.
+            assert b"TestStringThatMustOccur_Mender!#%&" not in fs.read("/sbin/fw_setenv"), \
+                "fw_setenv contains unexpected substring"
 
         # Get rid of build outputs in deploy directory that may get in the way.
         run_bitbake(prepared_test_build, "-c clean u-boot")
@@ -333,16 +378,12 @@ class TestUbootAutomation:
             run_bitbake(prepared_test_build)
 
             new_rootfs = latest_build_artifact(prepared_test_build['build_dir'], "core-image*.ext[234]")
-            subprocess.check_call(["debugfs", "-R", "dump /sbin/fw_setenv fw_setenv.tmp", new_rootfs])
-
-            try:
-                with open("fw_setenv.tmp") as fd:
-                    # If we selected u-boot-testing as the U-Boot provider, fw-utils
-                    # should have followed and should also contain the special
-                    # substring which that version is patched with.
-                    assert "TestStringThatMustOccur_Mender!#%&" in fd.read(), "fw_setenv.tmp does not contain expected substring"
-            finally:
-                os.unlink("fw_setenv.tmp")
+            with Ext4Image(new_rootfs) as fs:
+                # If we selected u-boot-testing as the U-Boot provider, fw-utils
+                # should have followed and should also contain the special
+                # substring which that version is patched with.
+                assert b"TestStringThatMustOccur_Mender!#%&" in fs.read("/sbin/fw_setenv"), \
+                    "fw_setenv does not contain expected substring"
         finally:
             # Get rid of build outputs in deploy directory that may get in the
             # way.
@@ -407,6 +448,41 @@ class TestUbootAutomation:
             run_bitbake(prepared_test_build, "-c clean u-boot")
             os.unlink(new_patch_name)
 
+    @pytest.mark.min_mender_version('1.0.0')
+    def test_auto_configure_cache(self, prepared_test_build):
+        """Test that a second build of U-Boot takes the auto-configured patch
+        from the cache, and that the result still passes
+        do_check_mender_defines."""
+
+        bitbake_variables = get_bitbake_variables("u-boot", env_setup=prepared_test_build['env_setup'])
+
+        # Only run if auto-configuration is on.
+        if bitbake_variables['MENDER_UBOOT_AUTO_CONFIGURE'] == "0":
+            pytest.skip("Test is not applicable when MENDER_UBOOT_AUTO_CONFIGURE is off")
+
+        cache_dir = tempfile.mkdtemp()
+        log = os.path.join(bitbake_variables['WORKDIR'], "temp", "log.do_mender_uboot_auto_configure")
+        try:
+            add_to_local_conf(prepared_test_build, 'MENDER_UBOOT_AUTO_CONFIGURE_CACHE_DIR = "%s"' % cache_dir)
+
+            for attempt in ["miss", "hit"]:
+                run_bitbake(prepared_test_build, "-c clean u-boot")
+                # Fails if the patch does not provide the Mender defines.
+                run_bitbake(prepared_test_build, "-c check_mender_defines u-boot")
+
+                patches = []
+                for dirpath, _, filenames in os.walk(cache_dir):
+                    patches += [os.path.join(dirpath, name) for name in filenames]
+                assert len(patches) == 1 and patches[0].endswith(".patch"), patches
+
+                with open(log) as fd:
+                    hit = "Applying cached auto-configured U-Boot patch" in fd.read()
+                assert hit == (attempt == "hit"), "Expected a cache %s" % attempt
+
+        finally:
+            run_bitbake(prepared_test_build, "-c clean u-boot")
+            shutil.rmtree(cache_dir)
+
     # Would be nice to test this with non-UBI, but we don't currently have any
     # non-boolean values inside Kconfig that we can test for. Boolean settings
     # can't be tested because of the limitations listed in
@@ -0,0 +1,569 @@
+#!/usr/bin/python
+# Copyright 2019 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Reader for UBI images, as made by ubinize, and the UBIFS file systems inside
+# them, or in images made by mkfs.ubifs.
+#
+# The image is mapped into memory, and only the parts needed to answer a query
+# are read: the EC and VID headers of each PEB and the volume table when the
+# image is opened, the LEBs of a volume when it is streamed, and the index
+# nodes on the way to a file when it is looked up. Only the committed UBIFS
+# index is used, which is everything there is in an image which hasn't been
+# mounted.
+
+import mmap
+import struct
+import zlib
+
+from bytestr import to_bytes, to_str
+
+try:
+    import lzo
+except ImportError:
+    lzo = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+UBI_EC_HDR_MAGIC = 0x55424923
+UBI_VID_HDR_MAGIC = 0x55424921
+UBI_LAYOUT_VOLUME_ID = 0x7fffefff
+UBI_MAX_VOLUMES = 128
+
+_EC_HDR = struct.Struct(">IB3xQIII32xI")
+_VID_HDR = struct.Struct(">IBBBBII4xIIII4xQ12xI")
+_VTBL_RECORD = struct.Struct(">IIIBBH128sB23xI")
+
+VOLUME_TYPES = {1: "dynamic", 2: "static"}
+
+UBIFS_NODE_MAGIC = 0x06101831
+UBIFS_ROOT_INO = 1
+UBIFS_BLOCK_SIZE = 4096
+
+UBIFS_INO_NODE = 0
+UBIFS_DATA_NODE = 1
+UBIFS_DENT_NODE = 2
+UBIFS_SB_NODE = 6
+UBIFS_MST_NODE = 7
+UBIFS_IDX_NODE = 9
+
+UBIFS_INO_KEY = 0
+UBIFS_DATA_KEY = 1
+UBIFS_DENT_KEY = 2
+
+UBIFS_KEY_HASH_R5 = 0
+UBIFS_KEY_HASH_TEST = 1
+
+UBIFS_COMPR_NONE = 0
+UBIFS_COMPR_LZO = 1
+UBIFS_COMPR_ZLIB = 2
+UBIFS_COMPR_ZSTD = 3
+
+UBIFS_ITYPE_DIR = 1
+UBIFS_ITYPE_LNK = 2
+
+_S_KEY_BLOCK_BITS = 29
+_S_KEY_HASH_MASK = (1 << _S_KEY_BLOCK_BITS) - 1
+
+_CH = struct.Struct("<IIQIBB2x")
+_SB_NODE = struct.Struct("<2xBBIIIIIQIIIIIIIH2xIIQI16sI")
+_MST_NODE = struct.Struct("<QQIIIII")
+_IDX_NODE = struct.Struct("<HH")
+_BRANCH = struct.Struct("<IIIII")
+_KEY = struct.Struct("<II")
+_INO_NODE = struct.Struct("<QQQQQIIIIIIIII")
+_DENT_NODE = struct.Struct("<QxBHI")
+_DATA_NODE = struct.Struct("<IHH")
+
+_SB_FIELDS = ["key_hash", "key_fmt", "flags", "min_io_size", "leb_size", "leb_cnt",
+              "max_leb_cnt", "max_bud_bytes", "log_lebs", "lpt_lebs", "orph_lebs",
+              "jhead_cnt", "fanout", "lsave_cnt", "fmt_version", "default_compr",
+              "rp_uid", "rp_gid", "rp_size", "time_gran", "uuid", "ro_compat_version"]
+
+MAX_SYMLINKS = 40
+
+
+class UbiError(Exception):
+    pass
+
+
+def _crc(data):
+    # Both UBI and UBIFS use CRC32 with an initial value of 0xFFFFFFFF and no
+    # final inversion.
+    return (zlib.crc32(data) & 0xffffffff) ^ 0xffffffff
+
+
+class UbiVolume(object):
+    """A volume in a UBI image. size is the size reserved for the volume, as
+    given to ubinize in vol_size, rounded up to whole LEBs. leb_map maps each
+    mapped LEB to the offset of the PEB holding it."""
+
+    def __init__(self, image, vol_id, record):
+        reserved_pebs, alignment, data_pad, vol_type, upd_marker, name_len, name, flags, crc \
+            = record
+        self.image = image
+        self.vol_id = vol_id
+        self.name = name[:name_len].decode("utf-8")
+        self.reserved_pebs = reserved_pebs
+        self.alignment = alignment
+        self.data_pad = data_pad
+        self.type = VOLUME_TYPES.get(vol_type, str(vol_type))
+        self.flags = flags
+        self.leb_size = image.leb_size - data_pad
+        self.size = reserved_pebs * image.leb_size
+        self.leb_map = {}
+        self._data_size = {}
+
+    def _map(self, lnum, offset, data_size):
+        self.leb_map[lnum] = offset
+        self._data_size[lnum] = data_size
+
+    def read(self, lnum, offs=0, length=None):
+        """Returns length bytes from offs in LEB lnum. Unmapped LEBs read as
+        erased flash."""
+
+        if length is None:
+            length = self.leb_length(lnum) - offs
+        if lnum not in self.leb_map:
+            return b"\xff" * length
+        start = self.leb_map[lnum] + self.image.data_offset + offs
+        data = self.image.mmap[start:start + length]
+        if len(data) < length:
+            data += b"\xff" * (length - len(data))
+        return data
+
+    def leb_length(self, lnum):
+        if self.type == "static" and lnum in self._data_size:
+            return self._data_size[lnum]
+        return self.leb_size
+
+    def chunks(self, limit=None):
+        """Yields the contents of the volume, one LEB at a time, up to the
+        last mapped LEB, or until limit bytes have been returned. This is the
+        same as the image extracted by ubireader_extract_images."""
+
+        if not self.leb_map:
+            return
+        remaining = limit
+        for lnum in range(max(self.leb_map) + 1):
+            length = self.leb_length(lnum)
+            if remaining is not None:
+                if remaining <= 0:
+                    return
+                length = min(length, remaining)
+                remaining -= length
+            yield self.read(lnum, 0, length)
+
+    def ubifs(self):
+        """Returns the UBIFS file system in the volume."""
+
+        return Ubifs(self.read)
+
+
+class UbiImage(object):
+    """A UBI image, as made by ubinize. The PEB size is not stored in the
+    image, so if it is not given, it is found by looking for the second EC
+    header. volumes maps volume names to UbiVolume objects."""
+
+    def __init__(self, path, peb_size=None):
+        self.path = path
+        self._fd = open(path, "rb")
+        try:
+            self.mmap = mmap.mmap(self._fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._fd.close()
+            raise
+        try:
+            self._scan(peb_size)
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        self._fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _ec_hdr(self, offset):
+        if offset + _EC_HDR.size > len(self.mmap):
+            return None
+        hdr = _EC_HDR.unpack_from(self.mmap, offset)
+        if hdr[0] != UBI_EC_HDR_MAGIC:
+            return None
+        if _crc(self.mmap[offset:offset + _EC_HDR.size - 4]) != hdr[-1]:
+            return None
+        return hdr
+
+    def _vid_hdr(self, offset):
+        if offset + _VID_HDR.size > len(self.mmap):
+            return None
+        hdr = _VID_HDR.unpack_from(self.mmap, offset)
+        if hdr[0] != UBI_VID_HDR_MAGIC:
+            return None
+        if _crc(self.mmap[offset:offset + _VID_HDR.size - 4]) != hdr[-1]:
+            return None
+        return hdr
+
+    def _guess_peb_size(self):
+        size = 1
+        while size < self.data_offset:
+            size *= 2
+        while size < len(self.mmap):
+            hdr = self._ec_hdr(size)
+            if hdr is not None and hdr[5] == self.image_seq:
+                return size
+            size *= 2
+        # Only one PEB.
+        return len(self.mmap)
+
+    def _scan(self, peb_size):
+        hdr = self._ec_hdr(0)
+        if hdr is None:
+            raise UbiError("%s: No UBI erase counter header at the start of the image" % self.path)
+        self.version = hdr[1]
+        self.vid_hdr_offset = hdr[3]
+        self.data_offset = hdr[4]
+        self.image_seq = hdr[5]
+        self.peb_size = peb_size or self._guess_peb_size()
+        self.leb_size = self.peb_size - self.data_offset
+
+        # (vol_id, lnum) -> (sqnum, offset, data_size) of the newest copy.
+        lebs = {}
+        for offset in range(0, len(self.mmap), self.peb_size):
+            if self._ec_hdr(offset) is None:
+                continue
+            vid = self._vid_hdr(offset + self.vid_hdr_offset)
+            if vid is None:
+                # Erased PEB.
+                continue
+            vol_id, lnum, data_size, sqnum = vid[5], vid[6], vid[7], vid[11]
+            if (vol_id, lnum) not in lebs or lebs[(vol_id, lnum)][0] < sqnum:
+                lebs[(vol_id, lnum)] = (sqnum, offset, data_size)
+
+        layout = None
+        for lnum in [0, 1]:
+            if (UBI_LAYOUT_VOLUME_ID, lnum) in lebs:
+                layout = lebs[(UBI_LAYOUT_VOLUME_ID, lnum)][1] + self.data_offset
+                break
+        if layout is None:
+            raise UbiError("%s: No volume table found" % self.path)
+
+        self.volumes = {}
+        by_id = {}
+        records = min(UBI_MAX_VOLUMES, self.leb_size // _VTBL_RECORD.size)
+        for vol_id in range(records):
+            offset = layout + vol_id * _VTBL_RECORD.size
+            record = _VTBL_RECORD.unpack_from(self.mmap, offset)
+            if record[0] == 0 or record[5] == 0:
+                continue
+            if _crc(self.mmap[offset:offset + _VTBL_RECORD.size - 4]) != record[-1]:
+                raise UbiError("%s: Bad CRC in volume table record %d" % (self.path, vol_id))
+            volume = UbiVolume(self, vol_id, record)
+            self.volumes[volume.name] = volume
+            by_id[vol_id] = volume
+
+        for (vol_id, lnum), (sqnum, offset, data_size) in lebs.items():
+            if vol_id in by_id:
+                by_id[vol_id]._map(lnum, offset, data_size)
+
+
+def _key_mask_hash(value):
+    value &= _S_KEY_HASH_MASK
+    if value <= 2:
+        # 0, 1 and 2 are reserved for "." and "..".
+        value += 3
+    return value
+
+
+def _key_r5_hash(name):
+    value = 0
+    for byte in bytearray(name):
+        # The kernel works on signed chars.
+        if byte >= 0x80:
+            byte -= 0x100
+        value = (value + (byte << 4)) & 0xffffffff
+        value = (value + (byte >> 4)) & 0xffffffff
+        value = (value * 11) & 0xffffffff
+    return _key_mask_hash(value)
+
+
+def _key_test_hash(name):
+    value = struct.unpack("<I", (name[:4] + b"\0\0\0\0")[:4])[0]
+    return _key_mask_hash(value)
+
+
+class UbifsInode(object):
+    """An inode in a UBIFS file system. mode is the full st_mode, and target
+    the target of a symbolic link."""
+
+    def __init__(self, inum, node):
+        fields = _INO_NODE.unpack_from(node, _CH.size + 16)
+        self.inum = inum
+        self.size = fields[1]
+        self.nlink = fields[8]
+        self.uid = fields[9]
+        self.gid = fields[10]
+        self.mode = fields[11]
+        data_len = fields[13]
+        self.target = node[160:160 + data_len] if self.is_link() else None
+
+    def is_dir(self):
+        return (self.mode & 0o170000) == 0o040000
+
+    def is_link(self):
+        return (self.mode & 0o170000) == 0o120000
+
+
+class Ubifs(object):
+    """A UBIFS file system. read is a function taking an LEB number, an offset
+    and a length, and returning those bytes of the LEB."""
+
+    def __init__(self, read):
+        self._read = read
+        self.superblock = self._superblock()
+        if self.superblock["key_hash"] == UBIFS_KEY_HASH_R5:
+            self._hash = _key_r5_hash
+        elif self.superblock["key_hash"] == UBIFS_KEY_HASH_TEST:
+            self._hash = _key_test_hash
+        else:
+            raise UbiError("Unsupported UBIFS key hash %d" % self.superblock["key_hash"])
+        self._root = self._master()
+
+    def _node(self, lnum, offs):
+        # Reads the node at offs in LEB lnum, and returns (type, node).
+        ch = _CH.unpack(self._read(lnum, offs, _CH.size))
+        magic, crc, sqnum, node_len, node_type = ch[:5]
+        if magic != UBIFS_NODE_MAGIC:
+            raise UbiError("No UBIFS node at LEB %d, offset %d" % (lnum, offs))
+        node = self._read(lnum, offs, node_len)
+        if _crc(node[8:]) != crc:
+            raise UbiError("Bad CRC in UBIFS node at LEB %d, offset %d" % (lnum, offs))
+        return node_type, node
+
+    def _superblock(self):
+        node_type, node = self._node(0, 0)
+        if node_type != UBIFS_SB_NODE:
+            raise UbiError("No UBIFS superblock")
+        superblock = dict(zip(_SB_FIELDS, _SB_NODE.unpack_from(node, _CH.size)))
+        if superblock["key_fmt"] != 0:
+            raise UbiError("Unsupported UBIFS key format %d" % superblock["key_fmt"])
+        return superblock
+
+    def _master(self):
+        # Every commit appends a master node to both master LEBs, the newest
+        # one is the one in use.
+        leb_size = self.superblock["leb_size"]
+        best = None
+        for lnum in [1, 2]:
+            data = self._read(lnum, 0, leb_size)
+            offs = data.find(struct.pack("<I", UBIFS_NODE_MAGIC))
+            while offs >= 0:
+                try:
+                    node_type, node = self._node(lnum, offs)
+                except (UbiError, struct.error):
+                    node_type = None
+                if node_type == UBIFS_MST_NODE:
+                    sqnum = _CH.unpack_from(node)[2]
+                    if best is None or best[0] < sqnum:
+                        best = (sqnum, node)
+                offs = data.find(struct.pack("<I", UBIFS_NODE_MAGIC), offs + 1)
+        if best is None:
+            raise UbiError("No UBIFS master node")
+        fields = _MST_NODE.unpack_from(best[1], _CH.size)
+        # root_lnum, root_offs
+        return fields[4], fields[5]
+
+    def _scan(self, low, high):
+        # Yields the leaf nodes with low <= key <= high, in key order. Keys
+        # are (inum, type << 29 | hash or block number). Equal keys may be
+        # spread over several branches when names collide, so all branches
+        # which can contain the range are followed.
+        stack = [self._root]
+        while stack:
+            lnum, offs = stack.pop()
+            node_type, node = self._node(lnum, offs)
+            if node_type != UBIFS_IDX_NODE:
+                key = _KEY.unpack_from(node, _CH.size)
+                if low <= key <= high:
+                    yield node_type, key, node
+                continue
+            child_cnt, level = _IDX_NODE.unpack_from(node, _CH.size)
+            branches = [_BRANCH.unpack_from(node, _CH.size + _IDX_NODE.size + i * _BRANCH.size)
+                        for i in range(child_cnt)]
+            children = []
+            for i, (b_lnum, b_offs, b_len, inum, key2) in enumerate(branches):
+                if (inum, key2) > high:
+                    break
+                if i + 1 < child_cnt and (branches[i + 1][3], branches[i + 1][4]) < low:
+                    continue
+                children.append((b_lnum, b_offs))
+            # Depth first, in key order.
+            stack.extend(reversed(children))
+
+    def inode(self, inum):
+        key = (inum, UBIFS_INO_KEY << _S_KEY_BLOCK_BITS)
+        for node_type, node_key, node in self._scan(key, key):
+            if node_type == UBIFS_INO_NODE:
+                return UbifsInode(inum, node)
+        return None
+
+    def _entries(self, inum, name=None):
+        # Yields (name, inum, type) of the directory entries of inum, or only
+        # of the entry called name.
+        if name is None:
+            low = (inum, UBIFS_DENT_KEY << _S_KEY_BLOCK_BITS)
+            high = (inum, (UBIFS_DENT_KEY << _S_KEY_BLOCK_BITS) | _S_KEY_HASH_MASK)
+        else:
+            low = high = (inum, (UBIFS_DENT_KEY << _S_KEY_BLOCK_BITS) | self._hash(name))
+        for node_type, key, node in self._scan(low, high):
+            if node_type != UBIFS_DENT_NODE:
+                continue
+            target, itype, nlen, cookie = _DENT_NODE.unpack_from(node, _CH.size + 16)
+            entry_name = node[56:56 + nlen]
+            if name is None or entry_name == name:
+                yield entry_name, target, itype
+
+    def _resolve(self, path, follow=True, depth=0):
+        # Returns the inode at path, or None.
+        if depth > MAX_SYMLINKS:
+            raise UbiError("Too many levels of symbolic links: %s" % path)
+        components = [c for c in to_bytes(path).split(b"/") if c and c != b"."]
+        inode = self.inode(UBIFS_ROOT_INO)
+        parents = []
+        for i, component in enumerate(components):
+            if component == b"..":
+                if parents:
+                    inode = parents.pop()
+                continue
+            if not inode.is_dir():
+                return None
+            entry = next(self._entries(inode.inum, component), None)
+            if entry is None:
+                return None
+            child = self.inode(entry[1])
+            if child.is_link() and (follow or i + 1 < len(components)):
+                base = b"/".join(components[:i])
+                target = child.target if child.target.startswith(b"/") \
+                    else b"/" + base + b"/" + child.target
+                rest = b"/".join(components[i + 1:])
+                return self._resolve(target + b"/" + rest if rest else target,
+                                     follow, depth + 1)
+            parents.append(inode)
+            inode = child
+        return inode
+
+    def lookup(self, path, follow=True):
+        """Returns the UbifsInode at path, or None if it doesn't exist.
+        Symbolic links are followed, except for the last component if follow
+        is False."""
+
+        return self._resolve(path, follow)
+
+    def exists(self, path):
+        return self.lookup(path) is not None
+
+    def listdir(self, path):
+        inode = self.lookup(path)
+        if inode is None or not inode.is_dir():
+            raise UbiError("Not a directory: %s" % path)
+        return sorted([to_str(name) for name, inum, itype in self._entries(inode.inum)])
+
+    def _decompress(self, compr_type, data, size):
+        if compr_type == UBIFS_COMPR_NONE:
+            return data
+        elif compr_type == UBIFS_COMPR_ZLIB:
+            return zlib.decompress(data, -15)
+        elif compr_type == UBIFS_COMPR_LZO:
+            if lzo is None:
+                raise UbiError("python-lzo is needed to read LZO compressed UBIFS data")
+            return lzo.decompress(data, False, size)
+        elif compr_type == UBIFS_COMPR_ZSTD:
+            if zstandard is None:
+                raise UbiError("zstandard is needed to read zstd compressed UBIFS data")
+            return zstandard.ZstdDecompressor().decompress(data, max_output_size=size)
+        raise UbiError("Unknown UBIFS compression type %d" % compr_type)
+
+    def read(self, path):
+        """Returns the contents of the file at path."""
+
+        inode = self.lookup(path)
+        if inode is None:
+            raise UbiError("No such file: %s" % path)
+        if inode.is_dir():
+            raise UbiError("Is a directory: %s" % path)
+        if inode.size == 0:
+            return b""
+        blocks = (inode.size + UBIFS_BLOCK_SIZE - 1) // UBIFS_BLOCK_SIZE
+        low = (inode.inum, UBIFS_DATA_KEY << _S_KEY_BLOCK_BITS)
+        high = (inode.inum, (UBIFS_DATA_KEY << _S_KEY_BLOCK_BITS) | (blocks - 1))
+        chunks = []
+        next_block = 0
+        for node_type, key, node in self._scan(low, high):
+            if node_type != UBIFS_DATA_NODE:
+                continue
+            block = key[1] & _S_KEY_HASH_MASK
+            size, compr_type, compr_size = _DATA_NODE.unpack_from(node, _CH.size + 16)
+            # Holes read as zeros.
+            chunks.append(b"\0" * ((block - next_block) * UBIFS_BLOCK_SIZE))
+            data = self._decompress(compr_type, node[48:], size)
+            chunks.append(data + b"\0" * (UBIFS_BLOCK_SIZE - len(data)))
+            next_block = block + 1
+        chunks.append(b"\0" * ((blocks - next_block) * UBIFS_BLOCK_SIZE))
+        return b"".join(chunks)[:inode.size]
+
+
+class UbifsImage(Ubifs):
+    """A UBIFS image, as made by mkfs.ubifs, with the LEBs one after the
+    other."""
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = open(path, "rb")
+        self.mmap = None
+        try:
+            self.mmap = mmap.mmap(self._fd.fileno(), 0, access=mmap.ACCESS_READ)
+            # The LEB size is in the superblock, at the start of LEB 0.
+            Ubifs.__init__(self, self._read_leb)
+        except Exception:
+            self.close()
+            raise
+
+    def _read_leb(self, lnum, offs, length):
+        start = (lnum * self.superblock["leb_size"] if lnum else 0) + offs
+        data = self.mmap[start:start + length]
+        if len(data) < length:
+            data += b"\xff" * (length - len(data))
+        return data
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        self._fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
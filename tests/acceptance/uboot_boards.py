@@ -0,0 +1,153 @@
+#!/usr/bin/python
+# Copyright 2019 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Index of the boards in a U-Boot source tree, used by test_uboot_compile.
+#
+# The index maps every config symbol defined in the Kconfig files under arch/
+# to the architectures defining it, and every defconfig to its CONFIG_TARGET_*
+# symbol and its MTD settings. It is built in one pass over the tree, and saved
+# together with a hash of the source tree, so that it is only built again when
+# the sources change.
+
+import hashlib
+import json
+import os
+import re
+import subprocess
+
+INDEX_FORMAT = 1
+
+_CONFIG_RE = re.compile(r"^config *(\S+) *$")
+
+
+def source_hash(src_dir):
+    """Returns a hash identifying the U-Boot sources. This is the git revision
+    if the tree is a git checkout without local changes to the files the index
+    is built from, otherwise a hash of the names, sizes and modification times
+    of those files."""
+
+    try:
+        with open(os.devnull, "w") as null:
+            revision = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                               cwd=src_dir, stderr=null).decode().strip()
+            status = subprocess.check_output(["git", "status", "--porcelain", "--", "arch", "configs"],
+                                             cwd=src_dir, stderr=null)
+        if not status.strip():
+            return "git:%s" % revision
+    except (OSError, subprocess.CalledProcessError):
+        pass
+
+    digest = hashlib.sha1()
+    for top in ["arch", "configs"]:
+        for dirpath, dirnames, filenames in os.walk(os.path.join(src_dir, top)):
+            dirnames.sort()
+            for file in sorted(filenames):
+                if top == "arch" and file != "Kconfig":
+                    continue
+                st = os.stat(os.path.join(dirpath, file))
+                digest.update(("%s %d %d\n" % (os.path.join(dirpath, file)[len(src_dir):],
+                                               st.st_size, st.st_mtime)).encode())
+    return "stat:%s" % digest.hexdigest()
+
+
+def _index_arch_symbols(src_dir):
+    # Symbol -> list of architectures whose Kconfig files define it. Kconfig
+    # files directly in arch/ belong to no architecture, and are recorded as
+    # "".
+    symbols = {}
+    arch_dir = os.path.join(src_dir, "arch")
+    for dirpath, dirnames, filenames in os.walk(arch_dir):
+        if "Kconfig" not in filenames:
+            continue
+        arch = os.path.relpath(dirpath, arch_dir).split(os.sep)[0]
+        if arch == ".":
+            arch = ""
+        with open(os.path.join(dirpath, "Kconfig")) as fd:
+            for line in fd:
+                match = _CONFIG_RE.match(line)
+                if match:
+                    archs = symbols.setdefault(match.group(1), [])
+                    if arch not in archs:
+                        archs.append(arch)
+    return symbols
+
+
+def _index_defconfigs(src_dir):
+    # Defconfig -> dictionary with its target symbol (without "CONFIG_") and
+    # MTD settings, any of which may be None.
+    defconfigs = {}
+    configs_dir = os.path.join(src_dir, "configs")
+    for config in os.listdir(configs_dir):
+        if not config.endswith("_defconfig"):
+            continue
+        entry = {"target": None, "mtdids": None, "mtdparts": None}
+        with open(os.path.join(configs_dir, config)) as fd:
+            for line in fd:
+                line = line.strip()
+                if (entry["target"] is None and line.startswith("CONFIG_TARGET_")
+                        and line.endswith("=y")):
+                    entry["target"] = line.split("=", 2)[0][len("CONFIG_"):]
+                elif line.startswith("CONFIG_MTDPARTS_DEFAULT="):
+                    entry["mtdparts"] = line.split("=", 2)[1]
+                elif line.startswith("CONFIG_MTDIDS_DEFAULT="):
+                    entry["mtdids"] = line.split("=", 2)[1]
+        defconfigs[config] = entry
+    return defconfigs
+
+
+def build_index(src_dir, hash=None):
+    return {
+        "format": INDEX_FORMAT,
+        "source_hash": hash or source_hash(src_dir),
+        "arch_symbols": _index_arch_symbols(src_dir),
+        "defconfigs": _index_defconfigs(src_dir),
+    }
+
+
+def load_index(src_dir, cache_file=None):
+    """Returns the index of src_dir, from cache_file if it is there and was
+    built from the same sources, otherwise it is built and saved there."""
+
+    hash = source_hash(src_dir)
+
+    if cache_file is not None and os.path.exists(cache_file):
+        try:
+            with open(cache_file) as fd:
+                index = json.load(fd)
+            if index.get("format") == INDEX_FORMAT and index.get("source_hash") == hash:
+                return index
+        except ValueError:
+            # Broken cache, just build it again.
+            pass
+
+    index = build_index(src_dir, hash)
+
+    if cache_file is not None:
+        tmp_file = "%s.%d" % (cache_file, os.getpid())
+        with open(tmp_file, "w") as fd:
+            json.dump(index, fd)
+        os.rename(tmp_file, cache_file)
+
+    return index
+
+
+def target_archs(index, config):
+    """Returns the architectures defining the target of config, or None if the
+    target isn't known."""
+
+    target = index["defconfigs"][config]["target"]
+    if target is None:
+        return None
+    return index["arch_symbols"].get(target, [])
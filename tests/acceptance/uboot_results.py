@@ -0,0 +1,164 @@
+#!/usr/bin/python
+# Copyright 2019 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Result store for test_uboot_compile.
+#
+# The result of every board is kept in an SQLite database, keyed by the
+# defconfig, the revision of the U-Boot sources and a hash of everything else
+# that goes into the test: the auto configuration scripts, the Mender patches,
+# the changes the recipe made to the sources and the build settings. A board
+# only needs to be tested again if one of those has changed. Only the tail of
+# the log of each board is kept.
+
+import collections
+import hashlib
+import os
+import sqlite3
+import subprocess
+import time
+
+LOG_TAIL_LINES = 50
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    defconfig TEXT NOT NULL,
+    source_revision TEXT NOT NULL,
+    inputs_hash TEXT NOT NULL,
+    failed INTEGER NOT NULL,
+    wall_time INTEGER,
+    log_tail TEXT NOT NULL,
+    recorded REAL NOT NULL,
+    PRIMARY KEY (defconfig, source_revision, inputs_hash)
+)
+"""
+
+
+def _hash_file(digest, path):
+    digest.update(("%s\n" % path).encode())
+    with open(path, "rb") as fd:
+        while True:
+            chunk = fd.read(1048576)
+            if not chunk:
+                break
+            digest.update(chunk)
+
+
+def source_revision(src_dir):
+    """The git revision of the U-Boot sources, or None if it is not a git
+    checkout."""
+
+    try:
+        with open(os.devnull, "w") as null:
+            return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                           cwd=src_dir, stderr=null).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def inputs_hash(src_dir, files, settings):
+    """Hash of everything besides the source revision that the result of a
+    board depends on: files is a list of files and directories, whose contents
+    are hashed, and settings a list of strings. The local changes in src_dir,
+    which are the patches and generated files added by the recipe, are
+    included too. If src_dir isn't a git checkout, all of it is hashed."""
+
+    digest = hashlib.sha256()
+    for path in sorted(files):
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for file in sorted(filenames):
+                    _hash_file(digest, os.path.join(dirpath, file))
+        elif os.path.exists(path):
+            _hash_file(digest, path)
+    for setting in settings:
+        digest.update(("%s\n" % setting).encode())
+
+    try:
+        with open(os.devnull, "w") as null:
+            digest.update(subprocess.check_output(["git", "diff", "--binary", "HEAD"],
+                                                  cwd=src_dir, stderr=null))
+            untracked = subprocess.check_output(["git", "ls-files", "-z", "--others",
+                                                 "--exclude-standard"],
+                                                cwd=src_dir, stderr=null).decode()
+        for file in sorted(untracked.split("\0")):
+            if file:
+                _hash_file(digest, os.path.join(src_dir, file))
+    except (OSError, subprocess.CalledProcessError):
+        for dirpath, dirnames, filenames in os.walk(src_dir):
+            dirnames.sort()
+            for file in sorted(filenames):
+                if not os.path.islink(os.path.join(dirpath, file)):
+                    _hash_file(digest, os.path.join(dirpath, file))
+
+    return digest.hexdigest()
+
+
+def parse_log(path):
+    """Reads a board log from Makefile.test_uboot_automation, and returns
+    (failed, wall time or None, tail of the log)."""
+
+    failed = False
+    wall_time = None
+    tail = collections.deque(maxlen=LOG_TAIL_LINES)
+    with open(path) as fd:
+        for line in fd:
+            if line == "AutoPatchFailed\n":
+                failed = True
+            elif line.startswith("BoardWallTime: "):
+                wall_time = int(line.split()[1])
+            tail.append(line)
+    return failed, wall_time, "".join(tail)
+
+
+class ResultStore(object):
+    def __init__(self, path, source_revision, inputs_hash):
+        self.source_revision = source_revision or "unknown"
+        self.inputs_hash = inputs_hash
+        self.db = sqlite3.connect(path)
+        self.db.execute(_SCHEMA)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def has_result(self, defconfig):
+        cursor = self.db.execute("SELECT 1 FROM results WHERE defconfig = ? AND source_revision = ? "
+                                 "AND inputs_hash = ?",
+                                 (defconfig, self.source_revision, self.inputs_hash))
+        return cursor.fetchone() is not None
+
+    def record_log(self, defconfig, log):
+        """Stores the result in the board log log."""
+
+        failed, wall_time, tail = parse_log(log)
+        self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (defconfig, self.source_revision, self.inputs_hash, int(failed),
+                         wall_time, tail, time.time()))
+        self.db.commit()
+
+    def results(self, defconfigs):
+        """Returns a dictionary of defconfig -> (failed, wall time, log tail)
+        for those of defconfigs that have results for the current inputs."""
+
+        wanted = set(defconfigs)
+        results = {}
+        cursor = self.db.execute("SELECT defconfig, failed, wall_time, log_tail FROM results "
+                                 "WHERE source_revision = ? AND inputs_hash = ?",
+                                 (self.source_revision, self.inputs_hash))
+        for defconfig, failed, wall_time, tail in cursor:
+            if defconfig in wanted:
+                results[defconfig] = (bool(failed), wall_time, tail)
+        return results
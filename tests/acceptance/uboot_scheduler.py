@@ -0,0 +1,282 @@
+#!/usr/bin/python
+# Copyright 2019 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Scheduler for the board matrix of test_uboot_compile.
+#
+# Instead of a fixed "make -j N", boards are started one by one while there is
+# room for them. The number of boards allowed to run at the same time is
+# raised while the machine has resources to spare, and lowered when memory
+# pressure rises, based on /proc/pressure (where available) and MemAvailable.
+# The peak RSS and duration of each board is saved in a history file, which is
+# used to estimate how much memory a board will need the next time, and to
+# start the slowest boards first. The RSS of a board is the sum over all the
+# processes it runs in parallel, sampled while it runs, since a board built
+# with "make -j N" needs memory for N compilers at once.
+
+import json
+import os
+import re
+import signal
+import subprocess
+import time
+
+# Used for boards we have no history for.
+DEFAULT_BOARD_RSS_KB = 1048576
+# Memory which should always be left available.
+MEMORY_RESERVE_KB = 524288
+# Percentage of time, over the last 10 seconds, in which some tasks were
+# stalled on memory, above which concurrency is lowered, and below which it may
+# be raised.
+MEMORY_PRESSURE_HIGH = 10.0
+MEMORY_PRESSURE_LOW = 1.0
+# Same for CPU. Above this there is no point in starting more boards.
+CPU_PRESSURE_HIGH = 80.0
+
+POLL_INTERVAL = 1.0
+# How long to wait between changes to the concurrency, so that the effect of
+# the previous change can be seen in the pressure averages.
+ADJUST_INTERVAL = 10.0
+
+
+def mem_available_kb():
+    with open("/proc/meminfo") as fd:
+        for line in fd.readlines():
+            match = re.match(r"^MemAvailable:\s+([0-9]+)\s*kB", line)
+            if match:
+                return int(match.group(1))
+    return None
+
+
+def pressure(resource):
+    """Returns the "some avg10" value of /proc/pressure/<resource>, or None if
+    pressure information is not available."""
+
+    try:
+        with open("/proc/pressure/%s" % resource) as fd:
+            for line in fd.readlines():
+                if line.startswith("some "):
+                    match = re.search(r"\bavg10=([0-9.]+)", line)
+                    if match:
+                        return float(match.group(1))
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def process_group_rss_kb(pgids):
+    """Returns a dictionary with the total RSS, in KiB, of the processes in each
+    of the process groups pgids, or None if /proc is not available."""
+
+    totals = dict([(pgid, 0) for pgid in pgids])
+    page_kb = os.sysconf("SC_PAGE_SIZE") // 1024
+    try:
+        pids = [entry for entry in os.listdir("/proc") if entry.isdigit()]
+    except OSError:
+        return None
+    for pid in pids:
+        try:
+            with open("/proc/%s/stat" % pid) as fd:
+                stat = fd.read()
+        except (IOError, OSError):
+            # Already gone.
+            continue
+        # The command name may contain spaces, so split after it. The process
+        # group is the 5th field, and the RSS in pages the 24th.
+        fields = stat[stat.rfind(")") + 2:].split()
+        pgid = int(fields[2])
+        if pgid in totals:
+            totals[pgid] += int(fields[21]) * page_kb
+    return totals
+
+
+class BoardHistory(object):
+    """Peak RSS and duration of previous runs of each board."""
+
+    def __init__(self, path):
+        self.path = path
+        self.boards = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as fd:
+                    self.boards = json.load(fd)
+            except ValueError:
+                # Broken history, start again.
+                pass
+
+    def peak_rss_kb(self, name):
+        return self.boards.get(name, {}).get("peak_rss_kb", DEFAULT_BOARD_RSS_KB)
+
+    def duration(self, name):
+        return self.boards.get(name, {}).get("duration", 0)
+
+    def record(self, name, peak_rss_kb, duration):
+        self.boards[name] = {"peak_rss_kb": peak_rss_kb, "duration": duration}
+        if self.path is None:
+            return
+        tmp_path = "%s.tmp" % self.path
+        with open(tmp_path, "w") as fd:
+            json.dump(self.boards, fd)
+        os.rename(tmp_path, self.path)
+
+
+class BoardJob(object):
+    """A board to run. command is a function taking the number of parallel
+    jobs to give to make inside the board, and returning a shell command. If
+    the board is interrupted, output is removed, so that it is run again when
+    the matrix is resumed. done, if given, is called when the board has
+    finished successfully."""
+
+    def __init__(self, name, command, output=None, done=None):
+        self.name = name
+        self.command = command
+        self.output = output
+        self.done = done
+        self.process = None
+        self.start_time = None
+        self.peak_rss_kb = 0
+
+
+class AdaptiveScheduler(object):
+    def __init__(self, max_jobs, history_file=None, env=None, min_jobs=1):
+        self.max_jobs = max_jobs
+        self.min_jobs = min_jobs
+        self.env = env
+        self.history = BoardHistory(history_file)
+        self.target = min_jobs
+        self.last_adjust = time.time()
+        self.peak_concurrency = 0
+
+    def _adjust_target(self, running):
+        now = time.time()
+        if now - self.last_adjust < ADJUST_INTERVAL:
+            return
+        memory = pressure("memory")
+        cpu = pressure("cpu")
+
+        new_target = self.target
+        if memory is not None and memory > MEMORY_PRESSURE_HIGH:
+            new_target = max(self.min_jobs, min(self.target, running) - 1)
+        elif ((memory is None or memory < MEMORY_PRESSURE_LOW)
+              and (cpu is None or cpu < CPU_PRESSURE_HIGH)
+              and running >= self.target):
+            new_target = min(self.max_jobs, self.target + 1)
+
+        if new_target != self.target:
+            print("Board scheduler: %d -> %d parallel boards (memory pressure: %s, CPU pressure: %s)"
+                  % (self.target, new_target, memory, cpu))
+            self.target = new_target
+            self.last_adjust = now
+
+    def _room_for(self, job, running):
+        if running >= self.target:
+            return False
+        if running == 0:
+            # Always make progress.
+            return True
+        available = mem_available_kb()
+        if available is None:
+            return True
+        return available - self.history.peak_rss_kb(job.name) >= MEMORY_RESERVE_KB
+
+    def _start(self, job, running):
+        # Spread the cores over the boards expected to run at the same time.
+        # Going by the target, not only the boards running so far, keeps the
+        # first boards from getting all the cores each.
+        subjobs = max(1, -(-self.max_jobs // max(self.target, running + 1)))
+        job.start_time = time.time()
+        # Start in a separate process group, so that the whole tree can be
+        # stopped if we are interrupted.
+        job.process = subprocess.Popen(job.command(subjobs), shell=True, env=self.env,
+                                       stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+
+    def _sample_rss(self, running):
+        # The processes of a board are all in the process group of its shell.
+        totals = process_group_rss_kb([job.process.pid for job in running])
+        if totals is None:
+            return
+        for job in running:
+            job.peak_rss_kb = max(job.peak_rss_kb, totals[job.process.pid])
+
+    def _reap(self, running):
+        # Removes the jobs that have finished from running, and returns them.
+        # A job is removed before its result is checked, so that an error
+        # does not make run() stop the jobs that have already succeeded.
+        finished = []
+        for job in list(running):
+            pid, status, rusage = os.wait4(job.process.pid, os.WNOHANG)
+            if pid == 0:
+                continue
+            running.remove(job)
+            if os.WIFEXITED(status):
+                returncode = os.WEXITSTATUS(status)
+            else:
+                returncode = -os.WTERMSIG(status)
+            # Keep Popen from trying to wait for it again.
+            job.process.returncode = returncode
+            duration = time.time() - job.start_time
+            # ru_maxrss is only the largest RSS of any single process of the
+            # job, in KiB, but it catches short peaks the sampling missed.
+            self.history.record(job.name, max(job.peak_rss_kb, rusage.ru_maxrss), duration)
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, job.name)
+            if job.done is not None:
+                job.done()
+            finished.append(job)
+        return finished
+
+    def _stop(self, running):
+        for job in running:
+            try:
+                os.killpg(job.process.pid, signal.SIGTERM)
+                os.waitpid(job.process.pid, 0)
+            except OSError:
+                pass
+            if job.output is not None and os.path.exists(job.output):
+                os.remove(job.output)
+
+    def _initial_target(self, jobs):
+        # As many boards as the memory is expected to fit, going by the largest
+        # peak RSS seen among them before.
+        available = mem_available_kb()
+        if available is None or not jobs:
+            return self.max_jobs
+        largest = max([self.history.peak_rss_kb(job.name) for job in jobs])
+        fits = (available - MEMORY_RESERVE_KB) // largest
+        return int(max(self.min_jobs, min(self.max_jobs, fits)))
+
+    def run(self, jobs):
+        # Start with the boards that took longest last time.
+        pending = sorted(jobs, key=lambda job: self.history.duration(job.name), reverse=True)
+        running = []
+        self.target = self._initial_target(pending)
+        print("Board scheduler: starting with %d parallel boards, at most %d"
+              % (self.target, self.max_jobs))
+        try:
+            while pending or running:
+                self._sample_rss(running)
+                self._reap(running)
+
+                self._adjust_target(len(running))
+                while pending and self._room_for(pending[0], len(running)):
+                    job = pending.pop(0)
+                    self._start(job, len(running))
+                    running.append(job)
+                self.peak_concurrency = max(self.peak_concurrency, len(running))
+
+                if running:
+                    time.sleep(POLL_INTERVAL)
+        except BaseException:
+            self._stop(running)
+            raise